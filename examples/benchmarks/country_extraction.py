@@ -0,0 +1,77 @@
+import argparse
+import time
+
+from flashgeotext.geotext import GeoText
+import pandas as pd
+
+from seldonite import filters
+
+TEXT = '''Canada and the United States agreed to new trade terms on Tuesday, ''' \
+       '''while officials in Germany and France said they would review the deal. ''' \
+       '''Talks with Mexico are expected to continue next month in Ottawa.'''
+
+def get_countries_per_row(text):
+    # previous implementation, building the gazetteer for every row
+    geotext = GeoText()
+    places = geotext.extract(input_text=text)
+    return list(places['countries'].keys())
+
+def time_rows(func, num_rows):
+    start = time.perf_counter()
+    func()
+    return num_rows / (time.perf_counter() - start)
+
+def local_benchmark(args):
+    texts = pd.Series([TEXT] * args.num_rows)
+
+    # building the gazetteer is slow, so time the previous implementation on fewer rows
+    num_per_row = min(args.num_rows, args.num_per_row_rows)
+    per_row_rate = time_rows(lambda: [get_countries_per_row(text) for text in texts[:num_per_row]], num_per_row)
+    batch_rate = time_rows(lambda: filters.extract_countries_batch(texts, counts=args.counts, positions=args.positions), args.num_rows)
+
+    return per_row_rate, batch_rate
+
+def spark_benchmark(args):
+    import pyspark.sql as psql
+    import pyspark.sql.functions as sfuncs
+
+    spark = psql.SparkSession.builder \
+        .master(args.master) \
+        .appName("country_extraction_benchmark") \
+        .getOrCreate()
+
+    num_per_row = min(args.num_rows, args.num_per_row_rows)
+    per_row_df = spark.range(num_per_row).select(sfuncs.lit(TEXT).alias('text')).cache()
+    per_row_df.count()
+    batch_df = spark.range(args.num_rows).select(sfuncs.lit(TEXT).alias('text')).cache()
+    batch_df.count()
+
+    per_row_udf = sfuncs.udf(get_countries_per_row, psql.types.ArrayType(psql.types.StringType()))
+    batch_udf = filters.country_extractor_udf(counts=args.counts, positions=args.positions)
+
+    per_row_rate = time_rows(lambda: per_row_df.select(per_row_udf('text')).write.format('noop').mode('overwrite').save(), num_per_row)
+    batch_rate = time_rows(lambda: batch_df.select(batch_udf('text')).write.format('noop').mode('overwrite').save(), args.num_rows)
+
+    return per_row_rate, batch_rate
+
+def main(args):
+    if args.spark:
+        per_row_rate, batch_rate = spark_benchmark(args)
+    else:
+        per_row_rate, batch_rate = local_benchmark(args)
+
+    print(f"Per row gazetteer: {per_row_rate:.1f} rows/s")
+    print(f"Cached gazetteer, batched: {batch_rate:.1f} rows/s")
+    print(f"Speedup: {batch_rate / per_row_rate:.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-rows', type=int, default=10000)
+    parser.add_argument('--num-per-row-rows', type=int, default=50)
+    parser.add_argument('--counts', action='store_true')
+    parser.add_argument('--positions', action='store_true')
+    parser.add_argument('--spark', action='store_true')
+    parser.add_argument('--master', default='local[1]')
+    args = parser.parse_args()
+
+    main(args)
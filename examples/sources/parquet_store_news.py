@@ -0,0 +1,31 @@
+import argparse
+
+from seldonite.sources import news
+from seldonite.spark import spark_tools
+from seldonite import collect, run
+
+
+def main(args):
+
+    if args.compact:
+        spark_builder = spark_tools.SparkBuilder(args.master)
+        with spark_builder.start_session() as spark_manager:
+            num_compacted = news.ParquetStore(args.store).compact(spark_manager, target_file_mb=args.target_file_mb)
+        print(f"Compacted {num_compacted} partitions")
+        return
+
+    csv_source = news.CSV(args.input)
+    collector = collect.Collector(csv_source)
+    runner = run.Runner(collector)
+    runner.send_to_parquet(args.store)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input')
+    parser.add_argument('--store')
+    parser.add_argument('--master')
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--target-file-mb', type=int, default=128)
+    args = parser.parse_args()
+
+    main(args)
@@ -4,7 +4,7 @@ import urllib
 import pyspark.sql.functions as sfuncs
 import pyspark.sql as psql
 
-from seldonite import base
+from seldonite import base, filters
 from seldonite.helpers import utils
 
 
@@ -74,8 +74,8 @@ class Analyze(base.BaseStage):
     def proportion_of_countries(self, df):
         df = df.withColumn('all_text', psql.functions.concat(df['title'], psql.functions.lit(' '), df['text']))
 
-        udfCountry = sfuncs.udf(utils.get_countries, ArrayType(StringType(), True))
-        df = df.withColumn('countries', udfCountry(df.all_text))
+        udfCountry = filters.country_extractor_udf()
+        df = df.withColumn('countries', udfCountry(df.all_text).getField('countries'))
 
         key = df.select(sfuncs.explode(df.countries).alias("key"))
 
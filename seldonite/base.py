@@ -12,4 +12,10 @@ class BaseStage:
         raise NotImplementedError('Stage must implement _process method')
 
     def _set_spark_options(self, spark_builder: spark_tools.SparkBuilder):
-        self.input._set_spark_options(spark_builder)
\ No newline at end of file
+        self.input._set_spark_options(spark_builder)
+
+    def _release(self, keep=[]):
+        self.input._release(keep=keep)
+
+    def _record_written(self, spark_manager: spark_tools.SparkManager, df):
+        self.input._record_written(spark_manager, df)
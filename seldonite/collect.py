@@ -1,14 +1,50 @@
+import collections
 import datetime
+import logging
 import os
+import re
 
 import pyspark.sql as psql
 import pyspark.sql.functions as sfuncs
 
 from seldonite import filters
+from seldonite.filters import political
 from seldonite.helpers import utils
 from seldonite.sources import news
 from seldonite.spark import spark_tools
 
+# above this many URLs, look up with a sort-merge join instead of broadcasting
+MAX_BROADCAST_URLS = 100000
+
+# filters that read the concatenated title and text of articles
+TEXT_FILTERS = ['keywords', 'language', 'near_duplicates', 'countries', 'political']
+# columns of fetched articles each filter reads
+FILTER_INPUT_COLS = {'urls': {'url'}, 'distinct': {'url'}, **{name: {'title', 'text'} for name in TEXT_FILTERS}}
+# rows per arrow batch for political filter inference, bounding executor memory
+POLITICAL_ARROW_BATCH_SIZE = 2048
+# units publish dates can be truncated to when stratifying samples
+SAMPLE_DATE_BUCKETS = ['year', 'month', 'week', 'day']
+
+def _ddl_column_names(schema):
+    '''
+    :return: Names of the top level columns of a Spark DDL schema, without needing a Spark session to parse it
+    '''
+    names = []
+    depth = 0
+    field = ''
+    for char in schema + ',':
+        if char in '<(':
+            depth += 1
+        elif char in '>)':
+            depth -= 1
+        if char == ',' and depth == 0:
+            if field.strip():
+                names.append(re.split(r'[\s:]', field.strip(), 1)[0].strip('`'))
+            field = ''
+        else:
+            field += char
+    return names
+
 
 class Collector:
     '''
@@ -26,11 +62,18 @@ class Collector:
         self._max_articles = None
         self._political_filter = False
         self._get_distinct_articles = False
+        self._drop_near_duplicates = False
         self._get_sample = False
         self._filter_countries = False
         self._filter_languages = False
         self._apply_udf = False
+        self._batch_udfs = []
         self._from_urls = False
+        self._count_rows = False
+        self._persisted_dfs = []
+        self._seen_urls = None
+        self._export_warc = False
+        self.filter_row_counts = collections.OrderedDict()
 
     def in_date_range(self, start_date, end_date):
         '''
@@ -50,15 +93,24 @@ class Collector:
         self._source.set_date_range(start_date, end_date)
         return self
 
-    def by_keywords(self, keywords):
+    def by_keywords(self, keywords, case_sensitive=False, whole_words=True, stem=False, lemmatize=False, output=False):
         '''
         Set some keywords to filter by
+
+        :param whole_words: Only match keywords as whole words, otherwise match anywhere in the text
+        :param stem: Strip plural suffixes from words before matching
+        :param lemmatize: Match keyword lemmas using a spark-nlp pipeline, much slower than the other options
+        :param output: Keep the number of occurrences of each keyword in column `keyword_counts`, unless lemmatizing
         '''
+        keyword_options = {'case_sensitive': case_sensitive, 'whole_words': whole_words, 'stem': stem}
 
-        if self._source.can_keyword_filter:
-            self._source.set_keywords(keywords)
+        if self._source.can_keyword_filter and not lemmatize and not output:
+            self._source.set_keywords(keywords, **keyword_options)
         else:
             self._keywords = keywords
+            self._keyword_options = keyword_options
+            self._lemmatize_keywords = lemmatize
+            self._output_keyword_counts = output
 
         return self
 
@@ -67,11 +119,22 @@ class Collector:
 
         return self
 
-    def only_political_articles(self, threshold=0.5, output=False):
-        filters.political.ensure_zip_exists()
+    def only_political_articles(self, threshold=0.5, output=False, quantized=False, first_stage=None):
+        '''
+        :param first_stage: Calibrated `political.HashedLinearClassifier`, or path to one saved with its `save` method.
+            Articles it is confident about skip the CNN, see `political.train_first_stage`
+        '''
+        political.ensure_zip_exists()
+        if isinstance(first_stage, str):
+            first_stage = political.HashedLinearClassifier.load(first_stage)
+        if first_stage is not None and first_stage.threshold != threshold:
+            raise ValueError(f"First stage was calibrated for threshold {first_stage.threshold}, not {threshold}")
+
         self._political_filter = True
         self._political_filter_threshold = threshold
         self._political_filter_output = output
+        self._political_filter_quantized = quantized
+        self._political_first_stage = first_stage
         return self
 
     def on_sites(self, sites):
@@ -86,14 +149,19 @@ class Collector:
         self._url_only_val = set
         return self
 
-    def in_language(self, lang='en'):
+    def in_language(self, lang='en', max_chars=2000, output=False):
         '''
         Filter by languages, language option in ISO 639-1
+
+        :param max_chars: Only detect the language from this many characters at the start of each article
+        :param output: Keep the detected language and its confidence in columns `language` and `language_confidence`
         '''
         if self._source.can_lang_filter:
             self._source.set_language(lang)
         self._filter_languages = True
         self._in_language = lang
+        self._language_max_chars = max_chars
+        self._output_language = output
         return self
 
     def exclude_in_url(self, url_wildcards):
@@ -105,34 +173,125 @@ class Collector:
         self._get_distinct_articles = True
         return self
 
-    def sample(self, num_articles):
+    def drop_near_duplicates(self, threshold=0.8, num_perm=128, shingle_size=5):
+        '''
+        Keep only the earliest published of each group of articles with near duplicate text, such as syndicated stories
+
+        :param threshold: Jaccard similarity of the articles' word shingles above which they are duplicates
+        :param num_perm: Number of MinHash permutations, more give more accurate similarity estimates
+        :param shingle_size: Number of consecutive words in each shingle
+        '''
+        self._drop_near_duplicates = True
+        self._near_duplicate_options = {'threshold': threshold, 'num_perm': num_perm, 'shingle_size': shingle_size}
+        return self
+
+    def sample(self, num_articles, stratify_by=None, allocation='proportional', seed=0):
+        '''
+        Randomly sample exactly `num_articles` articles, or all articles if there are fewer, in a single pass
+
+        :param stratify_by: 'domain', a date bucket of 'year', 'month', 'week' or 'day', or any other column such as
+            'language' when kept with `in_language(output=True)`
+        :param allocation: 'proportional' to sample each stratum by its share of articles, or 'equal' to sample strata evenly
+        :param seed: Seed for reproducible samples
+        '''
+        if allocation not in ('proportional', 'equal'):
+            raise ValueError(f"Unknown sample allocation '{allocation}', please use 'proportional' or 'equal'")
+
         self._get_sample = True
         self._num_sample_articles = num_articles
+        self._sample_stratify_by = stratify_by
+        self._sample_allocation = allocation
+        self._sample_seed = seed
         return self
 
-    def mentions_countries(self, countries=[], min_num_countries=0, ignore_countries=[], output=False):
+    def mentions_countries(self, countries=[], min_num_countries=0, ignore_countries=[], output=False, counts=False, positions=False):
+        '''
+        Filter by countries mentioned in articles
+
+        :param output: Keep the mentioned countries in column `countries`
+        :param counts: Output the number of mentions of each country in column `country_counts`
+        :param positions: Output the character spans of mentions of each country in column `country_spans`
+        '''
         self._mentions_countries = countries
         self._min_num_countries = min_num_countries
         self._ignore_countries = ignore_countries
         self._filter_countries = True
         self._output_countries = output
+        self._output_country_counts = counts
+        self._output_country_positions = positions
         return self
 
     def apply_udf(self, udf, column):
+        '''
+        Replace a column with the output of a row at a time Spark UDF, dropping rows where the column is null
+        '''
         self._apply_udf = True
         self._udf_to_apply = udf
         self._apply_udf_col = column
+        return self
+
+    def apply_batch_udf(self, func, input_cols, output_schema, batch_size=None, setup=None, arrow=False):
+        '''
+        Apply a function to batches of articles in Arrow batches, much faster than `apply_udf` for models and lookups
+
+        Can be called several times, and functions are applied in order.
+
+        :param func: Function of a batch of each input column, as pandas series or pyarrow arrays, preceded by the state from `setup` if given.
+                     Returns a series or array for a single output column, or a dataframe, dict or tuple of them for several
+        :param input_cols: Column or list of columns to pass to the function
+        :param output_schema: Spark DDL schema of the output columns, e.g. 'sentiment double, label string'. Outputs replace input columns of the same name
+        :param batch_size: Number of rows in each batch passed to the function, defaults to the Arrow batch size
+        :param setup: Function called once per executor python worker to create expensive state, such as a model or lookup table
+        :param arrow: Pass pyarrow arrays to the function instead of pandas series
+        '''
+        self._batch_udfs.append({'func': func, 'input_cols': input_cols, 'output_schema': output_schema, 'batch_size': batch_size, 'setup': setup, 'arrow': arrow})
+        return self
+
+    def from_urls(self, urls, broadcast=None):
+        '''
+        Only fetch articles with these URLs
+
+        :param urls: List of URLs, a DataFrame with a `url` column, or a path to URLs stored as
+                     Parquet (.parquet), CSV with a `url` header (.csv), or text with one URL per line
+        :param broadcast: Broadcast the URLs to every executor for the lookup instead of using a sort-merge join.
+                          Defaults to broadcasting only short lists of URLs
+        '''
+        if broadcast is None:
+            broadcast = isinstance(urls, list) and len(urls) <= MAX_BROADCAST_URLS
 
-    def from_urls(self, urls):
         if self._source.can_url_search:
-            self._source.set_urls(urls)
+            self._source.set_urls(urls, broadcast=broadcast)
         else:
             self._urls = urls
+            self._broadcast_urls = broadcast
             self._from_urls = True
         return self
 
+    def exclude_seen_urls(self, seen_urls):
+        '''
+        Skip articles collected by previous runs, and record the URLs of articles written by `Runner.send_to_database` or `Runner.send_to_parquet`
+
+        :param seen_urls: `seen_urls.ParquetSeenUrls` for an exact set of URLs, or `seen_urls.BloomSeenUrls` for very large histories
+        '''
+        self._source.set_seen_urls(seen_urls)
+        self._seen_urls = seen_urls
+        return self
+
+    def export_warc_records(self, export_dir, file_mb=1024, index_mode='overwrite'):
+        '''
+        Copy the raw WARC records of fetched articles into local WARC files, so later runs can process them again at disk speed
+        with `news.LocalWarc(export_dir)`, or search their offset index with `news.CommonCrawl.set_index(export_dir + '/index')`
+
+        :param export_dir: Directory on a filesystem shared by the driver and executors
+        :param file_mb: Size in megabytes at which exported WARC files are rolled over
+        :param index_mode: 'overwrite' to replace the offset index of earlier exports to the directory, or 'append' to add to it
+        '''
+        self._source.set_warc_export(export_dir, file_mb=file_mb, index_mode=index_mode)
+        self._export_warc = True
+        return self
+
     def _set_spark_options(self, spark_builder: spark_tools.SparkBuilder):
-        if self._keywords:
+        if self._keywords and self._lemmatize_keywords:
             spark_builder.use_spark_nlp()
 
         if self._political_filter:
@@ -142,116 +301,266 @@ class Collector:
             pol_class_archive = f"{political_classifier_path}#pon_classifier"
             spark_builder.add_archive(pol_class_archive)
 
+            arrow_batch_conf = 'spark.sql.execution.arrow.maxRecordsPerBatch'
+            if arrow_batch_conf not in spark_builder.conf:
+                spark_builder.set_conf(arrow_batch_conf, str(POLITICAL_ARROW_BATCH_SIZE))
+
         self._source._set_spark_options(spark_builder)
 
     def _process(self, spark_manager):
         self._check_args()
         df = self._source.fetch(spark_manager, self._max_articles, url_only=self._url_only_val)
-        df.cache()
 
-        if self._apply_udf:
-            df = df.where(sfuncs.col(self._apply_udf_col).isNotNull())
-            df = df.withColumn(self._apply_udf_col, self._udf_to_apply(sfuncs.col(self._apply_udf_col)))
+        self.filter_row_counts = collections.OrderedDict()
+        if self._count_rows:
+            df = self._persist(df)
+            self.filter_row_counts['fetch'] = df.count()
+            logging.info(f"Rows fetched: {self.filter_row_counts['fetch']}")
 
-        if self._get_distinct_articles:
-            df = df.drop_duplicates(['url'])
+        plan = self._plan_filters()
+        text_stages = [idx for idx, (name, _) in enumerate(plan) if name in TEXT_FILTERS]
 
-        if self._from_urls:
-            df = df.filter(sfuncs.col("url").isin(self._urls))
+        for idx, (name, stage) in enumerate(plan):
+            # concat title and text once for all filters that need it
+            if text_stages and idx == text_stages[0]:
+                df = df.withColumn('all_text', sfuncs.concat(df['title'], sfuncs.lit('. '), df['text']))
 
-        if self._keywords:
-            df = utils.tokenize(df)
-            df = df.withColumn('keyword_exists', sfuncs.array_intersect(sfuncs.col('tokens'), sfuncs.array([sfuncs.lit(keyword) for keyword in self._keywords])))
-            df = df.where(sfuncs.size('keyword_exists') > 0)
-            df = df.drop('tokens', 'all_text')
+            df = stage(df, spark_manager)
 
-        if self._filter_countries:
-            if 'countries' not in df.columns:
-                df = df.withColumn('all_text', psql.functions.concat(df['title'], psql.functions.lit('. '), df['text']))
-                udfCountry = sfuncs.udf(utils.get_countries, psql.types.ArrayType(psql.types.StringType(), True))
-                df = df.withColumn('countries', udfCountry(df.all_text))
-            else:
-                if [dtype for name, dtype in df.dtypes if name == 'countries'][0] == 'string':
-                    df = df.withColumn('countries', sfuncs.from_json(sfuncs.col('countries'), 'array<string>'))
-            if self._ignore_countries:
-                for country in self._ignore_countries:
-                    df = df.withColumn('countries', sfuncs.array_remove('countries', country))
-            if self._min_num_countries > 0:
-                df = df.where(sfuncs.size(sfuncs.col('countries')) >= self._min_num_countries)
-            if self._mentions_countries:
-                df = df.withColumn('country_mentioned', sfuncs.array_intersect('countries', sfuncs.array([sfuncs.lit(country) for country in self._mentions_countries])))
-                df = df.where(sfuncs.size('country_mentioned') > 0)
-                df = df.drop('country_mentioned')
-            
-            df = df.drop('all_text')
-            if not self._output_countries:
-                df = df.drop('countries')
+            if text_stages and idx == text_stages[-1]:
+                df = df.drop('all_text')
 
-        if self._filter_languages:
-            df = df.withColumn('all_text', psql.functions.concat(df['title'], psql.functions.lit('. '), df['text']))
-            df = df.where(sfuncs.col('all_text').isNotNull())
+            if self._count_rows:
+                df = self._persist(df)
+                self.filter_row_counts[name] = df.count()
+                logging.info(f"Rows after {name} filter: {self.filter_row_counts[name]}")
 
-            udfLanguage = sfuncs.udf(filters.get_language, psql.types.StringType())
-            df = df.withColumn('language', udfLanguage(df.all_text))
-            df = df.where(sfuncs.col('language') == self._in_language)
-            df = df.drop('language', 'all_text')
+        if self._get_sample:
+            strata_col = None
+            if self._sample_stratify_by:
+                strata_col = '_stratum'
+                df = df.withColumn(strata_col, self._sample_strata(df))
 
-        if self._political_filter:
+            df = spark_tools.reservoir_sample(df, self._num_sample_articles, seed=self._sample_seed, strata_col=strata_col, allocation=self._sample_allocation)
+            if not df.take(1):
+                raise ValueError('No articles found')
 
-            # create concat of title and text
-            df = df.filter(df['title'].isNotNull())
-            df = df.filter(df['text'].isNotNull())
-            df = df.withColumn('all_text', psql.functions.concat(df['title'], psql.functions.lit('. '), df['text']))
+            if strata_col:
+                df = df.drop(strata_col)
 
-            # tokenize text
-            spark_session = spark_manager.get_spark_session()
-            df = filters.political.preprocess_text(spark_session, df)
-            df = df.drop('all_text')
+        if self._max_articles:
+            return df.limit(self._max_articles)
+        else:
+            return df
 
-            # drop invalid rows
-            df = df.filter(df['tokens'].isNotNull())
-            df = df.filter(psql.functions.size('tokens') > 0)
+    def _sample_strata(self, df):
+        if self._sample_stratify_by == 'domain':
+            return sfuncs.regexp_replace(sfuncs.expr("parse_url(url, 'HOST')"), r'^www\.', '')
+        if self._sample_stratify_by in SAMPLE_DATE_BUCKETS:
+            return sfuncs.date_trunc(self._sample_stratify_by, df['publish_date']).cast('string')
+        if self._sample_stratify_by not in df.columns:
+            raise ValueError(f"Cannot stratify sample by missing column '{self._sample_stratify_by}'. Please keep it in the output of its filter.")
+        return df[self._sample_stratify_by].cast('string')
 
-            # increase num partitions ready for predict to avoid errors
-            num_partitions = df.rdd.getNumPartitions()
-            df = df.repartition(num_partitions * 16)
+    def _plan_filters(self):
+        '''
+        Order filters by their estimated cost per row, so that each filter only sees rows cheaper filters have kept
 
-            # get political predictions
-            pred_df = None
-            for df_batch in spark_tools.batch(df, max_rows=100000):
+        User defined functions don't drop rows, so they go after the filters, unless they write a column one reads.
+        Date, site and URL blacklist filters are applied by the source while fetching, before any of these
+        '''
+        plan = []
+        if self._from_urls:
+            plan.append(('urls', self._urls_stage))
+        if self._get_distinct_articles:
+            plan.append(('distinct', self._distinct_stage))
+        if self._keywords:
+            plan.append(('keywords', self._keywords_stage))
+        if self._filter_languages:
+            plan.append(('language', self._language_stage))
+        # shuffles articles by their signatures, so runs on what the cheap filters keep and spares the expensive ones
+        if self._drop_near_duplicates:
+            plan.append(('near_duplicates', self._near_duplicates_stage))
+        if self._filter_countries:
+            plan.append(('countries', self._countries_stage))
+        if self._political_filter:
+            plan.append(('political', self._political_stage))
+
+        udf_plan = []
+        if self._apply_udf:
+            udf_plan.append(('udf', self._udf_stage))
+        if self._batch_udfs:
+            udf_plan.append(('batch_udf', self._batch_udf_stage))
 
-                pred_col = 'political_pred'
-                df_batch = filters.political.spark_predict(df_batch, 'tokens', pred_col)
-                df_batch = df_batch.drop('tokens')
+        udf_cols = self._udf_output_cols()
+        udf_idx = next((idx for idx, (name, _) in enumerate(plan) if udf_cols & FILTER_INPUT_COLS[name]), len(plan))
+        return plan[:udf_idx] + udf_plan + plan[udf_idx:]
 
-                if pred_df is None:
-                    pred_df = df_batch
-                else:
-                    pred_df = pred_df.union(df_batch)
+    def _udf_output_cols(self):
+        cols = set()
+        if self._apply_udf:
+            cols.add(self._apply_udf_col)
+        for udf_args in self._batch_udfs:
+            cols.update(_ddl_column_names(udf_args['output_schema']))
+        return cols
 
-            df = pred_df
+    def get_plan(self):
+        '''
+        Get the names of the filters that will be applied to fetched articles, in order of execution
+        '''
+        return ['fetch'] + [name for name, _ in self._plan_filters()]
 
-            # filter where prediction is higher than threshold
-            df = df.where(f"{pred_col} > {self._political_filter_threshold}")
+    def count_rows(self, set=True):
+        '''
+        Count and log the number of rows remaining after each filter, available afterwards in `filter_row_counts`
 
-            if not self._political_filter_output:
-                df = df.drop('political_pred')
+        Note this materializes the articles after every filter
+        '''
+        self._count_rows = set
+        return self
 
-        if self._get_sample:
-            num_rows = df.count()
-            if num_rows == 0:
-                raise ValueError('No articles found')
+    def _persist(self, df):
+        df = df.persist()
+        self._persisted_dfs.append(df)
+        return df
 
-            frac = (self._num_sample_articles + 1) / num_rows
-            if frac < 1:
-                df = df.sample(fraction=frac).limit(self._num_sample_articles)
+    def _release(self, keep=[]):
+        '''
+        Uncache the frames persisted while filtering
 
-        if self._max_articles:
-            return df.limit(self._max_articles)
+        :param keep: Frames to leave cached, such as the output
+        '''
+        kept_dfs = []
+        for df in self._persisted_dfs:
+            if any(df is kept_df for kept_df in keep):
+                kept_dfs.append(df)
+            else:
+                df.unpersist()
+        self._persisted_dfs = kept_dfs
+        self._source._release()
+
+    def _record_written(self, spark_manager, df):
+        if self._seen_urls:
+            self._seen_urls.add(spark_manager, df)
+
+    def _udf_stage(self, df, spark_manager):
+        df = df.where(sfuncs.col(self._apply_udf_col).isNotNull())
+        return df.withColumn(self._apply_udf_col, self._udf_to_apply(sfuncs.col(self._apply_udf_col)))
+
+    def _batch_udf_stage(self, df, spark_manager):
+        for udf_args in self._batch_udfs:
+            udf = spark_tools.batch_udf(**udf_args)
+            df = df.withColumn('_batch_output', udf(df))
+            output_cols = df.schema['_batch_output'].dataType.names
+            df = df.select(*[col for col in df.columns if col not in output_cols + ['_batch_output']],
+                           *[sfuncs.col('_batch_output')[col].alias(col) for col in output_cols])
+        return df
+
+    def _urls_stage(self, df, spark_manager):
+        url_df = utils.load_urls(spark_manager, self._urls)
+        return utils.lookup_urls(df, url_df, broadcast=self._broadcast_urls)
+
+    def _distinct_stage(self, df, spark_manager):
+        return df.drop_duplicates(['url'])
+
+    def _near_duplicates_stage(self, df, spark_manager):
+        # articles are read once for their signatures and again to drop duplicates
+        df = self._persist(df)
+        return filters.duplicates.drop_near_duplicates(df, text_col='all_text', **self._near_duplicate_options)
+
+    def _keywords_stage(self, df, spark_manager):
+        if self._lemmatize_keywords:
+            df = utils.tokenize(df)
+            df = df.withColumn('keyword_exists', sfuncs.array_intersect(sfuncs.col('tokens'), sfuncs.array([sfuncs.lit(keyword) for keyword in self._keywords])))
+            df = df.where(sfuncs.size('keyword_exists') > 0)
+            return df.drop('tokens')
+
+        matcher = filters.keywords.KeywordMatcher(self._keywords, **self._keyword_options)
+        udfKeywords = filters.keywords.keyword_counter_udf(matcher)
+        df = df.withColumn('keyword_counts', udfKeywords(df.all_text))
+        df = df.where(sfuncs.size('keyword_counts') > 0)
+
+        if not self._output_keyword_counts:
+            df = df.drop('keyword_counts')
+        return df
+
+    def _language_stage(self, df, spark_manager):
+        df = df.where(sfuncs.col('all_text').isNotNull())
+
+        # truncate before handing to python to cut down on serialization
+        text_prefix = sfuncs.substring(sfuncs.col('all_text'), 1, self._language_max_chars)
+        udfLanguage = filters.language_detector_udf()
+        df = df.withColumn('detected_language', udfLanguage(text_prefix))
+        df = df.withColumn('language', sfuncs.col('detected_language.language')) \
+               .withColumn('language_confidence', sfuncs.col('detected_language.language_confidence')) \
+               .drop('detected_language')
+        df = df.where(sfuncs.col('language') == self._in_language)
+
+        if not self._output_language:
+            df = df.drop('language', 'language_confidence')
+        return df
+
+    def _countries_stage(self, df, spark_manager):
+        country_cols = []
+        if self._output_country_counts:
+            country_cols.append('country_counts')
+        if self._output_country_positions:
+            country_cols.append('country_spans')
+
+        if 'countries' not in df.columns or any(country_col not in df.columns for country_col in country_cols):
+            udfCountry = filters.country_extractor_udf(counts=self._output_country_counts, positions=self._output_country_positions)
+            df = df.drop('countries', *country_cols)
+            df = df.withColumn('extracted_countries', udfCountry(df.all_text))
+            df = df.select('*', *(sfuncs.col(f"extracted_countries.{col}").alias(col) for col in ['countries'] + country_cols)) \
+                   .drop('extracted_countries')
         else:
-            return df
+            if [dtype for name, dtype in df.dtypes if name == 'countries'][0] == 'string':
+                df = df.withColumn('countries', sfuncs.from_json(sfuncs.col('countries'), 'array<string>'))
+        if self._ignore_countries:
+            for country in self._ignore_countries:
+                df = df.withColumn('countries', sfuncs.array_remove('countries', country))
+            for country_col in country_cols:
+                df = df.withColumn(country_col, sfuncs.map_filter(country_col, lambda country, _: ~country.isin(self._ignore_countries)))
+        if self._min_num_countries > 0:
+            df = df.where(sfuncs.size(sfuncs.col('countries')) >= self._min_num_countries)
+        if self._mentions_countries:
+            df = df.withColumn('country_mentioned', sfuncs.array_intersect('countries', sfuncs.array([sfuncs.lit(country) for country in self._mentions_countries])))
+            df = df.where(sfuncs.size('country_mentioned') > 0)
+            df = df.drop('country_mentioned')
+
+        if not self._output_countries:
+            df = df.drop('countries')
+        return df
+
+    def _political_stage(self, df, spark_manager):
+        # concat is null for articles without a title or text
+        df = df.filter(df['all_text'].isNotNull())
+
+        pred_col = 'political_pred'
+        if self._political_first_stage is not None:
+            # cheap model decides confident articles, so only the rest are tokenized and run through the CNN
+            df = political.spark_cascade_predict(df, 'all_text', pred_col, self._political_first_stage, quantized=self._political_filter_quantized)
+        else:
+            # tokenize text
+            df = political.preprocess_text(df)
+
+            # drop invalid rows
+            df = df.filter(df['tokens'].isNotNull())
+            df = df.filter(sfuncs.length('tokens') > 0)
+
+            # get political predictions
+            df = political.spark_predict(df, 'tokens', pred_col, quantized=self._political_filter_quantized)
+            df = df.drop('tokens')
+
+        # filter where prediction is higher than threshold
+        df = df.where(f"{pred_col} > {self._political_filter_threshold}")
 
+        if not self._political_filter_output:
+            df = df.drop(pred_col)
+        return df
 
     def _check_args(self):
         if self._url_only_val and self._political_filter:
             raise ValueError('Cannot check political articles and get only URLs. Please remove one of the options.')
+        if self._url_only_val and self._export_warc:
+            raise ValueError('Cannot export WARC records and get only URLs. Please remove one of the options.')
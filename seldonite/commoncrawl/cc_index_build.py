@@ -0,0 +1,216 @@
+import datetime
+import os
+import re
+import urllib.parse
+
+import tldextract
+
+from seldonite import filters
+from seldonite.commoncrawl import warc_files
+from seldonite.commoncrawl.sparkcc import CCIndexSparkJob
+from seldonite.helpers import utils
+
+# ISO 639-3 codes of the languages langdetect can detect, as used in the content_languages column
+LANGUAGE_CODES = {
+    'af': 'afr', 'ar': 'ara', 'bg': 'bul', 'bn': 'ben', 'ca': 'cat', 'cs': 'ces', 'cy': 'cym', 'da': 'dan',
+    'de': 'deu', 'el': 'ell', 'en': 'eng', 'es': 'spa', 'et': 'est', 'fa': 'fas', 'fi': 'fin', 'fr': 'fra',
+    'gu': 'guj', 'he': 'heb', 'hi': 'hin', 'hr': 'hrv', 'hu': 'hun', 'id': 'ind', 'it': 'ita', 'ja': 'jpn',
+    'kn': 'kan', 'ko': 'kor', 'lt': 'lit', 'lv': 'lav', 'mk': 'mkd', 'ml': 'mal', 'mr': 'mar', 'ne': 'nep',
+    'nl': 'nld', 'no': 'nor', 'pa': 'pan', 'pl': 'pol', 'pt': 'por', 'ro': 'ron', 'ru': 'rus', 'sk': 'slk',
+    'sl': 'slv', 'so': 'som', 'sq': 'sqi', 'sv': 'swe', 'sw': 'swa', 'ta': 'tam', 'te': 'tel', 'th': 'tha',
+    'tl': 'tgl', 'tr': 'tur', 'uk': 'ukr', 'ur': 'urd', 'vi': 'vie', 'zh-cn': 'zho', 'zh-tw': 'zho', 'zh': 'zho'
+}
+
+_HTML_LANG_REGEX = re.compile(rb'<html[^>]*\slang\s*=\s*["\']?([a-zA-Z]{2,3}(?:-[a-zA-Z]{2})?)', re.IGNORECASE)
+_TAG_REGEX = re.compile(r'<script.*?</script>|<style.*?</style>|<[^>]+>', re.IGNORECASE | re.DOTALL)
+_CHARSET_REGEX = re.compile(r'charset\s*=\s*["\']?([^\s;"\']+)', re.IGNORECASE)
+
+# public suffix list bundled with tldextract, with and without private suffixes such as blogspot.com
+_suffix_extractors = None
+
+
+def _get_suffix_extractors():
+    global _suffix_extractors
+    if _suffix_extractors is None:
+        _suffix_extractors = (tldextract.TLDExtract(suffix_list_urls=()),
+                              tldextract.TLDExtract(suffix_list_urls=(), include_psl_private_domains=True))
+    return _suffix_extractors
+
+def url_columns(url):
+    '''
+    :return: Dict of the url columns of the cc-index schema for a URL, or None if it can't be parsed
+    '''
+    try:
+        parsed = urllib.parse.urlsplit(url)
+        port = parsed.port
+    except ValueError:
+        return None
+    host = parsed.hostname
+    if not host:
+        return None
+
+    host_parts = host.split('.')[::-1] + [None] * 5
+    registry, private = (extractor(host) for extractor in _get_suffix_extractors())
+    return {
+        'url_surtkey': utils._url_to_surtkey(url),
+        'url': url,
+        'url_host_name': host,
+        'url_host_tld': host_parts[0],
+        'url_host_2nd_last_part': host_parts[1],
+        'url_host_3rd_last_part': host_parts[2],
+        'url_host_4th_last_part': host_parts[3],
+        'url_host_5th_last_part': host_parts[4],
+        'url_host_registry_suffix': registry.suffix or None,
+        'url_host_registered_domain': f"{registry.domain}.{registry.suffix}" if registry.domain and registry.suffix else None,
+        'url_host_private_suffix': private.suffix or None,
+        'url_host_private_domain': f"{private.domain}.{private.suffix}" if private.domain and private.suffix else None,
+        'url_protocol': parsed.scheme,
+        'url_port': port,
+        'url_path': parsed.path,
+        'url_query': parsed.query or None
+    }
+
+def content_languages(html, max_chars=2000):
+    '''
+    :return: ISO 639-3 code of the language of an HTML page, from its declared language or else detected from its text
+    '''
+    match = _HTML_LANG_REGEX.search(html[:4096])
+    if match:
+        code = match.group(1).decode('ascii').lower()
+        if code in LANGUAGE_CODES:
+            return LANGUAGE_CODES[code]
+        if code.split('-')[0] in LANGUAGE_CODES:
+            return LANGUAGE_CODES[code.split('-')[0]]
+
+    text = _TAG_REGEX.sub(' ', html.decode('utf-8', errors='ignore'))
+    language, _ = filters.detect_language(' '.join(text.split()), max_chars=max_chars)
+    return LANGUAGE_CODES.get(language)
+
+
+class CCIndexBuildJob(CCIndexSparkJob):
+    """
+    Index local WARC files into a Parquet table with the schema of the Common Crawl columnar URL index,
+    so the index queries and WARC record fetches used for Common Crawl work against our own crawls
+    """
+
+    name = "CCIndexBuildJob"
+
+    def __init__(self, crawl='LOCAL', segment=None, split_size_mb=64, detect_languages=True, **kwargs):
+        '''
+        :param crawl: Value of the crawl column of indexed records, to query them by
+        :param segment: Value of the warc_segment column, defaults to the name of the directory of each WARC file
+        :param detect_languages: Detect the language of HTML pages without a declared language
+        '''
+        super().__init__(None, None, **kwargs)
+        self.crawl = crawl
+        self.segment = segment
+        self.split_size = int(split_size_mb * 1024 * 1024)
+        self.detect_languages = detect_languages
+
+    def run(self, spark_manager, paths, output_path, mode='overwrite'):
+        '''
+        :param paths: Path or list of paths to WARC files or directories containing them
+        :param output_path: Path of the table to write, which can be loaded with `table_path`
+        :param mode: Spark save mode, `append` to add crawls to an existing table
+        :return: Number of records indexed
+        '''
+        self.output_path = output_path
+        self.mode = mode
+        self.limit = None
+        return super(CCIndexSparkJob, self).run(spark_manager, warc_files.list_warc_files(paths), url_only=False)
+
+    def index_record(self, path, record):
+        '''
+        :return: Dict of the columns of a WARC response record, except its offset and length
+        '''
+        url = record.rec_headers.get_header('WARC-Target-URI')
+        row = url_columns(url) if url else None
+        if row is None:
+            return None
+
+        http_headers = record.http_headers
+        status = int(http_headers.get_statuscode()) if http_headers and http_headers.get_statuscode().isdigit() else None
+        content_type = http_headers.get_header('Content-Type', '') if http_headers else ''
+        mime_type = content_type.split(';')[0].strip().lower() or None
+        charset = _CHARSET_REGEX.search(content_type)
+        detected_mime = record.rec_headers.get_header('WARC-Identified-Payload-Type')
+
+        languages = None
+        if self.detect_languages and status == 200 and self.is_html(record):
+            languages = content_languages(record.content_stream().read())
+
+        warc_date = record.rec_headers.get_header('WARC-Date')
+        try:
+            fetch_time = datetime.datetime.strptime(warc_date[:19], '%Y-%m-%dT%H:%M:%S') if warc_date else None
+        except ValueError:
+            fetch_time = None
+
+        digest = record.rec_headers.get_header('WARC-Payload-Digest')
+        if row['url_path'] == '/robots.txt':
+            subset = 'robotstxt'
+        elif status == 200:
+            subset = 'warc'
+        else:
+            subset = 'crawldiagnostics'
+
+        row.update({
+            'fetch_time': fetch_time,
+            'fetch_status': status,
+            'fetch_redirect': http_headers.get_header('Location') if http_headers and status and 300 <= status < 400 else None,
+            'content_digest': digest.split(':', 1)[-1] if digest else None,
+            'content_mime_type': mime_type,
+            'content_mime_detected': detected_mime.lower() if detected_mime else mime_type,
+            'content_charset': charset.group(1).upper() if charset else None,
+            'content_languages': languages,
+            'content_truncated': record.rec_headers.get_header('WARC-Truncated'),
+            'warc_filename': os.path.abspath(path),
+            'warc_segment': self.segment or os.path.basename(os.path.dirname(os.path.abspath(path))),
+            'crawl': self.crawl,
+            'subset': subset
+        })
+        return row
+
+    def iterate_range_records(self, path, start, archive_iterator):
+        field_names = self.table_schema.fieldNames()
+        for record in archive_iterator:
+            if record.rec_type != 'response':
+                continue
+            self.records_processed.add(1)
+
+            try:
+                row = self.index_record(path, record)
+            except Exception as exception:
+                self.records_parsing_failed.add(1)
+                self.get_logger().error(f"Failed to index record in {path}: {exception}")
+                continue
+            if row is None:
+                self.records_parsing_failed.add(1)
+                continue
+
+            # offsets are relative to the start of the range
+            archive_iterator.read_to_end(record)
+            row['warc_record_offset'] = start + archive_iterator.get_record_offset()
+            row['warc_record_length'] = archive_iterator.get_record_length()
+            yield tuple(row[name] for name in field_names)
+
+    def run_job(self, spark_manager):
+        spark = spark_manager.get_spark_session()
+        self.num_partitions = 4 * spark_manager.get_num_cpus()
+
+        rdd = self.local_warc_ranges(spark_manager).mapPartitions(self.process_warc_ranges)
+        # index rows are small, so keep them rather than scanning the WARC files again to sample the range boundaries
+        df = spark.createDataFrame(rdd, self.table_schema).persist()
+        num_records = df.count()
+
+        # sorted by SURT key like the Common Crawl index, so row group statistics prune lookups by URL and domain
+        df.repartitionByRange(self.num_partitions, 'crawl', 'subset', 'url_surtkey') \
+          .sortWithinPartitions('url_surtkey') \
+          .write \
+          .mode(self.mode) \
+          .partitionBy('crawl', 'subset') \
+          .parquet(self.output_path)
+
+        df.unpersist()
+
+        self.log_aggregators(spark_manager)
+        return num_records
@@ -4,6 +4,7 @@ import pyspark.sql as psql
 
 from seldonite import filters
 from seldonite.commoncrawl.sparkcc import CCSparkJob
+from seldonite.filters.keywords import KeywordMatcher
 from seldonite.helpers import heuristics, worker_utils
 
 
@@ -12,14 +13,21 @@ class FetchNewsJob(CCSparkJob):
 
     name = "FetchNewsJob"
 
-    def run(self, spark_manager, listing, limit=None, keywords=[], sites=[], start_date=None, end_date=None, **kwargs):
-        self.set_constraints(keywords, start_date, end_date)
+    url_blacklist = None
+    seen_url_checker = None
+
+    def run(self, spark_manager, listing, limit=None, keywords=[], keyword_options={}, sites=[], start_date=None, end_date=None, url_black_list=[], seen_url_checker=None, **kwargs):
+        self.set_constraints(keywords, start_date, end_date, keyword_options=keyword_options)
         self.limit = limit
         self.sites = sites
+        self.url_blacklist = filters.compile_url_blacklist(url_black_list)
+        self.seen_url_checker = seen_url_checker
         return super().run(spark_manager, listing, **kwargs)
 
-    def set_constraints(self, keywords, start_date, end_date):
+    def set_constraints(self, keywords, start_date, end_date, keyword_options={}):
         self.keywords = keywords
+        # build the keyword automaton once, rather than for every record
+        self.keyword_matcher = KeywordMatcher(keywords, **keyword_options) if keywords else None
         self.start_date = start_date
         self.end_date = end_date
 
@@ -35,6 +43,12 @@ class FetchNewsJob(CCSparkJob):
         if self.sites and not filters.check_url_from_sites(url, self.sites):
             return None
 
+        if filters.check_url_blacklisted(url, self.url_blacklist):
+            return None
+
+        if self.seen_url_checker and self.seen_url_checker(url):
+            return None
+
         if self.url_only:
             return url
 
@@ -61,7 +75,7 @@ class FetchNewsJob(CCSparkJob):
             if (self.start_date and publish_date < self.start_date) or (self.end_date and publish_date > self.end_date):
                 return None
 
-        if self.keywords and not filters.contains_keywords(article, self.keywords):
+        if self.keyword_matcher and not filters.contains_keywords(article, self.keyword_matcher):
             return None
 
         row_values = collections.OrderedDict()
@@ -0,0 +1,33 @@
+import pyspark.sql as psql
+
+from seldonite.commoncrawl import warc_files
+from seldonite.commoncrawl.fetch_news import FetchNewsJob
+from seldonite.helpers import worker_utils
+
+
+class LocalWarcFetchNewsJob(FetchNewsJob):
+    """ News articles from WARC files on a local or mounted filesystem,
+        with large files split into byte ranges processed by separate tasks """
+
+    name = "LocalWarcFetchNewsJob"
+
+    def __init__(self, split_size_mb=64, **kwargs):
+        super().__init__(None, None, **kwargs)
+        self.split_size = int(split_size_mb * 1024 * 1024)
+
+    def run(self, spark_manager, paths, features=['title', 'text', 'url', 'publish_date'], **kwargs):
+        self.features = features
+        return super().run(spark_manager, warc_files.list_warc_files(paths), **kwargs)
+
+    def iterate_range_records(self, path, start, archive_iterator):
+        for res in self.iterate_records(path, archive_iterator):
+            # URLs alone are returned as strings
+            yield psql.Row(url=res) if isinstance(res, str) else res
+
+    def run_job(self, spark_manager):
+        spark = spark_manager.get_spark_session()
+        self.num_partitions = 4 * spark_manager.get_num_cpus()
+
+        rdd = self.local_warc_ranges(spark_manager).mapPartitions(self.process_warc_ranges)
+        schema = 'url string' if self.url_only else worker_utils.article_schema(self.features)
+        return spark.createDataFrame(rdd, schema)
@@ -1,21 +1,33 @@
+import datetime
+import gzip
 from io import BytesIO
 import json
 import logging
 import math
 import os
 import re
+import urllib.parse
+import uuid
 from tempfile import TemporaryFile
 
 import boto3
 import botocore
+from pyspark import TaskContext
 import pyspark.sql as psql
 from warcio.archiveiterator import ArchiveIterator
 from warcio.recordloader import ArchiveLoadFailed
 
+from seldonite.commoncrawl import warc_files
+from seldonite.helpers import utils
 from seldonite.spark.spark_tools import SparkManager
 
 LOGGING_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
 
+# offset index of exported WARC records, with the columns of the columnar URL index used by its queries
+EXPORT_INDEX_SCHEMA = 'url string, url_surtkey string, url_host_registered_domain string, url_path string, content_charset string, ' \
+                      'warc_filename string, warc_record_offset int, warc_record_length int, crawl string, subset string'
+CRAWL_REGEX = re.compile(r'(CC-(?:MAIN|NEWS)-\d{4}-\d{2})')
+
 
 class CCSparkJob:
     """
@@ -26,6 +38,9 @@ class CCSparkJob:
 
     warc_parse_http_header = True
 
+    # bytes of local WARC files processed by each task
+    split_size = 64 * 1024 * 1024
+
     records_processed = None
     warc_input_processed = None
     warc_input_failed = None
@@ -158,6 +173,50 @@ class CCSparkJob:
             finally:
                 stream.close()
 
+    def split_warc(self, path):
+        '''
+        Split a local WARC file into byte ranges at record boundaries, so large files can be processed by several tasks
+        '''
+        try:
+            ranges = warc_files.split_warc_file(path, self.split_size)
+        except (OSError, ValueError) as exception:
+            # fall back to reading the whole file in one task
+            self.get_logger().error(f"Failed to split WARC {path}: {exception}")
+            ranges = [(path, 0, None)]
+        self.warc_input_processed.add(1)
+        return ranges
+
+    def process_warc_ranges(self, iterator):
+        no_parse = (not self.warc_parse_http_header)
+
+        for path, start, end in iterator:
+            def process_range(reader):
+                archive_iterator = ArchiveIterator(reader, no_record_parse=no_parse, arc2warc=True)
+                yield from self.iterate_range_records(path, start, archive_iterator)
+
+            try:
+                yield from warc_files.iterate_range(path, start, end, process_range)
+            except (ArchiveLoadFailed, OSError) as exception:
+                self.warc_input_failed.add(1)
+                self.get_logger().error(f"Invalid WARC: {path} ({start}-{end}) - {exception}")
+
+    def iterate_range_records(self, path, start, archive_iterator):
+        """Iterate over the WARC records of a byte range of a local file, starting at offset `start`"""
+        return self.iterate_records(path, archive_iterator)
+
+    def local_warc_ranges(self, spark_manager):
+        '''
+        :return: RDD of byte ranges of the local WARC files in the input listing, spread over tasks
+        '''
+        sc = spark_manager.get_spark_context()
+        if not self.input_file_listing:
+            raise ValueError('No WARC files found')
+
+        # find record boundaries of each file in parallel, then spread the ranges over tasks
+        range_rdd = sc.parallelize(self.input_file_listing, numSlices=min(len(self.input_file_listing), self.num_partitions)) \
+                      .flatMap(self.split_warc)
+        return range_rdd.repartition(self.num_partitions)
+
     def process_record(self, record):
         raise NotImplementedError('Processing record needs to be customized')
 
@@ -261,6 +320,8 @@ class CCIndexSparkJob(CCSparkJob):
                                       .option("header", True) \
                                       .option("inferSchema", True) \
                                       .load(self.csv)
+
+        sqldf = self.restrict_dataframe(spark_manager, sqldf)
         sqldf.persist()
 
         num_rows = sqldf.count()
@@ -274,6 +335,12 @@ class CCIndexSparkJob(CCSparkJob):
 
         return sqldf
 
+    def restrict_dataframe(self, spark_manager, sqldf):
+        '''
+        Hook to narrow down the rows matched by the query before they are persisted
+        '''
+        return sqldf
+
     def run_job(self, spark_manager):
         sqldf = self.load_dataframe(spark_manager)
 
@@ -298,6 +365,11 @@ class CCIndexWarcSparkJob(CCIndexSparkJob):
 
     name = "CCIndexWarcSparkJob"
 
+    urls = None
+    broadcast_urls = False
+    seen_urls = None
+    warc_export_dir = None
+
     def __init__(self, *args, query=None, csv=None, **kwargs):
         super().__init__(*args, **kwargs)
         # SQL query to select rows. 
@@ -310,9 +382,25 @@ class CCIndexWarcSparkJob(CCIndexSparkJob):
         # and the input columns `url', `warc_filename', `warc_record_offset' and `warc_record_length' are mandatory, see also option query.
         self.csv = csv
 
+    def fetch_warc_record(self, s3client, warc_path, offset, length):
+        '''
+        :return: Bytes of a WARC record, read from the local filesystem for absolute or `file:` paths and from S3 otherwise
+        '''
+        if warc_path.startswith('/') or warc_path.startswith('file:'):
+            # records of locally indexed WARC files
+            with open(re.sub('^file:(//)?', '', warc_path), 'rb') as warc_file:
+                warc_file.seek(offset)
+                return warc_file.read(length)
+
+        # TODO adapt if grouping warc records
+        rangereq = 'bytes={}-{}'.format(offset, (offset+length-1))
+        response = s3client.get_object(Bucket="commoncrawl",
+                                       Key=warc_path,
+                                       Range=rangereq)
+        return response["Body"].read()
+
     def fetch_process_warc_records(self, rows):
         s3client = boto3.client('s3', aws_access_key_id=self.aws_access_key, aws_secret_access_key=self.aws_secret_key)
-        bucketname = "commoncrawl"
         no_parse = (not self.warc_parse_http_header)
 
 
@@ -326,19 +414,14 @@ class CCIndexWarcSparkJob(CCIndexSparkJob):
             if 'content_charset' in row:
                 content_charset = row['content_charset']
             self.get_logger().debug("Fetching WARC record for {}".format(url))
-            # TODO adapt if grouping warc records
-            rangereq = 'bytes={}-{}'.format(offset, (offset+length-1))
             try:
-                response = s3client.get_object(Bucket=bucketname,
-                                               Key=warc_path,
-                                               Range=rangereq)
+                record_stream = BytesIO(self.fetch_warc_record(s3client, warc_path, offset, length))
             except Exception as exception:
                 self.get_logger().error(
                     'Failed to download: {} ({}, offset: {}, length: {}) - {}'
                     .format(url, warc_path, offset, length, exception))
                 self.warc_input_failed.add(1)
                 continue
-            record_stream = BytesIO(response["Body"].read())
             try:
                 for record in ArchiveIterator(record_stream,
                                               no_record_parse=no_parse):
@@ -356,6 +439,109 @@ class CCIndexWarcSparkJob(CCIndexSparkJob):
                     'Invalid WARC record: {} ({}, offset: {}, length: {}) - {}'
                     .format(url, warc_path, offset, length, exception))
 
+    def export_warc_partition(self, partition_idx, rows):
+        '''
+        Copy the WARC records of a partition into local WARC files of about `warc_export_file_size` bytes,
+        yielding the offset index row of each copied record
+        '''
+        s3client = boto3.client('s3', aws_access_key_id=self.aws_access_key, aws_secret_access_key=self.aws_secret_key)
+        os.makedirs(self.warc_export_dir, exist_ok=True)
+
+        warc_file = None
+        file_num = 0
+        position = 0
+        try:
+            for row in rows:
+                row = row.asDict()
+                try:
+                    data = self.fetch_warc_record(s3client, row['warc_filename'], int(row['warc_record_offset']), int(row['warc_record_length']))
+                except Exception as exception:
+                    self.get_logger().error(
+                        'Failed to download: {} ({}, offset: {}, length: {}) - {}'
+                        .format(row['url'], row['warc_filename'], row['warc_record_offset'], row['warc_record_length'], exception))
+                    self.warc_input_failed.add(1)
+                    continue
+
+                if data[:2] != b'\x1f\x8b':
+                    # records of uncompressed local files are compressed on their own, with the blank lines ending a record
+                    data = gzip.compress(data if data.endswith(b'\r\n\r\n') else data + b'\r\n\r\n')
+
+                if warc_file is None or (position > 0 and position + len(data) > self.warc_export_file_size):
+                    if warc_file is not None:
+                        warc_file.close()
+                        os.replace(attempt_path, export_path)
+                        warc_file = None
+                        file_num += 1
+                    export_path = os.path.abspath(os.path.join(self.warc_export_dir, f"{self.warc_export_run_id}-{partition_idx:05d}-{file_num:05d}.warc.gz"))
+                    # written under a name of this attempt, so failed or speculative attempts never leave partial files
+                    # under the name in the index, and any attempt that finishes moves the same records into place
+                    attempt_path = f"{export_path}.{TaskContext.get().taskAttemptId()}.tmp"
+                    warc_file = open(attempt_path, 'wb')
+                    position = 0
+
+                warc_file.write(data)
+                crawl = row.get('crawl')
+                if not crawl:
+                    crawl_match = CRAWL_REGEX.search(row['warc_filename'])
+                    crawl = crawl_match.group(1) if crawl_match else 'LOCAL'
+                yield (row['url'], utils._url_to_surtkey(row['url']), utils.registered_domain(row['url']), urllib.parse.urlsplit(row['url']).path,
+                       row.get('content_charset'), export_path, position, len(data), crawl, 'warc')
+                position += len(data)
+        finally:
+            if warc_file is not None:
+                warc_file.close()
+        if warc_file is not None:
+            os.replace(attempt_path, export_path)
+
+    def export_warc_records(self, spark_manager, df):
+        '''
+        Copy the WARC records of a dataframe of index rows into local WARC files, so they can be processed again at disk speed,
+        along with an offset index in `index` under the export directory that can be searched with `table_path`.
+        The index replaces that of earlier exports unless `warc_export_index_mode` is 'append'
+
+        :return: RDD of rows locating the copied records
+        '''
+        spark = spark_manager.get_spark_session()
+        self.warc_export_run_id = f"seldonite-{datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+        columns = ['url', 'warc_filename', 'warc_record_offset', 'warc_record_length']
+        columns += [column for column in ['content_charset', 'crawl'] if column in df.columns]
+        export_rdd = df.select(*columns).rdd.mapPartitionsWithIndex(self.export_warc_partition)
+
+        index_path = os.path.join(self.warc_export_dir, 'index')
+        spark.createDataFrame(export_rdd, EXPORT_INDEX_SCHEMA) \
+             .write \
+             .mode(self.warc_export_index_mode) \
+             .partitionBy('crawl', 'subset') \
+             .parquet(index_path)
+        self.get_logger(spark_manager=spark_manager).info(
+            "Exported WARC records to {}".format(self.warc_export_dir))
+
+        # read back from the written index, so records are copied once without keeping them cached for the session
+        index_df = spark.read.parquet(index_path) \
+                        .where(psql.functions.col('warc_filename').contains(f"{os.sep}{self.warc_export_run_id}-"))
+        return index_df.select('url', 'warc_filename', 'warc_record_offset', 'warc_record_length', 'content_charset').rdd
+
+    def restrict_dataframe(self, spark_manager, sqldf):
+        if self.seen_urls is not None:
+            # exclude seen URLs before their WARC records are fetched
+            surtkey_col = 'url_surtkey' if 'url_surtkey' in sqldf.columns else None
+            sqldf = self.seen_urls.exclude(spark_manager, sqldf, surtkey_col=surtkey_col)
+
+        if self.urls is None:
+            return sqldf
+
+        # semi-join against the URLs rather than inlining them into the query
+        # so that any number of URLs can be looked up
+        url_df = utils.load_urls(spark_manager, self.urls)
+        if 'url_surtkey' in sqldf.columns:
+            url_df = utils.add_surtkey(url_df)
+            key = 'url_surtkey'
+        else:
+            key = 'url'
+
+        return utils.lookup_urls(sqldf, url_df, on=key, broadcast=self.broadcast_urls)
+
     def run_job(self, spark_manager):
         df = self.load_dataframe(spark_manager)
 
@@ -366,14 +552,11 @@ class CCIndexWarcSparkJob(CCIndexSparkJob):
             columns = ['url', 'warc_filename', 'warc_record_offset', 'warc_record_length']
             if 'content_charset' in df.columns:
                 columns.append('content_charset')
-            warc_recs = df.select(*columns).rdd
-
-            if self.urls:
-                spark = spark_manager.get_spark_session()
-                url_df = spark.createDataFrame(self.urls, psql.types.StringType()).withColumnRenamed('value', 'url')
-                df = df.join(url_df, 'url', 'leftsemi')
-
-            warc_recs = df.rdd
+            if self.warc_export_dir:
+                # process the local copies of the records
+                warc_recs = self.export_warc_records(spark_manager, df)
+            else:
+                warc_recs = df.select(*columns).rdd
 
         num_warcs = warc_recs.count()
         if num_warcs == 0:
@@ -389,8 +572,19 @@ class CCIndexWarcSparkJob(CCIndexSparkJob):
         return rdd.toDF()
 
 
-    def run(self, spark_manager, features, urls, url_only):
+    def run(self, spark_manager, features, urls, url_only, broadcast_urls=False, seen_urls=None, warc_export_dir=None, warc_export_file_mb=1024,
+            warc_export_index_mode='overwrite'):
+        '''
+        :param warc_export_dir: Directory to copy the matched WARC records into before processing them, on a filesystem shared by executors
+        :param warc_export_file_mb: Size in megabytes at which exported WARC files are rolled over
+        :param warc_export_index_mode: 'overwrite' to replace the offset index of earlier exports, or 'append' to add to it
+        '''
+        self.warc_export_dir = warc_export_dir
+        self.warc_export_file_size = int(warc_export_file_mb * 1024 * 1024)
+        self.warc_export_index_mode = warc_export_index_mode
         self.url_only = url_only
         self.features = features
         self.urls = urls
+        self.broadcast_urls = broadcast_urls
+        self.seen_urls = seen_urls
         return super().run(spark_manager)
@@ -0,0 +1,167 @@
+import io
+import mmap
+import os
+import re
+import zlib
+
+WARC_FILE_REGEX = re.compile(r'.*\.(warc|arc)(\.gz)?$')
+_MIN_CHUNK_SIZE = 1 << 14
+_CHUNK_SIZE = 1 << 20
+_CONTENT_LENGTH_REGEX = re.compile(rb'\r\nContent-Length:\s*(\d+)', re.IGNORECASE)
+
+
+def list_warc_files(paths):
+    '''
+    :param paths: Path or list of paths to WARC files or directories containing them
+    :return: Sorted list of paths to WARC files
+    '''
+    if isinstance(paths, str):
+        paths = [paths]
+
+    warc_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, file_names in os.walk(path):
+                warc_paths.extend(os.path.join(dir_path, file_name) for file_name in file_names if WARC_FILE_REGEX.match(file_name))
+        elif os.path.exists(path):
+            warc_paths.append(path)
+        else:
+            raise ValueError(f"No WARC file or directory at '{path}'")
+    return sorted(warc_paths)
+
+
+class MmapRangeReader(io.RawIOBase):
+    '''
+    Read only file object over a byte range of a memory mapped file, reading slices of the mapping without copying the range
+    '''
+
+    def __init__(self, buffer, start=0, end=None):
+        self._view = memoryview(buffer)[start:end]
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, min(offset, len(self._view)))
+        return self._pos
+
+    def readinto(self, buffer):
+        num_bytes = min(len(buffer), len(self._view) - self._pos)
+        buffer[:num_bytes] = self._view[self._pos:self._pos + num_bytes]
+        self._pos += num_bytes
+        return num_bytes
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return data
+
+    def close(self):
+        # the mapping can only be closed once no views of it remain
+        self._view.release()
+        super().close()
+
+
+def gzip_member_offsets(buffer):
+    '''
+    Find where each gzip member of a buffer starts, by decompressing it once and discarding the output
+
+    WARC files are compressed a record per member, so every member start is a record boundary.
+    '''
+    view = memoryview(buffer)
+    offsets = []
+    pos = 0
+    try:
+        while pos < len(view):
+            offsets.append(pos)
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            chunk_pos = pos
+            # start small, as input past the end of the member is copied, and members are often single small records
+            chunk_size = _MIN_CHUNK_SIZE
+            while not decompressor.eof:
+                chunk = view[chunk_pos:chunk_pos + chunk_size]
+                chunk_size = min(chunk_size * 2, _CHUNK_SIZE)
+                if len(chunk) == 0:
+                    raise ValueError(f"Truncated gzip member at offset {pos}")
+                decompressor.decompress(chunk, _CHUNK_SIZE)
+                # drain output without holding it all in memory
+                while decompressor.unconsumed_tail and not decompressor.eof:
+                    decompressor.decompress(decompressor.unconsumed_tail, _CHUNK_SIZE)
+                chunk_pos += len(chunk)
+            pos = chunk_pos - len(decompressor.unused_data)
+    finally:
+        view.release()
+    return offsets
+
+def warc_record_offsets(buffer):
+    '''
+    Find where each record of an uncompressed WARC buffer starts, from the Content-Length of each record header
+    '''
+    offsets = []
+    pos = 0
+    while pos < len(buffer):
+        offsets.append(pos)
+        header_end = buffer.find(b'\r\n\r\n', pos)
+        if header_end < 0:
+            break
+        match = _CONTENT_LENGTH_REGEX.search(buffer[pos:header_end + 2])
+        if match is None:
+            raise ValueError(f"WARC record at offset {pos} has no Content-Length")
+        # records are followed by two newlines
+        pos = header_end + 4 + int(match.group(1)) + 4
+        # tolerate stray newlines between records
+        while buffer[pos:pos + 2] == b'\r\n':
+            pos += 2
+    return offsets
+
+def split_warc_file(path, split_size):
+    '''
+    Split a WARC file into byte ranges of about `split_size` bytes starting at record boundaries,
+    so a large file can be processed by several tasks
+
+    :return: List of tuples of path, start and end offsets
+    '''
+    size = os.path.getsize(path)
+    if size <= split_size:
+        return [(path, 0, size)]
+
+    with open(path, 'rb') as warc_file, mmap.mmap(warc_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if buffer[:2] == b'\x1f\x8b':
+            offsets = gzip_member_offsets(buffer)
+        else:
+            offsets = warc_record_offsets(buffer)
+
+    ranges = []
+    start = 0
+    for offset in offsets[1:]:
+        if offset - start >= split_size:
+            ranges.append((path, start, offset))
+            start = offset
+    ranges.append((path, start, size))
+    return ranges
+
+def iterate_range(path, start, end, process):
+    '''
+    Memory map a WARC file and call `process` with a reader over a byte range of it, yielding what it yields
+    '''
+    with open(path, 'rb') as warc_file:
+        if os.fstat(warc_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(warc_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            reader = MmapRangeReader(buffer, start, end)
+            try:
+                yield from process(reader)
+            finally:
+                reader.close()
@@ -1,25 +1,142 @@
+import re
 from urllib.parse import urlparse
 
 from flashgeotext.geotext import GeoText
 import langdetect
+import langdetect.detector_factory
+import pandas as pd
+import pyspark.sql.functions as sfuncs
+
+from seldonite.filters import duplicates
+from seldonite.filters.keywords import KeywordMatcher
+
+# language profiles and gazetteer, loaded once per python worker
+_language_detector_factory = None
+_geotext = None
 
 def contains_keywords(article, keywords):
-    if any(keyword in article.title for keyword in keywords):
-        return True
-    elif any(keyword in article.text for keyword in keywords):
-        return True
-    else:
-        return False
+    '''
+    :param keywords: List of keywords matched case sensitively anywhere in the text,
+                     or a `KeywordMatcher` with its own options to avoid rebuilding it for every article
+    '''
+    if not isinstance(keywords, KeywordMatcher):
+        keywords = KeywordMatcher(keywords, case_sensitive=True, whole_words=False)
+
+    return keywords.matches(article.title) or keywords.matches(article.text)
 
 def check_url_from_sites(url, sites):
     domain = urlparse(url).hostname
     return any(f".{site}" in domain or f"/{site}" in domain for site in sites)
 
+def _like_to_regex(like_pattern):
+    '''
+    Translate a SQL LIKE pattern into the body of an equivalent regular expression
+    '''
+    regex = []
+    chars = iter(like_pattern)
+    for char in chars:
+        if char == '\\':
+            # LIKE only allows the escape character before a wildcard or itself
+            escaped = next(chars, None)
+            if escaped not in ('%', '_', '\\'):
+                raise ValueError(f"Invalid escape sequence in LIKE pattern: {like_pattern}")
+            regex.append(re.escape(escaped))
+        elif char == '%':
+            if not regex or regex[-1] != '.*':
+                regex.append('.*')
+        elif char == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(char))
+    return ''.join(regex)
+
+def url_blacklist_regex(url_wildcards):
+    '''
+    Combine URL wildcards, where '*' matches any sequence of characters, into a single anchored regular expression
+    that matches exactly the URLs the equivalent chain of LIKE clauses would match.
+    The expression is compatible with both Python's re module and Spark's RLIKE.
+    '''
+    if not url_wildcards:
+        return None
+
+    like_patterns = (url_wildcard.replace('*', '%') for url_wildcard in url_wildcards)
+    alternatives = sorted(set(_like_to_regex(like_pattern) for like_pattern in like_patterns))
+    # '(?!.)' rather than '$' as '$' also matches before a trailing newline in both Python and Java
+    return f"(?s)^(?:{'|'.join(alternatives)})(?!.)"
+
+def compile_url_blacklist(url_wildcards):
+    regex = url_blacklist_regex(url_wildcards)
+    return re.compile(regex) if regex else None
+
+def check_url_blacklisted(url, blacklist):
+    '''
+    :param blacklist: Compiled pattern from `compile_url_blacklist`
+    '''
+    return blacklist is not None and blacklist.match(url) is not None
+
+def _get_geotext():
+    global _geotext
+    if _geotext is None:
+        _geotext = GeoText()
+    return _geotext
+
+def extract_countries(text):
+    '''
+    :return: Dict of countries mentioned in the text, each with its `count` of mentions and their (start, end) `span_info`
+    '''
+    if not isinstance(text, str) or not text:
+        return {}
+
+    places = _get_geotext().extract(input_text=text)
+    return places['countries']
+
 def get_countries(text):
-    geotext = GeoText()
-    places = geotext.extract(input_text=text)
-        
-    return list(places['countries'].keys())
+    return list(extract_countries(text).keys())
+
+def extract_countries_batch(texts, counts=False, positions=False):
+    '''
+    Extract the countries mentioned in each of a batch of texts
+
+    :param texts: Pandas series of texts
+    :param counts: Add a `country_counts` column, mapping each country to its number of mentions
+    :param positions: Add a `country_spans` column, mapping each country to the [start, end) character spans of its mentions
+    :return: Pandas dataframe with a `countries` column, and any requested count and position columns
+    '''
+    columns = ['countries']
+    if counts:
+        columns.append('country_counts')
+    if positions:
+        columns.append('country_spans')
+
+    rows = []
+    for text in texts:
+        countries = extract_countries(text)
+        row = {'countries': list(countries.keys())}
+        if counts:
+            row['country_counts'] = {country: info['count'] for country, info in countries.items()}
+        if positions:
+            row['country_spans'] = {country: [list(span) for span in info['span_info']] for country, info in countries.items()}
+        rows.append(row)
+
+    return pd.DataFrame(rows, columns=columns)
+
+def country_extractor_udf(counts=False, positions=False):
+    '''
+    Vectorized UDF extracting the countries mentioned in a text column in Arrow batches
+
+    Returns a struct column with the fields of `extract_countries_batch`
+    '''
+    fields = ['countries array<string>']
+    if counts:
+        fields.append('country_counts map<string, int>')
+    if positions:
+        fields.append('country_spans map<string, array<array<int>>>')
+
+    @sfuncs.pandas_udf(', '.join(fields))
+    def extract_texts_countries(texts: pd.Series) -> pd.DataFrame:
+        return extract_countries_batch(texts, counts=counts, positions=positions)
+
+    return extract_texts_countries
 
 def get_language(text):
     try:
@@ -27,3 +144,47 @@ def get_language(text):
     except Exception as err:
         raise Exception(f"Recieved exception: {err}, for input: {text}")
 
+def _get_language_detector_factory():
+    global _language_detector_factory
+    if _language_detector_factory is None:
+        factory = langdetect.detector_factory.DetectorFactory()
+        factory.load_profile(langdetect.detector_factory.PROFILES_DIRECTORY)
+        # fix the seed so detection is deterministic
+        factory.set_seed(0)
+        _language_detector_factory = factory
+    return _language_detector_factory
+
+def detect_language(text, max_chars=None):
+    '''
+    Detect the language of text without raising on bad input
+
+    :param max_chars: Only use this many characters from the start of the text
+    :return: Tuple of ISO 639-1 language code and its probability, or (None, None) if no language could be detected
+    '''
+    if not isinstance(text, str) or not text:
+        return None, None
+
+    if max_chars:
+        text = text[:max_chars]
+
+    try:
+        detector = _get_language_detector_factory().create()
+        detector.append(text)
+        language = detector.get_probabilities()[0]
+    except Exception:
+        return None, None
+
+    return language.lang, language.prob
+
+def language_detector_udf(max_chars=None):
+    '''
+    Vectorized UDF detecting the language of a text column in Arrow batches
+
+    Returns a struct column with fields `language` and `language_confidence`, both null where detection failed
+    '''
+    @sfuncs.pandas_udf('language string, language_confidence double')
+    def detect_languages(texts: pd.Series) -> pd.DataFrame:
+        languages = [detect_language(text, max_chars=max_chars) for text in texts]
+        return pd.DataFrame(languages, columns=['language', 'language_confidence'])
+
+    return detect_languages
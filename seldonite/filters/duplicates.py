@@ -0,0 +1,147 @@
+import hashlib
+import re
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyspark.sql as psql
+import pyspark.sql.functions as sfuncs
+
+_WORD_REGEX = re.compile(r'\w+')
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# multipliers combining the word hashes of a shingle, so word order matters
+_SHINGLE_PRIMES = np.array([1, 1000003, 2147483647, 4294967291, 6700417, 998244353, 1000000007, 16777619], dtype=np.uint64)
+
+
+class MinHasher:
+    '''
+    MinHash signatures of the word shingles of texts, whose agreement estimates the Jaccard similarity of the shingle sets
+    '''
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=0):
+        if not 1 <= shingle_size <= len(_SHINGLE_PRIMES):
+            raise ValueError(f"Shingle size must be between 1 and {len(_SHINGLE_PRIMES)}")
+
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, text):
+        '''
+        :return: Numpy array of 32 bit hashes of each run of `shingle_size` words, or of all words in shorter texts
+        '''
+        if not isinstance(text, str):
+            return np.array([], dtype=np.uint64)
+
+        word_hashes = np.array([zlib.crc32(word.encode('utf-8')) for word in _WORD_REGEX.findall(text.lower())], dtype=np.uint64)
+        shingle_size = min(self.shingle_size, len(word_hashes))
+        if shingle_size == 0:
+            return word_hashes
+
+        num_shingles = len(word_hashes) - shingle_size + 1
+        shingles = np.zeros(num_shingles, dtype=np.uint64)
+        for idx in range(shingle_size):
+            shingles += word_hashes[idx:idx + num_shingles] * _SHINGLE_PRIMES[idx]
+        return np.unique((shingles >> np.uint64(16)) & _MAX_HASH)
+
+    def signature(self, text):
+        '''
+        :return: Numpy array of `num_perm` minimum hashes, empty for texts without words
+        '''
+        shingles = self.shingles(text)
+        if len(shingles) == 0:
+            return np.array([], dtype=np.int64)
+
+        # universal hashing, where multiplication is allowed to overflow as in datasketch
+        with np.errstate(over='ignore'):
+            hashes = ((np.outer(self._a, shingles) + self._b[:, None]) % _MERSENNE_PRIME) & _MAX_HASH
+        return hashes.min(axis=1).astype(np.int64)
+
+
+# numpy 2 renamed trapz
+_trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+def _false_probabilities(threshold, bands, rows):
+    # probability of two texts with jaccard similarity s sharing a band is 1 - (1 - s^r)^b
+    similarities = np.linspace(0, 1, 201)
+    candidate = 1 - (1 - similarities ** rows) ** bands
+    below = similarities <= threshold
+    false_positive = _trapezoid(candidate[below], similarities[below])
+    false_negative = _trapezoid(1 - candidate[~below], similarities[~below])
+    return false_positive, false_negative
+
+def lsh_params(threshold, num_perm=128):
+    '''
+    Choose the number of bands and rows per band so that texts of about `threshold` similarity become candidates,
+    minimising the chance of both false candidates and missed duplicates
+
+    :return: Tuple of bands and rows per band
+    '''
+    if not 0 < threshold < 1:
+        raise ValueError('Similarity threshold must be between 0 and 1')
+
+    best_error, best_params = None, None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            error = sum(_false_probabilities(threshold, bands, rows))
+            if best_error is None or error < best_error:
+                best_error, best_params = error, (bands, rows)
+    return best_params
+
+def band_hashes(signature, bands, rows):
+    '''
+    :return: List of a 64 bit hash of each band of the signature, distinct between bands
+    '''
+    if len(signature) == 0:
+        return []
+
+    signature = np.asarray(signature, dtype=np.int64)
+    return [int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8, salt=band.to_bytes(16, 'little')).digest(), 'little', signed=True)
+            for band in range(bands)]
+
+def drop_near_duplicates(df, text_col='all_text', threshold=0.8, num_perm=128, shingle_size=5, order_cols=['publish_date', 'url'], seed=0):
+    '''
+    Keep one representative of each group of articles whose texts are near duplicates, such as syndicated wire stories
+
+    Articles sharing any LSH band of their MinHash signatures are candidates, and a candidate is dropped if its
+    estimated similarity to the first article in the band, by `order_cols` with nulls last, reaches the threshold.
+    Each band is only compared to its first article, so work grows with the number of articles rather than candidate pairs.
+    Articles are identified by a hash of their columns, so rows identical in every column are not told apart.
+    The dataframe is read twice, so should be persisted if expensive to compute.
+
+    :param threshold: Estimated Jaccard similarity of word shingles above which articles are duplicates
+    :return: Dataframe without the near duplicate articles. Articles without text are kept.
+    '''
+    bands, rows = lsh_params(threshold, num_perm=num_perm)
+    hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size, seed=seed)
+
+    @sfuncs.pandas_udf('array<long>')
+    def minhash(texts: pd.Series) -> pd.Series:
+        return pd.Series([hasher.signature(text) for text in texts])
+
+    @sfuncs.pandas_udf('array<long>')
+    def lsh_bands(signatures: pd.Series) -> pd.Series:
+        return pd.Series([band_hashes(signature, bands, rows) for signature in signatures])
+
+    # ids from content rather than position, as row order may change each time the dataframe is read
+    hashable_cols = [field.name for field in df.schema.fields if not isinstance(field.dataType, psql.types.MapType)]
+    df = df.withColumn('_article_id', sfuncs.xxhash64(*hashable_cols))
+    signature_df = df.select('_article_id', *order_cols, minhash(sfuncs.col(text_col)).alias('_signature'))
+
+    # structs compare nulls first, so flag them to keep dated articles ahead of undated ones
+    order_fields = [field for col in order_cols for field in (sfuncs.col(col).isNull(), sfuncs.col(col))]
+    order_struct = sfuncs.struct(*order_fields, sfuncs.col('_article_id'), sfuncs.col('_signature'))
+    band_df = signature_df.select('_article_id', '_signature', order_struct.alias('_order'), sfuncs.explode(lsh_bands(sfuncs.col('_signature'))).alias('_band'))
+    first_df = band_df.groupby('_band').agg(sfuncs.min('_order').alias('_first'))
+
+    matching = sfuncs.expr(f"size(filter(zip_with(_signature, _first._signature, (x, y) -> x = y), same -> same)) >= {threshold * num_perm}")
+    duplicate_df = band_df.join(first_df, '_band') \
+                          .where(sfuncs.col('_first._article_id') != sfuncs.col('_article_id')) \
+                          .where(matching) \
+                          .select('_article_id') \
+                          .distinct()
+
+    return df.join(duplicate_df, '_article_id', 'left_anti').drop('_article_id')
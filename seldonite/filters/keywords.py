@@ -0,0 +1,128 @@
+import collections
+import re
+
+import pandas as pd
+import pyspark.sql.functions as sfuncs
+
+_WORD_REGEX = re.compile(r'\w+')
+
+
+def stem(word):
+    '''
+    Cheap stemmer that only strips plural suffixes, after Harman's S-stemmer
+    '''
+    if word.endswith('ies') and not word.endswith(('eies', 'aies')):
+        return word[:-3] + 'y'
+    if word.endswith('es') and not word.endswith(('aes', 'ees', 'oes')):
+        return word[:-1]
+    if word.endswith('s') and not word.endswith(('us', 'ss')):
+        return word[:-1]
+    return word
+
+
+class KeywordMatcher:
+    '''
+    Finds all occurrences of a set of keywords in a single pass over a text, using an Aho-Corasick automaton
+
+    With `whole_words`, texts and keywords are split into words and keywords only match whole word sequences,
+    so 'tax cut' matches 'Tax cuts are coming' (with `stem`) but not 'syntax cutoff'.
+    Otherwise keywords match anywhere as substrings.
+    '''
+
+    def __init__(self, keywords, case_sensitive=False, whole_words=True, stem=False):
+        if stem and not whole_words:
+            raise ValueError('Stemming keywords requires matching whole words')
+
+        self.keywords = list(dict.fromkeys(keywords))
+        self.case_sensitive = case_sensitive
+        self.whole_words = whole_words
+        self.stem = stem
+
+        # automaton state: transitions, failure link, and indices of keywords ending at that state
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for idx, keyword in enumerate(self.keywords):
+            self._add(self._symbols(keyword), idx)
+        self._build_failure_links()
+
+    def _symbols(self, text):
+        if not self.case_sensitive:
+            text = text.lower()
+
+        if not self.whole_words:
+            return text
+
+        words = _WORD_REGEX.findall(text)
+        if self.stem:
+            words = [stem(word) for word in words]
+        return words
+
+    def _add(self, symbols, idx):
+        if not symbols:
+            raise ValueError(f"Keyword '{self.keywords[idx]}' has nothing to match")
+
+        state = 0
+        for symbol in symbols:
+            if symbol not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][symbol] = len(self._goto) - 1
+            state = self._goto[state][symbol]
+        self._out[state].append(idx)
+
+    def _build_failure_links(self):
+        # breadth first, so failure links always point to shallower, already linked states
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for symbol, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail_state = self._fail[state]
+                while fail_state and symbol not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                self._fail[next_state] = self._goto[fail_state].get(symbol, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def _iter_matches(self, text):
+        if not isinstance(text, str):
+            return
+
+        state = 0
+        for symbol in self._symbols(text):
+            while state and symbol not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(symbol, 0)
+            for idx in self._out[state]:
+                yield idx
+
+    def matches(self, text):
+        '''
+        :return: True if any keyword occurs in the text
+        '''
+        return any(True for _ in self._iter_matches(text))
+
+    def count(self, text):
+        '''
+        :return: Dict mapping each keyword that occurs in the text to its number of occurrences
+        '''
+        counts = {}
+        for idx in self._iter_matches(text):
+            keyword = self.keywords[idx]
+            counts[keyword] = counts.get(keyword, 0) + 1
+        return counts
+
+
+def keyword_counter_udf(matcher):
+    '''
+    Vectorized UDF counting the keywords of a `KeywordMatcher` in a text column in Arrow batches
+
+    Returns a map column of keyword counts, empty where no keyword occurs
+    '''
+    @sfuncs.pandas_udf('map<string, int>')
+    def count_keywords(texts: pd.Series) -> pd.Series:
+        return pd.Series([matcher.count(text) for text in texts])
+
+    return count_keywords
@@ -1,14 +1,19 @@
 import collections
 import doctest
 import os
+import re
+from typing import Iterator
+import weakref
+import zlib
 
+import tensorflow as tf
 from tensorflow.keras.models import load_model
 from tensorflow.keras.preprocessing.text import tokenizer_from_json
 from tensorflow.keras.preprocessing import sequence
 import numpy as np
 import pandas as pd
+from pyspark import SparkFiles
 import pyspark.sql as psql
-from bigdl.orca.learn.tf2.estimator import Estimator
 
 from seldonite.helpers import utils
 
@@ -26,6 +31,21 @@ _NONPOLITICAL_ARTICLE = '''Table tennis world cup 2025 takes place in South Kore
                         '''to the advantage of underdog Bob Bobby who has been playing outstanding matches ''' \
                         '''in the National Table Tennis League this year.'''
 
+BATCH_SIZE = 64
+PADDING_SIZE = 1500
+TOKEN_DTYPE = '<i4'
+# batches are padded to a multiple of this short of the padding size, rather than always to the padding size
+BUCKET_SIZE = 128
+QUANTIZED_MODEL_NAME = 'model_int8.tflite'
+
+_WORD_REGEX = re.compile(r'\w+')
+
+# models, keyed by quantization, and tokenizers, loaded once per python worker
+_models = {}
+_tokenizers = {}
+# lengths each model can be padded to without changing its predictions
+_buckets = weakref.WeakKeyDictionary()
+
 def ensure_zip_exists():
     # TODO cannot currently download straight from drive
     this_dir_path = os.path.dirname(os.path.abspath(__file__))
@@ -42,70 +62,482 @@ def unzip_model():
         utils.unzip(zip_path, model_dir_path)
     return model_path
 
-def preprocess(texts, tokenizer_path=os.path.join('.', 'pon_classifier')):
+def _get_tokenizer(tokenizer_path=None):
     '''
-    :param df:
+    Load the tokenizer once per python worker, from the archive shipped to executors if available
     '''
-    PADDING_SIZE = 1500
-    with open(os.path.join(tokenizer_path, 'tokenizer.json'), 'r') as tokenizer_file:
+    if tokenizer_path is None:
+        tokenizer_path = os.path.join('.', 'pon_classifier')
+        if not os.path.exists(os.path.join(tokenizer_path, 'tokenizer.json')):
+            tokenizer_path = os.path.dirname(unzip_model())
+
+    if tokenizer_path not in _tokenizers:
+        with open(os.path.join(tokenizer_path, 'tokenizer.json'), 'r') as tokenizer_file:
             json = tokenizer_file.read()
 
-    tokenizer = tokenizer_from_json(json)
+        _tokenizers[tokenizer_path] = tokenizer_from_json(json)
+    return _tokenizers[tokenizer_path]
+
+def tokenize(texts, tokenizer_path=None):
+    '''
+    :return: List of unpadded int32 token arrays, truncated to the tokens the model sees
+    '''
+    tokenizer = _get_tokenizer(tokenizer_path)
     # TODO check what words are missing from tokenizer
     # for now we will assume vocab is good
-    tokens = tokenizer.texts_to_sequences(texts)
-    return sequence.pad_sequences(tokens, maxlen=PADDING_SIZE)
-
-def preprocess_text_partition(iter, **kwargs):
-    rows = []
-    texts = []
-    for row in iter:
-        rows.append(row)
-        texts.append(row['all_text'])
-    mapped_col = (array.tolist() for array in preprocess(texts, **kwargs))
-    for row, mapped_item in zip(rows, mapped_col):
-        yield psql.Row(url=row['url'], title=row['title'], text=row['text'], publish_date=row['publish_date'], all_text=row['all_text'], tokens=mapped_item)
-
-def preprocess_text(session, df):
-    tokens_rdd = df.rdd.mapPartitions(preprocess_text_partition)
-    
-    schema = psql.types.StructType([
-        psql.types.StructField("url", psql.types.StringType(), True),
-        psql.types.StructField("title", psql.types.StringType(), True),
-        psql.types.StructField("text", psql.types.StringType(), True),
-        psql.types.StructField("publish_date", psql.types.StringType(), True),
-        psql.types.StructField("all_text", psql.types.StringType(), True),
-        psql.types.StructField("tokens", psql.types.ArrayType(psql.types.IntegerType()), True)
-    ])
-    return session.createDataFrame(tokens_rdd, schema)
-
-def spark_predict(df, feature_col, pred_col):
-    '''
-
-    '''
-    BATCH_SIZE = 64
-
-    def model_creator(config):
-        model_path = os.path.join('.', 'pon_classifier')
-        model_path = os.path.join(model_path, 'model.h5')
-        if not os.path.exists(model_path):
-            model_path = unzip_model()
-
-        return load_model(model_path)
-
-    # TODO switch to tf2 backend
-    est = Estimator.from_keras(model_creator=model_creator, backend='spark', model_dir='./')
-    df = est.predict(df, feature_cols=[feature_col], batch_size=BATCH_SIZE)
-
-    # extract single prediction value from prediction vector
-    def _ith(v, i):
-        try:
-            return float(v[i])
-        except ValueError:
-            return None
-
-    ith = psql.functions.udf(_ith, psql.types.DoubleType())
-    return df.withColumn(pred_col, ith('prediction', psql.functions.lit(1))).drop('prediction')
+    sequences = tokenizer.texts_to_sequences(texts)
+    # padding truncates from the start, so only the last tokens are ever used
+    return [np.asarray(tokens[-PADDING_SIZE:], dtype=np.int32) for tokens in sequences]
+
+def encode_tokens(tokens):
+    return np.asarray(tokens, dtype=TOKEN_DTYPE).tobytes()
+
+def decode_tokens(tokens_bytes):
+    return np.frombuffer(tokens_bytes, dtype=TOKEN_DTYPE)
+
+def pad_tokens(tokens, padding_size=PADDING_SIZE):
+    '''
+    :param tokens: Sequence of token arrays
+    :return: 2D numpy array of the token arrays, zero padded at the start to the padding size
+    '''
+    return sequence.pad_sequences(tokens, maxlen=padding_size)
+
+def preprocess(texts, tokenizer_path=None):
+    return pad_tokens(tokenize(texts, tokenizer_path=tokenizer_path))
+
+def preprocess_text(df, text_col='all_text', tokens_col='tokens', tokenizer_path=None):
+    '''
+    Add a column of each text's unpadded tokens, encoded as little endian int32 bytes.
+    Padding is left to inference, so each row stores only its own tokens.
+    '''
+    @psql.functions.pandas_udf(psql.types.BinaryType())
+    def tokenize_texts(texts: pd.Series) -> pd.Series:
+        return pd.Series([encode_tokens(tokens) for tokens in tokenize(texts.fillna(''), tokenizer_path=tokenizer_path)])
+
+    return df.withColumn(tokens_col, tokenize_texts(psql.functions.col(text_col)))
+
+def _model_path():
+    model_path = os.path.join('.', 'pon_classifier', 'model.h5')
+    if not os.path.exists(model_path):
+        model_path = unzip_model()
+    return model_path
+
+def _with_variable_length(config):
+    if isinstance(config, dict):
+        config = {key: _with_variable_length(value) for key, value in config.items()}
+        for shape_key in ('batch_input_shape', 'batch_shape'):
+            if shape_key in config and config[shape_key] is not None and len(config[shape_key]) == 2:
+                config[shape_key] = [None, None]
+        if 'input_length' in config:
+            config['input_length'] = None
+        return config
+    if isinstance(config, list):
+        return [_with_variable_length(value) for value in config]
+    return config
+
+def variable_length_model(model):
+    '''
+    Rebuild a keras model to accept token sequences of any length, so batches can be padded less, see `exact_bucket_lengths`
+
+    :return: The rebuilt model, or None if the model's layers need a fixed input length
+    '''
+    if model.input_shape[1] is None:
+        return model
+
+    try:
+        variable_model = model.__class__.from_config(_with_variable_length(model.get_config()))
+        variable_model.set_weights(model.get_weights())
+        variable_model.predict_on_batch(np.zeros((1, BUCKET_SIZE), dtype=np.int32))
+    except Exception:
+        return None
+    return variable_model
+
+def export_quantized_model(model_path=None, output_path=None):
+    '''
+    Export a TensorFlow Lite copy of the classifier with int8 quantized weights, for faster inference on CPU
+
+    :param model_path: Path of the keras model, defaults to the packaged classifier
+    :param output_path: Path to write the quantized model to, defaults to alongside the keras model
+    :return: Path of the quantized model
+    '''
+    if model_path is None:
+        model_path = _model_path()
+    if output_path is None:
+        output_path = os.path.join(os.path.dirname(model_path), QUANTIZED_MODEL_NAME)
+
+    model = load_model(model_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(variable_length_model(model) or model)
+    # dynamic range quantization: int8 weights, activations quantized on the fly
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    # moved into place whole, so processes exporting at once never load a partly written model
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as model_file:
+        model_file.write(converter.convert())
+    os.replace(temp_path, output_path)
+    return output_path
+
+def _quantized_model_path(model_path):
+    quantized_path = os.path.join(os.path.dirname(model_path), QUANTIZED_MODEL_NAME)
+    if not os.path.exists(quantized_path):
+        export_quantized_model(model_path, quantized_path)
+    return quantized_path
+
+def _ship_quantized_model(model_path=None):
+    '''
+    Export the quantized model on the driver if missing and send it to executors, so their workers don't each export it
+
+    :return: Name of the model file for `SparkFiles.get`
+    '''
+    quantized_path = _quantized_model_path(model_path or _model_path())
+    psql.SparkSession.getActiveSession().sparkContext.addFile(quantized_path)
+    return os.path.basename(quantized_path)
+
+class QuantizedModel:
+    '''
+    TensorFlow Lite classifier from `export_quantized_model`, with the `predict_on_batch` method of a keras model
+    '''
+
+    def __init__(self, model_path):
+        self._interpreter = tf.lite.Interpreter(model_path=model_path)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._input_shape = None
+        self.input_shape = tuple(None if dim < 0 else dim for dim in self._input['shape_signature'])
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=self._input['dtype'])
+        if x.shape != self._input_shape:
+            self._interpreter.resize_tensor_input(self._input['index'], x.shape)
+            self._interpreter.allocate_tensors()
+            self._input_shape = x.shape
+
+        self._interpreter.set_tensor(self._input['index'], x)
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._output['index'])
+
+def load_classifier(model_path, quantized=False):
+    '''
+    :param model_path: Path of the keras model, or of a quantized model from `export_quantized_model`
+    :param quantized: Use the int8 quantized model alongside the keras model, exporting it first if missing
+    :return: Model with a `predict_on_batch` method, accepting any sequence length where the architecture allows
+    '''
+    if model_path.endswith('.tflite'):
+        return QuantizedModel(model_path)
+    if quantized:
+        return QuantizedModel(_quantized_model_path(model_path))
+
+    model = load_model(model_path)
+    return variable_length_model(model) or model
+
+def _get_model(quantized=False, model_path=None):
+    '''
+    Load the classifier once per python worker, from the archive shipped to executors if available
+
+    :param model_path: Path of a keras model to use instead of the packaged classifier
+    '''
+    if (quantized, model_path) not in _models:
+        _models[(quantized, model_path)] = load_classifier(model_path or _model_path(), quantized=quantized)
+    return _models[(quantized, model_path)]
+
+def exact_bucket_lengths(model, padding_size=PADDING_SIZE, bucket_size=BUCKET_SIZE, tolerance=1e-4, num_probes=4, seed=0):
+    '''
+    Find the lengths shorter than the padding size that articles can be padded to without changing the model's predictions
+
+    Padding tokens still pass through the embedding and layer biases, and strided layers see articles at offsets set by
+    the padded length, so padding less only gives the same predictions for some architectures, lengths and margins of padding.
+    Candidate lengths are a whole number of buckets short of the padding size, and each is checked on random articles
+    a little shorter than it against the same articles padded to the padding size.
+
+    :return: Sorted list of tuples of padded length and the longest article predicted exactly at it, ending with the padding size
+    '''
+    buckets = []
+    if model.input_shape[1] is None:
+        rng = np.random.default_rng(seed)
+        for length in range(padding_size % bucket_size or bucket_size, padding_size, bucket_size):
+            article_lengths = sorted({max(1, length - margin) for margin in (bucket_size - 1, 96, 64, 32, 16, 8, 4, 2, 1, 0)} | {1})
+            # token ids below any real vocabulary size
+            tokens = [rng.integers(1, 100, size=article_length, dtype=np.int32) for article_length in article_lengths for _ in range(num_probes)]
+            matches = np.isclose(model.predict_on_batch(pad_tokens(tokens, padding_size=length)),
+                                 model.predict_on_batch(pad_tokens(tokens, padding_size=padding_size)), atol=tolerance).all(axis=1)
+            matches = matches.reshape(len(article_lengths), num_probes).all(axis=1)
+
+            # longest article such that it and all shorter probes are predicted exactly
+            max_length = 0
+            for article_length, match in zip(article_lengths, matches):
+                if not match:
+                    break
+                max_length = article_length
+            if max_length:
+                buckets.append((length, max_length))
+
+    buckets.append((padding_size, padding_size))
+    return buckets
+
+def _get_buckets(model, padding_size):
+    if model not in _buckets:
+        _buckets[model] = {}
+    if padding_size not in _buckets[model]:
+        _buckets[model][padding_size] = exact_bucket_lengths(model, padding_size=padding_size)
+    return _buckets[model][padding_size]
+
+def _bucket_length(length, buckets):
+    # the shortest padded length that predicts an article this long exactly
+    return next(padded_length for padded_length, max_length in buckets if length <= max_length)
+
+def predict_bucketed(model, tokens, batch_size=BATCH_SIZE, padding_size=PADDING_SIZE):
+    '''
+    Predict on batches of articles of similar length, padding each batch only as far as gives the same predictions
+    as padding to `padding_size`, see `exact_bucket_lengths`
+
+    :param model: Model with a `predict_on_batch` method
+    :param tokens: Sequence of unpadded token arrays
+    :return: 2D numpy array of class probabilities, in the order of `tokens`
+    '''
+    buckets = _get_buckets(model, padding_size)
+    lengths = np.array([min(len(article_tokens), padding_size) for article_tokens in tokens], dtype=np.int64)
+    order = np.argsort(lengths, kind='stable')
+
+    predictions = np.zeros((len(tokens), 2), dtype=np.float64)
+    for start in range(0, len(order), batch_size):
+        batch_idx = order[start:start + batch_size]
+        length = _bucket_length(lengths[batch_idx[-1]], buckets)
+        padded_tokens = pad_tokens([tokens[idx] for idx in batch_idx], padding_size=length)
+        predictions[batch_idx] = model.predict_on_batch(padded_tokens)
+    return predictions
+
+def predict_tokens(tokens, batch_size=BATCH_SIZE, quantized=False, model_path=None):
+    '''
+    :param tokens: Pandas series of encoded token arrays, from `preprocess_text`
+    :return: Numpy array of the probability that each article is political
+    '''
+    decoded_tokens = [decode_tokens(tokens_bytes) for tokens_bytes in tokens]
+    return predict_bucketed(_get_model(quantized=quantized, model_path=model_path), decoded_tokens, batch_size=batch_size)[:, 1]
+
+def spark_predict(df, feature_col, pred_col, batch_size=BATCH_SIZE, quantized=False, model_path=None):
+    '''
+    Score each partition's Arrow batches in place with a model loaded once per python worker
+
+    :param model_path: Path of a keras model readable by executors, defaults to the packaged classifier
+    '''
+    quantized_file = _ship_quantized_model(model_path) if quantized else None
+
+    @psql.functions.pandas_udf(psql.types.DoubleType())
+    def predict(tokens_batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+        worker_model_path = SparkFiles.get(quantized_file) if quantized_file else model_path
+        for tokens in tokens_batches:
+            yield pd.Series(predict_tokens(tokens, batch_size=batch_size, quantized=quantized, model_path=worker_model_path))
+
+    return df.withColumn(pred_col, predict(psql.functions.col(feature_col)))
+
+class HashedLinearClassifier:
+    '''
+    Hashed bag-of-words logistic regression, cheap enough to score every article before the CNN
+
+    Once calibrated against the CNN, articles scoring above `upper` are accepted and below `lower` are rejected
+    outright, and only those in the uncertain band in between need the CNN.
+    '''
+
+    def __init__(self, n_features=2**18, weights=None, bias=0.0, lower=None, upper=None, threshold=None):
+        self.n_features = n_features
+        self.weights = np.zeros(n_features, dtype=np.float32) if weights is None else np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.lower = lower
+        self.upper = upper
+        self.threshold = threshold
+        self.report = None
+        self._feature_index = {}
+
+    def __getstate__(self):
+        # the hashed word cache is rebuilt on each executor rather than shipped with the model
+        state = self.__dict__.copy()
+        state['_feature_index'] = {}
+        return state
+
+    def _hash(self, word):
+        idx = self._feature_index.get(word)
+        if idx is None:
+            # crc32 rather than hash(), which is salted differently in each python process
+            idx = zlib.crc32(word.encode('utf-8')) % self.n_features
+            self._feature_index[word] = idx
+        return idx
+
+    def _article_features(self, text):
+        if not isinstance(text, str):
+            text = ''
+        counts = collections.Counter(self._hash(word) for word in _WORD_REGEX.findall(text.lower()))
+        cols = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        vals = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        norm = np.linalg.norm(vals)
+        return cols, vals / norm if norm > 0 else vals
+
+    @staticmethod
+    def _stack(features):
+        rows = np.repeat(np.arange(len(features)), [len(cols) for cols, _ in features])
+        cols = np.concatenate([cols for cols, _ in features]) if features else np.array([], dtype=np.int64)
+        vals = np.concatenate([vals for _, vals in features]) if features else np.array([], dtype=np.float32)
+        return rows, cols, vals
+
+    def _scores(self, features):
+        rows, cols, vals = self._stack(features)
+        return np.bincount(rows, weights=self.weights[cols] * vals, minlength=len(features)) + self.bias
+
+    def predict(self, texts):
+        '''
+        :return: Numpy array of the probability that each article is political
+        '''
+        return _sigmoid(self._scores([self._article_features(text) for text in texts]))
+
+    def fit(self, texts, targets, epochs=5, batch_size=256, learning_rate=0.5, l2=1e-6, seed=0):
+        '''
+        Train with minibatch Adagrad on the log loss
+
+        :param targets: Labels or CNN probabilities in [0, 1], to train on or distill from respectively
+        '''
+        features = [self._article_features(text) for text in texts]
+        targets = np.asarray(targets, dtype=np.float64)
+        weight_grads = np.full(self.n_features, 1e-8, dtype=np.float32)
+        bias_grads = 1e-8
+
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(features))
+            for start in range(0, len(order), batch_size):
+                batch_idx = order[start:start + batch_size]
+                rows, cols, vals = self._stack([features[idx] for idx in batch_idx])
+                scores = np.bincount(rows, weights=self.weights[cols] * vals, minlength=len(batch_idx)) + self.bias
+                errors = _sigmoid(scores) - targets[batch_idx]
+
+                weight_grad = np.bincount(cols, weights=errors[rows] * vals, minlength=self.n_features) / len(batch_idx)
+                weight_grad += l2 * self.weights
+                weight_grads += weight_grad ** 2
+                self.weights -= (learning_rate * weight_grad / np.sqrt(weight_grads)).astype(np.float32)
+
+                bias_grad = errors.mean()
+                bias_grads += bias_grad ** 2
+                self.bias -= learning_rate * bias_grad / np.sqrt(bias_grads)
+        return self
+
+    def calibrate(self, predictions, cnn_predictions, threshold=0.5, tolerance=0.01):
+        '''
+        Choose the widest accept and reject regions that each disagree with the CNN on at most
+        `tolerance` of the articles the CNN finds political
+
+        :param predictions: Probabilities from this model on held out articles
+        :param cnn_predictions: CNN probabilities on the same articles
+        :return: Report of the cascade against the CNN alone on these articles, from `evaluate`
+        '''
+        predictions = np.asarray(predictions)
+        cnn_positive = np.asarray(cnn_predictions) > threshold
+        allowed_errors = tolerance * max(cnn_positive.sum(), 1)
+
+        # reject below the first prediction at which too many political articles would be lost
+        order = np.argsort(predictions)
+        lost = np.searchsorted(np.cumsum(cnn_positive[order]), allowed_errors, side='right')
+        self.lower = float(predictions[order[lost]]) if lost < len(order) else np.inf
+
+        # accept above the first prediction, from the top, at which too many articles would be wrongly accepted
+        order = order[::-1]
+        wrong = np.searchsorted(np.cumsum(~cnn_positive[order]), allowed_errors, side='right')
+        self.upper = float(predictions[order[wrong]]) if wrong < len(order) else -np.inf
+
+        self.threshold = threshold
+        self.report = self.evaluate(predictions, cnn_predictions)
+        return self.report
+
+    def decide(self, predictions):
+        '''
+        :return: Boolean numpy arrays of the articles accepted, and of those left for the CNN
+        '''
+        if self.threshold is None:
+            raise ValueError('Classifier must be calibrated against the CNN before use in a cascade')
+
+        predictions = np.asarray(predictions)
+        accepted = predictions > self.upper
+        uncertain = ~accepted & (predictions >= self.lower)
+        return accepted, uncertain
+
+    def evaluate(self, predictions, cnn_predictions):
+        '''
+        :return: Dict of the precision and recall of the cascade, taking the CNN's decisions as truth,
+            and the fraction of articles the CNN would still score
+        '''
+        cnn_positive = np.asarray(cnn_predictions) > self.threshold
+        accepted, uncertain = self.decide(predictions)
+        cascade_positive = accepted | (uncertain & cnn_positive)
+
+        true_positives = (cascade_positive & cnn_positive).sum()
+        return {
+            'precision': float(true_positives / max(cascade_positive.sum(), 1)),
+            'recall': float(true_positives / max(cnn_positive.sum(), 1)),
+            'cnn_fraction': float(uncertain.mean()) if len(uncertain) else 0.0,
+            'articles': int(len(cnn_positive))
+        }
+
+    def save(self, path):
+        with open(path, 'wb') as model_file:
+            np.savez_compressed(model_file, weights=self.weights, bias=self.bias, lower=np.nan if self.lower is None else self.lower,
+                                upper=np.nan if self.upper is None else self.upper, threshold=np.nan if self.threshold is None else self.threshold)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as params:
+            optional = {name: None if np.isnan(params[name]) else float(params[name]) for name in ['lower', 'upper', 'threshold']}
+            return cls(n_features=len(params['weights']), weights=params['weights'], bias=float(params['bias']), **optional)
+
+def _sigmoid(scores):
+    return 1 / (1 + np.exp(-np.clip(scores, -30, 30)))
+
+def train_first_stage(texts, targets=None, threshold=0.5, tolerance=0.01, holdout=0.2, quantized=False, seed=0, **fit_kwargs):
+    '''
+    Train a cheap first stage for the political filter, and calibrate its confident regions against the CNN
+
+    :param texts: Sample of articles, such as from the feeds the filter will run on
+    :param targets: Political labels for the texts. If None, the first stage is distilled from the CNN's predictions
+    :param tolerance: Fraction of the CNN's political articles each confident region may decide differently
+    :param holdout: Fraction of the texts held out to calibrate and evaluate the cascade
+    :return: Calibrated `HashedLinearClassifier`, with the cascade's precision, recall and CNN fraction in its `report`
+    '''
+    texts = pd.Series(list(texts)).fillna('')
+    rng = np.random.default_rng(seed)
+    is_holdout = rng.random(len(texts)) < holdout
+    if targets is None:
+        cnn_predictions = predict_bucketed(_get_model(quantized=quantized), tokenize(texts))[:, 1]
+        targets = cnn_predictions
+    else:
+        cnn_predictions = np.full(len(texts), np.nan)
+        cnn_predictions[is_holdout] = predict_bucketed(_get_model(quantized=quantized), tokenize(texts[is_holdout]))[:, 1]
+
+    first_stage = HashedLinearClassifier()
+    first_stage.fit(texts[~is_holdout], np.asarray(targets)[~is_holdout], seed=seed, **fit_kwargs)
+    first_stage.calibrate(first_stage.predict(texts[is_holdout]), cnn_predictions[is_holdout], threshold=threshold, tolerance=tolerance)
+    return first_stage
+
+def spark_cascade_predict(df, text_col, pred_col, first_stage, batch_size=BATCH_SIZE, quantized=False, tokenizer_path=None):
+    '''
+    Score texts with a calibrated first stage, only tokenizing and running the CNN on articles it is unsure of
+
+    Predictions are above the first stage's threshold exactly where the cascade accepts an article.
+    Articles with no tokens that are left to the CNN are scored 0
+    '''
+    quantized_file = _ship_quantized_model() if quantized else None
+
+    @psql.functions.pandas_udf(psql.types.DoubleType())
+    def predict(texts_batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+        model_path = SparkFiles.get(quantized_file) if quantized_file else None
+        for texts in texts_batches:
+            texts = texts.fillna('')
+            predictions = first_stage.predict(texts)
+            accepted, uncertain = first_stage.decide(predictions)
+            # confident predictions are kept, but clipped to the side of the threshold the first stage decided
+            predictions = np.where(accepted, np.maximum(predictions, np.nextafter(first_stage.threshold, np.inf)),
+                                   np.minimum(predictions, first_stage.threshold))
+            if uncertain.any():
+                tokens = tokenize(texts[uncertain], tokenizer_path=tokenizer_path)
+                cnn_predictions = predict_bucketed(_get_model(quantized=quantized, model_path=model_path), tokens, batch_size=batch_size)[:, 1]
+                predictions[uncertain] = np.where([len(article_tokens) > 0 for article_tokens in tokens], cnn_predictions, 0.0)
+            yield pd.Series(predictions)
+
+    return df.withColumn(pred_col, predict(psql.functions.col(text_col)))
 
 def filter(news_articles, threshold=0.5):
     """
@@ -137,9 +569,11 @@ class Classifier:
     under the Apache 2.0 license <http://www.apache.org/licenses/LICENSE-2.0>.
     """
 
-    def __init__(self):
+    def __init__(self, quantized=False, batch_size=BATCH_SIZE):
         self._tokenizer = None
         self._model = None
+        self._quantized = quantized
+        self._batch_size = batch_size
         self._load()
 
     def _load(self):
@@ -147,11 +581,12 @@ class Classifier:
             json = tokenizer_file.read()
 
         self._tokenizer = tokenizer_from_json(json)
-        self._model = load_model('./pon_classifier/model.h5')
+        self._model = load_classifier('./pon_classifier/model.h5', quantized=self._quantized)
 
-    @staticmethod
-    def _as_array(tokens):
-        return np.array(tokens.values.tolist())
+    def _estimate_chunk(self, news_articles):
+        tokens = [np.asarray(article_tokens[-PADDING_SIZE:], dtype=np.int32)
+                  for article_tokens in self._tokenizer.texts_to_sequences(news_articles)]
+        return predict_bucketed(self._model, tokens, batch_size=self._batch_size)[:, 1]
 
     def estimate(self, news_articles):
         """
@@ -170,34 +605,45 @@ class Classifier:
         True
         >>> estimations[1] < 0.01
         True
+        >>> quantized_classifier = Classifier(quantized=True)
+        >>> quantized_estimations = quantized_classifier.estimate([_POLITICAL_ARTICLE, _NONPOLITICAL_ARTICLE])
+        >>> quantized_estimations[0] > 0.99
+        True
+        >>> quantized_estimations[1] < 0.01
+        True
         """
 
-        to_estimate = EstimationSet(data=news_articles, tokenizer=self._tokenizer).get_data()
-        tokens = to_estimate[EstimationSet.COL_TOKENS]
-        estimations = self._model.predict(Classifier._as_array(tokens), batch_size=256)
-
-        return [float(p) for p in list(estimations[:, 1])]
+        return [float(p) for p in self._estimate_chunk(list(news_articles))]
 
+    def estimate_stream(self, news_articles, chunk_size=4096):
+        """
+        Lazily estimate if each news article in an iterable covers policy topics.
 
-class EstimationSet:
-    COL_TOKENS = 'TOKENS'
-    _COL_TEXT = 'TEXT'
+        Articles are read in chunks, and each chunk is batched by length so little padding is computed.
 
-    def __init__(self, data, tokenizer):
-        self._data = pd.DataFrame({EstimationSet._COL_TEXT: data})
-        self._tokenizer = tokenizer
-        self._preprocess()
+        # Arguments
+            news_articles: An iterable of news articles, such as a generator over a file.
+            chunk_size: Number of articles to hold in memory at once. Larger chunks give tighter length buckets.
 
-    def get_data(self):
-        return self._data
+        # Returns
+            A generator of the estimated probabilities, in the order of `news_articles`.
 
-    def _preprocess(self):
-        self._data[EstimationSet.COL_TOKENS] = self._tokenizer.texts_to_sequences(self._data[EstimationSet._COL_TEXT])
-        self._data[EstimationSet.COL_TOKENS] = EstimationSet._pad_tokens(self._data[EstimationSet.COL_TOKENS], 1500)
+        >>> classifier = Classifier()
+        >>> estimations = list(classifier.estimate_stream(iter([_POLITICAL_ARTICLE, _NONPOLITICAL_ARTICLE]), chunk_size=1))
+        >>> estimations[0] > 0.99
+        True
+        >>> estimations[1] < 0.01
+        True
+        """
 
-    @staticmethod
-    def _pad_tokens(tokens, padding_size):
-        return pd.Series(list(sequence.pad_sequences(tokens, maxlen=padding_size)), index=tokens.index)
+        chunk = []
+        for news_article in news_articles:
+            chunk.append(news_article)
+            if len(chunk) == chunk_size:
+                yield from (float(p) for p in self._estimate_chunk(chunk))
+                chunk = []
+        if chunk:
+            yield from (float(p) for p in self._estimate_chunk(chunk))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (compatible; seldonite)'
+
+
+class ResponseCache:
+    '''
+    On-disk cache of response bodies with their validators, so pages can be fetched again with conditional requests
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def get(self, url):
+        '''
+        :return: Dict of the cached `body`, `etag` and `last_modified` of a URL, or None
+        '''
+        try:
+            with open(self._path(url), 'r', encoding='utf-8') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, body, etag=None, last_modified=None):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({'body': body, 'etag': etag, 'last_modified': last_modified}, cache_file)
+        os.replace(tmp_path, path)
+
+
+class HostLimiter:
+    '''
+    Bounds the number of concurrent requests to each host, and the time between the starts of requests to a host
+    '''
+
+    def __init__(self, max_per_host=2, min_interval=0.0):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._semaphores = {}
+        self._locks = {}
+        self._last_start = {}
+
+    async def acquire(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.max_per_host)
+            self._locks[host] = asyncio.Lock()
+
+        await self._semaphores[host].acquire()
+        if self.min_interval:
+            async with self._locks[host]:
+                wait = self._last_start.get(host, 0) + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._last_start[host] = time.monotonic()
+
+    def release(self, host):
+        self._semaphores[host].release()
+
+
+class AsyncFetcher:
+    '''
+    Fetches many URLs concurrently from an asyncio loop, over a pooled HTTP session, while bounding the load on each host
+
+    With a cache directory, responses are cached with their validators and fetched again with conditional requests,
+    so pages that have not changed are served from the cache.
+    '''
+
+    def __init__(self, max_connections=32, max_per_host=2, min_host_interval=0.0, cache_dir=None, timeout=30, max_retries=2, headers=None):
+        '''
+        :param max_connections: Number of requests in flight at once across all hosts
+        :param max_per_host: Number of requests in flight at once to each host
+        :param min_host_interval: Seconds between the starts of requests to each host
+        :param cache_dir: Directory to cache responses in, defaults to no cache
+        '''
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.min_host_interval = min_host_interval
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.headers = {'User-Agent': DEFAULT_USER_AGENT, **(headers or {})}
+
+    def _session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_connections, pool_maxsize=self.max_connections)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self.headers)
+        return session
+
+    def _get(self, session, url, cached):
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = session.get(url, headers=headers, timeout=self.timeout)
+                # retry throttling and server errors, give up on other errors
+                if response.status_code != 429 and response.status_code < 500:
+                    return response
+            except requests.RequestException as err:
+                if attempt == self.max_retries:
+                    logging.warning(f"Couldn't fetch URL {url}: {err}")
+                    return None
+            if attempt < self.max_retries:
+                time.sleep(2 ** attempt)
+        return response
+
+    async def _fetch(self, loop, executor, session, limiter, url):
+        host = urllib.parse.urlparse(url).netloc
+        cached = self.cache.get(url) if self.cache else None
+
+        await limiter.acquire(host)
+        try:
+            response = await loop.run_in_executor(executor, self._get, session, url, cached)
+        finally:
+            limiter.release(host)
+
+        if response is None:
+            return None
+        if response.status_code == 304 and cached:
+            return cached['body']
+        if response.status_code != 200:
+            logging.warning(f"Couldn't fetch URL {url}: status {response.status_code}")
+            return None
+
+        body = response.text
+        if self.cache:
+            self.cache.put(url, body, etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+        return body
+
+    async def _fetch_all(self, urls):
+        loop = asyncio.get_running_loop()
+        limiter = HostLimiter(max_per_host=self.max_per_host, min_interval=self.min_host_interval)
+        session = self._session()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            try:
+                return await asyncio.gather(*[self._fetch(loop, executor, session, limiter, url) for url in urls])
+            finally:
+                session.close()
+
+    def fetch_all(self, urls):
+        '''
+        :return: List of the body of each URL, or None where it could not be fetched, in the order of the URLs
+        '''
+        urls = list(urls)
+        if not urls:
+            return []
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._fetch_all(urls))
+
+        # already inside an event loop, such as in a notebook
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self._fetch_all(urls)).result()
@@ -0,0 +1,167 @@
+import datetime
+import logging
+import time
+
+import pyspark.sql as psql
+
+# errors after which retrying a write may succeed, such as a failover
+_RETRYABLE_CODES = {6, 7, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+
+def _to_document(row):
+    document = row.asDict(recursive=True)
+    for field, value in document.items():
+        if isinstance(value, datetime.datetime):
+            # spark gives naive datetimes in the local time of the executor, while pymongo takes naive datetimes as UTC
+            document[field] = value.astimezone(datetime.timezone.utc)
+        elif isinstance(value, datetime.date):
+            # BSON has no plain dates
+            document[field] = datetime.datetime.combine(value, datetime.time(), tzinfo=datetime.timezone.utc)
+    return document
+
+def _create_key_index(collection, key):
+    '''
+    Create a unique index on the key, or a plain one if the collection already holds duplicate keys
+    '''
+    from pymongo.errors import OperationFailure
+
+    try:
+        collection.create_index(key, unique=True)
+    except OperationFailure as err:
+        if err.code != 11000:
+            raise
+        # such as from runs that appended articles before they were upserted
+        logging.warning(f"Collection '{collection.name}' has documents with the same {key}, so they can't be made unique, "
+                        f"and partitions upserting the same new {key} at once may both insert it. "
+                        f"Remove the duplicates to have a unique index created: {err}")
+        collection.create_index(key)
+
+def bulk_upsert(collection, documents, key='url', max_retries=3, backoff=1.0):
+    '''
+    Replace or insert each document by its key with an unordered bulk write, retrying the writes that failed transiently
+
+    Writes are idempotent, so a retried or repeated write leaves the same documents as a single one.
+    Writes the write concern did not acknowledge are retried, then counted as failed.
+    Duplicate key errors are not retried, as they fail again.
+
+    :return: Dict of the number of documents inserted, updated and failed, and the keys of the failed documents
+    '''
+    from pymongo import ReplaceOne
+    from pymongo.errors import BulkWriteError, ConnectionFailure
+
+    counts = {'inserted': 0, 'updated': 0, 'failed': 0, 'failed_keys': []}
+    pending = []
+    for document in documents:
+        if document.get(key) is None:
+            counts['failed'] += 1
+        else:
+            pending.append(document)
+
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        requests = [ReplaceOne({key: document[key]}, document, upsert=True) for document in pending]
+        try:
+            result = collection.bulk_write(requests, ordered=False)
+            counts['inserted'] += result.upserted_count
+            counts['updated'] += result.matched_count
+            pending = []
+        except BulkWriteError as err:
+            details = err.details
+            retry = []
+            for write_error in details.get('writeErrors', []):
+                document = pending[write_error['index']]
+                if write_error.get('code') in _RETRYABLE_CODES:
+                    retry.append(document)
+                else:
+                    logging.warning(f"Failed to write document with {key} '{document[key]}': {write_error.get('errmsg')}")
+                    counts['failed'] += 1
+                    counts['failed_keys'].append(document[key])
+
+            if details.get('writeConcernErrors'):
+                # writes were applied but not acknowledged as the write concern asks, so are rewritten rather than counted
+                logging.warning(f"Retrying writes not acknowledged by the write concern: {details['writeConcernErrors'][0].get('errmsg')}")
+                error_idxs = {write_error['index'] for write_error in details.get('writeErrors', [])}
+                retry.extend(document for idx, document in enumerate(pending) if idx not in error_idxs)
+            else:
+                counts['inserted'] += details.get('nUpserted', 0)
+                counts['updated'] += details.get('nMatched', 0)
+            pending = retry
+        except ConnectionFailure as err:
+            # unknown which writes were applied, but rewriting them is harmless
+            logging.warning(f"Retrying {len(pending)} writes after connection failure: {err}")
+
+    counts['failed'] += len(pending)
+    counts['failed_keys'].extend(document[key] for document in pending)
+    return counts
+
+def upsert_partitions(df, connection_string, database, collection, key='url', bulk_size=1000, write_concern=None, max_retries=3):
+    '''
+    Write each partition of a dataframe straight to MongoDB with unordered bulk upserts keyed on `key`
+
+    Documents are replaced whole, so re-running a collection updates articles rather than duplicating them.
+    A unique index on the key is created if missing, so that each upsert is a lookup rather than a collection scan,
+    and partitions upserting the same key at once can't both insert it. If the collection already holds duplicate keys,
+    a plain index is created instead with a warning.
+
+    :param bulk_size: Number of documents per bulk write
+    :param write_concern: Dict of write concern options, such as `{'w': 'majority', 'j': True}`. Defaults to the server's
+    :param max_retries: Number of times to retry writes that failed transiently in each bulk write
+    :return: Dict of the number of documents inserted, updated and failed, and the keys of the failed documents
+    '''
+    import pymongo
+
+    client = pymongo.MongoClient(connection_string)
+    try:
+        _create_key_index(client[database][collection], key)
+    finally:
+        client.close()
+
+    def write_partition(rows):
+        import pymongo
+        from pymongo.write_concern import WriteConcern
+
+        client = pymongo.MongoClient(connection_string)
+        mongo_collection = client[database][collection]
+        if write_concern:
+            mongo_collection = mongo_collection.with_options(write_concern=WriteConcern(**write_concern))
+
+        counts = {'inserted': 0, 'updated': 0, 'failed': 0, 'failed_keys': []}
+        try:
+            documents = []
+            for row in rows:
+                documents.append(_to_document(row))
+                if len(documents) >= bulk_size:
+                    batch_counts = bulk_upsert(mongo_collection, documents, key=key, max_retries=max_retries)
+                    for name in counts:
+                        counts[name] += batch_counts[name]
+                    documents = []
+
+            if documents:
+                batch_counts = bulk_upsert(mongo_collection, documents, key=key, max_retries=max_retries)
+                for name in counts:
+                    counts[name] += batch_counts[name]
+        finally:
+            client.close()
+
+        yield counts
+
+    summary = {'inserted': 0, 'updated': 0, 'failed': 0, 'failed_keys': []}
+    for counts in df.rdd.mapPartitions(write_partition).collect():
+        for name in summary:
+            summary[name] += counts[name]
+    return summary
+
+def written_rows(spark_manager, df, summary, key='url'):
+    '''
+    :return: Rows of `df` not among the failed writes of a summary from `upsert_partitions`
+    '''
+    if not summary['failed_keys']:
+        return df.where(psql.functions.col(key).isNotNull())
+
+    spark = spark_manager.get_spark_session()
+    failed_df = spark.createDataFrame([(failed_key,) for failed_key in summary['failed_keys']], [key])
+    return df.where(psql.functions.col(key).isNotNull()).join(failed_df, key, 'left_anti')
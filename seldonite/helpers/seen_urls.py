@@ -0,0 +1,256 @@
+import hashlib
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import pyspark.sql as psql
+from pyspark.sql.utils import AnalysisException
+
+from seldonite.helpers import utils
+
+FINGERPRINT_COL = '_url_fingerprint'
+
+
+def surtkey_fingerprint(surtkey):
+    '''
+    :return: Signed 64 bit fingerprint of a SURT key
+    '''
+    return int.from_bytes(hashlib.blake2b(surtkey.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+def url_fingerprint(url):
+    '''
+    :return: Signed 64 bit fingerprint of a URL, by its SURT key so trivially different forms of a URL match
+    '''
+    return surtkey_fingerprint(utils._url_to_surtkey(url) or url)
+
+def add_fingerprint(df, url_col='url', surtkey_col=None, fingerprint_col=FINGERPRINT_COL):
+    '''
+    Add the fingerprint of each URL, from its SURT key column if it has one, such as in the CommonCrawl index
+    '''
+    fingerprint = surtkey_fingerprint if surtkey_col else url_fingerprint
+
+    @psql.functions.pandas_udf(psql.types.LongType())
+    def fingerprint_urls(urls: pd.Series) -> pd.Series:
+        return pd.Series([fingerprint(url) for url in urls], dtype='int64')
+
+    return df.withColumn(fingerprint_col, fingerprint_urls(psql.functions.col(surtkey_col or url_col)))
+
+
+class SeenUrls:
+    '''
+    Base class for a persisted set of URLs already collected, so repeated runs only fetch new articles
+    '''
+
+    def exclude(self, spark_manager, df, url_col='url', surtkey_col=None):
+        '''
+        :return: Dataframe without the rows whose URLs have been seen
+        '''
+        raise NotImplementedError()
+
+    def add(self, spark_manager, df, url_col='url'):
+        '''
+        Record the URLs of a dataframe as seen
+        '''
+        raise NotImplementedError()
+
+    def url_checker(self, spark_manager):
+        '''
+        :return: Function checking on executors whether a single URL has been seen, or None if the set can only be joined against
+        '''
+        return None
+
+
+class ParquetSeenUrls(SeenUrls):
+    '''
+    Exact set of URL fingerprints in a Parquet dataset, looked up with an anti-join against the articles
+
+    Each `add` appends a sorted run of new fingerprints, and once there are more than `max_files` files they are
+    merged into one sorted file per core, so lookups don't slow down with the number of runs
+    '''
+
+    def __init__(self, path, max_files=64):
+        '''
+        :param max_files: Number of files above which they are merged after adding URLs
+        '''
+        self.path = path
+        self.max_files = max_files
+
+    def _load(self, spark_manager):
+        spark = spark_manager.get_spark_session()
+        try:
+            return spark.read.parquet(self.path)
+        except AnalysisException:
+            # nothing seen yet
+            return None
+
+    def exclude(self, spark_manager, df, url_col='url', surtkey_col=None):
+        seen_df = self._load(spark_manager)
+        if seen_df is None:
+            return df
+
+        df = add_fingerprint(df, url_col=url_col, surtkey_col=surtkey_col)
+        seen_df = seen_df.withColumnRenamed('fingerprint', FINGERPRINT_COL)
+        return df.join(seen_df, FINGERPRINT_COL, 'left_anti').drop(FINGERPRINT_COL)
+
+    def add(self, spark_manager, df, url_col='url'):
+        fingerprint_df = add_fingerprint(df.select(url_col), url_col=url_col) \
+            .select(psql.functions.col(FINGERPRINT_COL).alias('fingerprint')) \
+            .distinct()
+
+        seen_df = self._load(spark_manager)
+        if seen_df is not None:
+            fingerprint_df = fingerprint_df.join(seen_df, 'fingerprint', 'left_anti')
+
+        fingerprint_df.orderBy('fingerprint').write.mode('append').parquet(self.path)
+        self.compact(spark_manager)
+
+    def compact(self, spark_manager):
+        '''
+        Merge the files of the set if there are more than `max_files`
+
+        :return: Whether the files were merged
+        '''
+        spark = spark_manager.get_spark_session()
+        spark_context = spark_manager.get_spark_context()
+        hadoop_fs = spark_context._jvm.org.apache.hadoop.fs
+        seen_path = hadoop_fs.Path(self.path)
+        fs = seen_path.getFileSystem(spark_context._jsc.hadoopConfiguration())
+        # hidden from reads of the set by its leading underscore
+        staging_path = hadoop_fs.Path(seen_path, '_staging')
+
+        file_paths = [status.getPath() for status in fs.listStatus(seen_path) if status.getPath().getName().endswith('.parquet')]
+        if len(file_paths) <= self.max_files:
+            return False
+
+        spark.read.parquet(*[path.toString() for path in file_paths]) \
+             .distinct() \
+             .repartitionByRange(spark_manager.get_num_cpus(), 'fingerprint') \
+             .sortWithinPartitions('fingerprint') \
+             .write \
+             .mode('overwrite') \
+             .parquet(staging_path.toString())
+
+        # fingerprints seen twice are still only seen, so the merged files are moved in before the files they replace
+        # are deleted, and a failure part way through only leaves duplicates for the next compaction to merge
+        for status in fs.listStatus(staging_path):
+            if status.getPath().getName().endswith('.parquet'):
+                if not fs.rename(status.getPath(), hadoop_fs.Path(seen_path, status.getPath().getName())):
+                    raise OSError(f"Failed to move merged file {status.getPath().toString()} into {self.path}")
+        for path in file_paths:
+            if not fs.delete(path, False):
+                raise OSError(f"Failed to delete merged file {path.toString()}")
+        fs.delete(staging_path, True)
+        return True
+
+
+class BloomSeenUrls(SeenUrls):
+    '''
+    Scalable Bloom filter of URL fingerprints, for histories too large to keep exactly
+
+    Seen URLs are always excluded, and unseen URLs are wrongly excluded with probability at most `error_rate`.
+    Each time the filter fills, a filter of twice the capacity and half the error rate is added, bounding the total
+    error rate however many URLs are added. The filter is kept in a numpy file on the driver and broadcast to executors.
+    '''
+
+    def __init__(self, path, capacity=10000000, error_rate=0.001):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filters = None
+
+    def _get_filters(self):
+        if self._filters is None:
+            self._filters = []
+            if os.path.exists(self.path):
+                with np.load(self.path) as saved:
+                    for idx, (num_hashes, count, capacity) in enumerate(saved['params']):
+                        self._filters.append({'bits': saved[f"bits_{idx}"], 'num_hashes': int(num_hashes), 'count': int(count), 'capacity': int(capacity)})
+        return self._filters
+
+    def _new_filter(self):
+        level = len(self._get_filters())
+        capacity = self.capacity * 2 ** level
+        # error rates halve with each filter so their sum stays under the overall error rate
+        error_rate = self.error_rate / 2 ** (level + 1)
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        bloom_filter = {'bits': np.zeros(math.ceil(num_bits / 8), dtype=np.uint8), 'num_hashes': num_hashes, 'count': 0, 'capacity': capacity}
+        self._filters.append(bloom_filter)
+        return bloom_filter
+
+    def save(self):
+        filters = self._get_filters()
+        params = np.array([[bloom_filter['num_hashes'], bloom_filter['count'], bloom_filter['capacity']] for bloom_filter in filters], dtype=np.int64).reshape(-1, 3)
+        bits = {f"bits_{idx}": bloom_filter['bits'] for idx, bloom_filter in enumerate(filters)}
+        with open(self.path, 'wb') as filter_file:
+            np.savez(filter_file, params=params, **bits)
+
+    @staticmethod
+    def _positions(bloom_filter, fingerprints):
+        # double hashing from the two halves of each fingerprint
+        fingerprints = np.asarray(fingerprints, dtype=np.int64).view(np.uint64)
+        first = fingerprints & np.uint64(0xFFFFFFFF)
+        second = (fingerprints >> np.uint64(32)) | np.uint64(1)
+        hash_idx = np.arange(bloom_filter['num_hashes'], dtype=np.uint64)
+        num_bits = np.uint64(len(bloom_filter['bits']) * 8)
+        return (first[:, None] + hash_idx[None, :] * second[:, None]) % num_bits
+
+    @staticmethod
+    def _filter_contains(bloom_filter, fingerprints):
+        positions = BloomSeenUrls._positions(bloom_filter, fingerprints)
+        bits = (bloom_filter['bits'][positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def contains(self, fingerprints):
+        '''
+        :return: Boolean numpy array of whether each fingerprint may have been seen
+        '''
+        fingerprints = np.asarray(fingerprints, dtype=np.int64)
+        seen = np.zeros(len(fingerprints), dtype=bool)
+        for bloom_filter in self._get_filters():
+            seen |= self._filter_contains(bloom_filter, fingerprints)
+        return seen
+
+    def add_fingerprints(self, fingerprints):
+        fingerprints = np.unique(np.asarray(fingerprints, dtype=np.int64))
+        fingerprints = fingerprints[~self.contains(fingerprints)]
+
+        filters = self._get_filters()
+        while len(fingerprints) > 0:
+            bloom_filter = filters[-1] if filters and filters[-1]['count'] < filters[-1]['capacity'] else self._new_filter()
+            to_add = fingerprints[:bloom_filter['capacity'] - bloom_filter['count']]
+            positions = self._positions(bloom_filter, to_add).ravel()
+            np.bitwise_or.at(bloom_filter['bits'], positions >> np.uint64(3), (1 << (positions & np.uint64(7))).astype(np.uint8))
+            bloom_filter['count'] += len(to_add)
+            fingerprints = fingerprints[len(to_add):]
+
+    def url_checker(self, spark_manager):
+        filters = spark_manager.get_spark_context().broadcast(self._get_filters())
+
+        def is_seen(url):
+            seen_urls = BloomSeenUrls(None)
+            seen_urls._filters = filters.value
+            return bool(seen_urls.contains([url_fingerprint(url)])[0])
+
+        return is_seen
+
+    def exclude(self, spark_manager, df, url_col='url', surtkey_col=None):
+        if not self._get_filters():
+            return df
+
+        filters = spark_manager.get_spark_context().broadcast(self._get_filters())
+        fingerprint = surtkey_fingerprint if surtkey_col else url_fingerprint
+
+        @psql.functions.pandas_udf(psql.types.BooleanType())
+        def is_seen(urls: pd.Series) -> pd.Series:
+            seen_urls = BloomSeenUrls(None)
+            seen_urls._filters = filters.value
+            return pd.Series(seen_urls.contains([fingerprint(url) for url in urls]))
+
+        return df.where(~is_seen(psql.functions.col(surtkey_col or url_col)))
+
+    def add(self, spark_manager, df, url_col='url'):
+        fingerprint_df = add_fingerprint(df.select(url_col), url_col=url_col).select(FINGERPRINT_COL).distinct()
+        self.add_fingerprints(fingerprint_df.toPandas()[FINGERPRINT_COL].to_numpy())
+        self.save()
@@ -1,8 +1,10 @@
 import collections
 import datetime
 import gzip
+import os
 import re
 import subprocess
+import urllib.parse
 import zipfile
 
 import botocore
@@ -12,6 +14,8 @@ import pyspark.sql as psql
 import requests
 import pyspark.ml as sparkml
 import sparknlp
+import surt
+import tldextract
 
 
 
@@ -134,16 +138,87 @@ def construct_db_uri(connection_string, database, collection):
 
     return f"{url_path}/{database}.{collection}{query_string}"
 
-def get_countries(text):
-    geotext = GeoText()
-    places = geotext.extract(input_text=text)
-        
-    return list(places['countries'].keys())
+def load_urls(spark_manager, urls):
+    '''
+    Load URLs to look up into a DataFrame with a single `url` column
+
+    :param urls: List of URLs, a DataFrame with a `url` column, or a path to URLs stored as
+                 Parquet (.parquet), CSV with a `url` header (.csv), or text with one URL per line
+    '''
+    spark = spark_manager.get_spark_session()
+    if isinstance(urls, psql.DataFrame):
+        url_df = urls
+    elif isinstance(urls, str):
+        extension = os.path.splitext(urls.rstrip('/'))[1]
+        if extension == '.parquet':
+            url_df = spark.read.parquet(urls)
+        elif extension == '.csv':
+            url_df = spark.read.csv(urls, header=True)
+        else:
+            url_df = spark.read.text(urls).withColumnRenamed('value', 'url')
+    else:
+        url_df = spark.createDataFrame([(url,) for url in urls], ['url'])
 
+    return url_df.select('url').where(psql.functions.col('url').isNotNull())
+
+def _url_to_surtkey(url):
+    try:
+        return surt.surt(url)
+    except Exception:
+        return None
+
+def add_surtkey(df, url_col='url', surtkey_col='url_surtkey'):
+    '''
+    Add the SURT form of each URL, as used to sort and key the CommonCrawl index
+    '''
+    surtkey_udf = psql.functions.udf(_url_to_surtkey, psql.types.StringType())
+    return df.withColumn(surtkey_col, surtkey_udf(psql.functions.col(url_col)))
+
+# public suffix list bundled with tldextract, so executors never fetch it
+_domain_extractor = None
+
+def registered_domain(url):
+    '''
+    :return: Domain registered under the public suffix of a URL or host, e.g. 'bbc.co.uk' for 'https://news.bbc.co.uk/a',
+             or the host itself if it has no public suffix
+    '''
+    global _domain_extractor
+    if not isinstance(url, str) or not url:
+        return None
+    if _domain_extractor is None:
+        _domain_extractor = tldextract.TLDExtract(suffix_list_urls=())
+
+    host = urllib.parse.urlparse(url if '//' in url else f"//{url}").hostname
+    if not host:
+        return None
+    extracted = _domain_extractor(host)
+    if extracted.domain and extracted.suffix:
+        return f"{extracted.domain}.{extracted.suffix}"
+    return host
+
+def add_registered_domain(df, url_col='url', domain_col='domain'):
+    '''
+    Add the registered domain of each URL, as used to partition article stores
+    '''
+    domain_udf = psql.functions.udf(registered_domain, psql.types.StringType())
+    return df.withColumn(domain_col, domain_udf(psql.functions.col(url_col)))
+
+def lookup_urls(df, url_df, on='url', broadcast=False):
+    '''
+    Semi-join `df` against the URLs in `url_df`, keeping only rows with a matching key
+
+    Broadcasting ships the URLs to every executor and avoids shuffling `df`,
+    otherwise both sides are shuffled for a sort-merge join, which scales to any number of URLs
+    '''
+    url_df = url_df.select(on)
+    if broadcast:
+        url_df = psql.functions.broadcast(url_df)
+    return df.join(url_df, on, 'leftsemi')
 
 def tokenize(df):
 
-    df = df.withColumn('all_text', psql.functions.concat(df['title'], psql.functions.lit('. '), df['text']))
+    if 'all_text' not in df.columns:
+        df = df.withColumn('all_text', psql.functions.concat(df['title'], psql.functions.lit('. '), df['text']))
 
     try:
         eng_stopwords = nltk.corpus.stopwords.words('english')
@@ -2,6 +2,8 @@ import datetime
 
 from newspaper import Article, ArticleException
 
+from seldonite import filters
+
 def link_to_article(link):
     article = Article(link)
     article.download()
@@ -30,9 +32,35 @@ def dict_to_article(dict):
     article.publish_date = dict['publish_date']
     return article
 
+# types of article attributes that are not strings
+_ARTICLE_FEATURE_TYPES = {'publish_date': 'timestamp', 'authors': 'array<string>', 'keywords': 'array<string>', 'movies': 'array<string>'}
+
+def article_schema(features):
+    '''
+    :return: Spark DDL schema of rows of these article features
+    '''
+    return ', '.join(f"{feature} {_ARTICLE_FEATURE_TYPES.get(feature, 'string')}" for feature in features)
+
+def article_to_row(article, url, features):
+    '''
+    :return: Tuple of the features of a parsed article, matching `article_schema`
+    '''
+    values = []
+    for feature in features:
+        value = url if feature == 'url' else getattr(article, feature)
+        if feature == 'publish_date' and not isinstance(value, datetime.datetime):
+            value = None
+        elif feature in _ARTICLE_FEATURE_TYPES and feature != 'publish_date':
+            value = list(value) if value else []
+        values.append(value)
+    return tuple(values)
+
+def escape_sql_string(value):
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
 def construct_query(urls, sites, limit, crawls=None, lang='eng', url_black_list=[], start_date=None, end_date=None):
     #TODO automatically get most recent crawl
-    query = "SELECT url, url_path, warc_filename, warc_record_offset, warc_record_length, content_charset FROM ccindex WHERE subset = 'warc'"
+    query = "SELECT url, url_surtkey, url_path, warc_filename, warc_record_offset, warc_record_length, content_charset, crawl FROM ccindex WHERE subset = 'warc'"
 
     if crawls:
         # 
@@ -73,10 +101,9 @@ def construct_query(urls, sites, limit, crawls=None, lang='eng', url_black_list=
         query += f" AND NOT ({clause})"
 
     if url_black_list:
-        # replace wildcards with %
-        url_black_list = [url_wildcard.replace('*', '%') for url_wildcard in url_black_list]
-        clause = " OR ".join((f"url_path LIKE '{url_wildcard}'" for url_wildcard in url_black_list))
-        query += f" AND NOT ({clause})"
+        # single regex for all wildcards, so each url path is only scanned once
+        blacklist_regex = filters.url_blacklist_regex(url_black_list)
+        query += f" AND NOT (url_path RLIKE '{escape_sql_string(blacklist_regex)}')"
 
     # set limit to sites if needed
     if limit:
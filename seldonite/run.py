@@ -1,9 +1,12 @@
 from contextlib import contextmanager
+import logging
 from typing import Iterable
 
 import pyspark.sql as psql
 
 from seldonite import base
+from seldonite.helpers import mongo_sink
+from seldonite.sources import news
 from seldonite.spark import spark_tools
 
 class Runner():
@@ -21,10 +24,32 @@ class Runner():
         self.python_executable = python_executable
         self.keep_alive = keep_alive
         self._spark_manager = None
+        self._output_df = None
 
     def get_obj(self):
+        '''
+        Get the output of the input stage
+
+        A Spark dataframe output is cached and counted so the frames cached while filtering can be released,
+        call `release` when done with it. Other outputs may still read cached frames until `release` is called
+        '''
         with self.start_and_process() as obj:
+            if isinstance(obj, psql.DataFrame):
+                obj = obj.persist()
+                obj.count()
+                # the output may itself be the last frame cached while filtering
+                self.input._release(keep=[obj])
+                self._output_df = obj
             return obj
+
+    def release(self):
+        '''
+        Uncache the output of `get_obj` and any frames it still depends on
+        '''
+        if self._output_df is not None:
+            self._output_df.unpersist()
+            self._output_df = None
+        self.input._release()
         
     @contextmanager
     def start_and_process(self):
@@ -43,37 +68,66 @@ class Runner():
         '''
 
         with self.start_and_process() as res:
-            if isinstance(res, psql.DataFrame):
-                return res.toPandas()
-            elif isinstance(res, Iterable):
-                dfs = []
-                
-                for element in res:
-                    assert isinstance(element, psql.DataFrame)
-                    dfs.append(element.toPandas())
-
-                return dfs
-
-    def send_to_database(self, connection_string, database, table):
+            try:
+                if isinstance(res, psql.DataFrame):
+                    return res.toPandas()
+                elif isinstance(res, Iterable):
+                    dfs = []
+                    
+                    for element in res:
+                        assert isinstance(element, psql.DataFrame)
+                        dfs.append(element.toPandas())
+
+                    return dfs
+            finally:
+                self.input._release()
+
+    def send_to_database(self, connection_string, database, table, key='url', bulk_size=1000, write_concern=None, max_retries=3):
+        '''
+        Upsert articles into a MongoDB collection by `key`, straight from each partition, so re-runs update rather than duplicate them
+
+        :param bulk_size: Number of documents per bulk write
+        :param write_concern: Dict of write concern options, such as `{'w': 'majority'}`
+        :param max_retries: Number of times to retry writes that failed transiently
+        :return: Dict of the number of articles inserted, updated and failed, and the keys of the failed articles
+        '''
         spark_builder = self._get_spark_builder()
-        spark_builder.set_conf('spark.mongodb.output.uri', connection_string)
-        spark_builder.add_package('org.mongodb.spark:mongo-spark-connector_2.12:3.0.1')
-        spark_builder.set_conf('spark.mongodb.keep_alive_ms', 20000)
         with spark_builder.start_session() as spark_manager:
-            df = self.input._process(spark_manager)
+            # kept for recording the written URLs without filtering the articles again
+            df = self.input._process(spark_manager).persist()
 
-            for df_batch in spark_tools.batch(df, max_rows=1000000):
-                df_batch.write \
-                    .format("mongo") \
-                    .mode("append") \
-                    .option("database", database) \
-                    .option("collection", table) \
-                    .save()
+            summary = mongo_sink.upsert_partitions(df, connection_string, database, table, key=key, bulk_size=bulk_size,
+                                                   write_concern=write_concern, max_retries=max_retries)
+            logging.info(f"Articles inserted: {summary['inserted']}, updated: {summary['updated']}, failed: {summary['failed']}")
+
+            # failed articles are not recorded, so they are fetched again next run
+            self.input._record_written(spark_manager, mongo_sink.written_rows(spark_manager, df, summary, key=key))
+
+            df.unpersist()
+            self.input._release()
+
+        return summary
+
+    def send_to_parquet(self, path, mode='append'):
+        '''
+        Write articles to a `news.ParquetStore`, partitioned by publish year, month and domain
+
+        :param mode: 'append' to add to the store or 'overwrite' to replace it
+        '''
+        spark_builder = self._get_spark_builder()
+        with spark_builder.start_session() as spark_manager:
+            # kept for recording the written URLs without filtering the articles again
+            df = self.input._process(spark_manager).persist()
+            news.ParquetStore(path).write(df, mode=mode)
+            self.input._record_written(spark_manager, df)
+            df.unpersist()
+            self.input._release()
 
     def run(self):
         spark_builder = self._get_spark_builder()
         with spark_builder.start_session() as spark_manager:
             self.input._process(spark_manager)
+            self.input._release()
 
     def set_spark_manager(self, spark_manager):
         self._spark_manager = spark_manager
@@ -1,15 +1,23 @@
 import collections
 import datetime
+import hashlib
+import json
 import logging
+import math
+import re
+import urllib.parse
 
+from seldonite import filters
 from seldonite.commoncrawl.cc_index_fetch_news import CCIndexFetchNewsJob
 from seldonite.commoncrawl.fetch_news import FetchNewsJob
+from seldonite.commoncrawl.local_fetch_news import LocalWarcFetchNewsJob
 from seldonite.commoncrawl.sparkcc import CCIndexSparkJob
-from seldonite.helpers import utils, worker_utils
+from seldonite.helpers import http_fetch, utils, worker_utils
+from seldonite.helpers.seen_urls import FINGERPRINT_COL, add_fingerprint
 from seldonite.spark import spark_tools
 
-from googleapiclient.discovery import build as gbuild
 import pandas as pd
+from pyspark import InheritableThread
 import pyspark.sql as psql
 
 # TODO make abstract
@@ -26,6 +34,7 @@ class BaseSource:
         self.uses_callback = False
         self.can_keyword_filter = False
         self.keywords = None
+        self.keyword_options = {}
         # we need to filter for only news articles by default
         self.news_only = False
 
@@ -34,6 +43,8 @@ class BaseSource:
 
         self.sites = []
         self.urls = None
+        self.broadcast_urls = False
+        self.seen_urls = None
 
         self.features = ['title', 'text', 'url', 'publish_date']
 
@@ -42,6 +53,11 @@ class BaseSource:
         self.can_url_black_list = True
         self.url_black_list = []
 
+        self.can_export_warc = False
+        self.warc_export_dir = None
+        self.warc_export_file_mb = 1024
+        self.warc_export_index_mode = 'overwrite'
+
     def set_date_range(self, start_date, end_date):
         '''
         params:
@@ -63,21 +79,49 @@ class BaseSource:
         else:
             raise NotImplementedError('This source cannot blacklist paths, please try another source.')
 
-    def set_keywords(self, keywords):
+    def set_keywords(self, keywords, **keyword_options):
+        '''
+        :param keyword_options: Options for matching keywords in articles, see `filters.keywords.KeywordMatcher`
+        '''
         if self.can_keyword_filter:
             self.keywords = keywords
+            self.keyword_options = keyword_options
         else:
-            raise NotImplemented('This source cannot filter by keywords, please try another source.')
+            raise NotImplementedError('This source cannot filter by keywords, please try another source.')
 
     def set_sites(self, sites):
         self.sites = sites
 
-    def set_urls(self, urls):
+    def set_urls(self, urls, broadcast=False):
         self.urls = urls
+        self.broadcast_urls = broadcast
 
     def set_features(self, features):
         self.features = features
 
+    def set_seen_urls(self, seen_urls):
+        '''
+        :param seen_urls: `seen_urls.SeenUrls` of URLs to exclude before fetching articles
+        '''
+        self.seen_urls = seen_urls
+
+    def set_warc_export(self, export_dir, file_mb=1024, index_mode='overwrite'):
+        '''
+        :param export_dir: Directory to copy the raw WARC records of fetched articles into
+        :param file_mb: Size in megabytes at which exported WARC files are rolled over
+        :param index_mode: 'overwrite' to replace the offset index of earlier exports, or 'append' to add to it
+        '''
+        if not self.can_export_warc:
+            raise NotImplementedError('This source cannot export WARC records, please try another source.')
+        # offsets are stored as 32 bit integers in the index schema
+        if file_mb >= 2047:
+            raise ValueError('Exported WARC files must be smaller than 2GB')
+        if index_mode not in ('overwrite', 'append'):
+            raise ValueError(f"Unknown WARC export index mode '{index_mode}', please use 'overwrite' or 'append'")
+        self.warc_export_dir = export_dir
+        self.warc_export_file_mb = file_mb
+        self.warc_export_index_mode = index_mode
+
     def set_distinct(self):
         return
 
@@ -87,6 +131,9 @@ class BaseSource:
     def _set_spark_options(self, spark_builder: spark_tools.SparkBuilder):
         return
 
+    def _release(self):
+        return
+
     def _apply_default_filters(self, df, spark_manager, url_only, max_articles):
         if url_only:
             df = df.select('url')
@@ -105,27 +152,255 @@ class BaseSource:
                 df = spark.sql(f"SELECT * FROM temp WHERE {clause}")
 
         if self.url_black_list:
-            for blacklist_pattern in self.url_black_list:
-                like_pattern = blacklist_pattern.replace('*', '%')
-                df = df.where(~psql.functions.col('url').like(like_pattern))
+            blacklist_regex = filters.url_blacklist_regex(self.url_black_list)
+            df = df.where(~psql.functions.col('url').rlike(blacklist_regex))
+
+        if self.seen_urls:
+            df = self.seen_urls.exclude(spark_manager, df)
 
         return df.limit(max_articles) if max_articles else df
 
 class CSV(BaseSource):
-    def __init__(self, csv_path):
+    '''
+    Source of articles exported to CSV, optionally cached as Parquet so later runs read only the columns they need
+
+    The cached copy is range partitioned by publish date, so date filters skip most files, and is remade whenever
+    the CSV changes size or modification time.
+    '''
+
+    def __init__(self, csv_path, schema=None, cache_dir=None):
+        '''
+        :param schema: Spark DDL string or `StructType` of article columns, matched to the CSV header by name. Columns not in it,
+                       such as a pandas index, are read as strings. Defaults to inferring types, which reads the whole CSV an extra time
+        :param cache_dir: Directory to keep a Parquet copy of the CSV in, which can be on any filesystem Spark can write to
+        '''
         super().__init__()
         self.csv_path = csv_path
+        self.schema = schema
+        self.cache_dir = cache_dir
+
+    def _read_csv(self, spark):
+        csv_options = {'header': True, 'multiLine': True, 'escape': '"'}
+        if self.schema is None:
+            return spark.read.csv(self.csv_path, inferSchema=True, **csv_options)
+
+        schema = psql.types._parse_datatype_string(self.schema) if isinstance(self.schema, str) else self.schema
+        types = {field.name: field.dataType for field in schema.fields}
+        # without a schema only the header is read, and spark matches a given schema to columns by position
+        columns = spark.read.csv(self.csv_path, **csv_options).columns
+        missing = set(types) - set(columns)
+        if missing:
+            raise ValueError(f"Columns {sorted(missing)} of the schema are not in the CSV header")
+        csv_schema = psql.types.StructType([psql.types.StructField(col, types.get(col, psql.types.StringType())) for col in columns])
+        return spark.read.csv(self.csv_path, schema=csv_schema, **csv_options)
+
+    def _cache_path(self, spark_manager):
+        spark_context = spark_manager.get_spark_context()
+        jvm = spark_context._jvm
+        csv_path = jvm.org.apache.hadoop.fs.Path(self.csv_path)
+        fs = csv_path.getFileSystem(spark_context._jsc.hadoopConfiguration())
+
+        statuses = fs.globStatus(csv_path) or []
+        file_statuses = []
+        for status in statuses:
+            file_statuses.extend(fs.listStatus(status.getPath()) if status.isDirectory() else [status])
+        if not file_statuses:
+            raise ValueError(f"No CSV found at '{self.csv_path}'")
+
+        # key the cached copy by the files it was made from and how they were read
+        stamp = hashlib.sha1(str(self.schema).encode('utf-8'))
+        for status in sorted(file_statuses, key=lambda status: status.getPath().toString()):
+            stamp.update(f"{status.getPath().toString()}:{status.getLen()}:{status.getModificationTime()}".encode('utf-8'))
+
+        name = self.csv_path.rstrip('/').split('/')[-1].split('.')[0] or 'csv'
+        csv_digest = hashlib.sha1(self.csv_path.encode('utf-8')).hexdigest()[:8]
+        csv_cache_dir = f"{self.cache_dir.rstrip('/')}/{name}-{csv_digest}"
+        return csv_cache_dir, f"{csv_cache_dir}/{stamp.hexdigest()}", fs, jvm
+
+    def _read_cached(self, spark_manager):
+        spark = spark_manager.get_spark_session()
+        csv_cache_dir, cache_path, fs, jvm = self._cache_path(spark_manager)
+
+        # spark only writes the success marker once every file is written
+        if not fs.exists(jvm.org.apache.hadoop.fs.Path(f"{cache_path}/_SUCCESS")):
+            logging.info(f"Converting '{self.csv_path}' to Parquet at '{cache_path}'")
+            # drop copies of older versions of the CSV
+            fs.delete(jvm.org.apache.hadoop.fs.Path(csv_cache_dir), True)
+
+            df = self._read_csv(spark)
+            if '_c0' in df.columns:
+                df = df.drop('_c0')
+            num_partitions = spark_manager.get_num_cpus() * 8
+            if 'publish_date' in df.columns:
+                df = df.repartitionByRange(num_partitions, 'publish_date')
+            else:
+                df = df.repartition(num_partitions)
+            df.write.parquet(cache_path)
+
+        return spark.read.parquet(cache_path)
 
     def fetch(self, spark_manager, max_articles=None, url_only=False):
-        spark = spark_manager.get_spark_session()
-        df = spark.read.csv(self.csv_path, inferSchema=True, header=True, multiLine=True, escape='"')
+        if self.cache_dir:
+            # parquet files are split across tasks, so articles need no shuffle before filtering
+            df = self._read_cached(spark_manager)
+            return self._apply_default_filters(df, spark_manager, url_only, max_articles)
 
+        df = self._read_csv(spark_manager.get_spark_session())
         if '_c0' in df.columns:
             df = df.drop('_c0')
 
-        df = df.repartition(spark_manager.get_num_cpus() * 8)
-        return self._apply_default_filters(df, spark_manager, url_only, max_articles)
+        # multi line CSVs are read a whole file per task, so spread articles out for later filters, after the cheap default ones
+        df = self._apply_default_filters(df, spark_manager, url_only, max_articles)
+        return df.repartition(spark_manager.get_num_cpus() * 8)
+
+
+class ParquetStore(BaseSource):
+    '''
+    Columnar store of articles, partitioned by publish year, month and registered domain, with files sorted by publish date
+
+    Date ranges and sites skip whole partitions, exact date filters skip row groups by their min and max publish dates,
+    and only the features asked for are read. Write articles to it with `Runner.send_to_parquet`, and merge the small
+    files left by many appends with `compact`.
+    '''
+    partition_cols = ['year', 'month', 'domain']
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def fetch(self, spark_manager, max_articles=None, url_only=False):
+        spark = spark_manager.get_spark_session()
+        df = spark.read.parquet(self.path)
+
+        # conditions only on partition columns, which spark resolves to directories before reading any files
+        month_idx = df['year'] * 12 + df['month']
+        if self.start_date:
+            df = df.where(month_idx >= self.start_date.year * 12 + self.start_date.month)
+        if self.end_date:
+            df = df.where(month_idx <= self.end_date.year * 12 + self.end_date.month)
+        if self.sites:
+            domains = list({utils.registered_domain(site) for site in self.sites} - {None})
+            df = df.where(df['domain'].isin(domains))
+
+        df = self._apply_default_filters(df, spark_manager, url_only, max_articles)
+        if url_only:
+            return df
 
+        columns = [col for col in self.features if col in df.columns] if self.features else df.columns
+        return df.select(*[col for col in columns if col not in self.partition_cols])
+
+    def write(self, df, mode='append', max_records_per_file=1000000):
+        '''
+        Add articles to the store
+
+        :param mode: Spark save mode, 'append' to add to the store or 'overwrite' to replace it
+        '''
+        df = df.withColumn('year', psql.functions.year('publish_date')) \
+               .withColumn('month', psql.functions.month('publish_date'))
+        df = utils.add_registered_domain(df)
+
+        # one task per partition directory, writing files sorted by publish date for row group pruning
+        df.repartition(*self.partition_cols) \
+          .sortWithinPartitions(*self.partition_cols, 'publish_date') \
+          .write \
+          .partitionBy(*self.partition_cols) \
+          .option('maxRecordsPerFile', max_records_per_file) \
+          .mode(mode) \
+          .parquet(self.path)
+
+    def compact(self, spark_manager, target_file_mb=128):
+        '''
+        Merge the files of each partition that has more files than its size needs into files of about `target_file_mb`
+
+        Only the files listed when compaction starts are replaced, so appends can continue meanwhile.
+        Merged files are moved into place before the files they replace are deleted, so readers may see articles twice
+        but never miss them. If compaction fails partway, the merged files are left in `_staging` with a manifest of
+        the files they replace, and the next call finishes moving them into place first.
+
+        :return: Number of partitions compacted
+        '''
+        spark = spark_manager.get_spark_session()
+        spark_context = spark_manager.get_spark_context()
+        hadoop_fs = spark_context._jvm.org.apache.hadoop.fs
+        store_path = hadoop_fs.Path(self.path)
+        fs = store_path.getFileSystem(spark_context._jsc.hadoopConfiguration())
+        store_path = fs.makeQualified(store_path)
+        staging_path = f"{store_path.toString()}/_staging"
+        manifest_path = f"{staging_path}/_manifest"
+        target_bytes = target_file_mb * 1024 * 1024
+
+        if fs.exists(hadoop_fs.Path(manifest_path)):
+            # a previous compaction failed after staging its files
+            self._finish_compaction(spark, fs, hadoop_fs, store_path, staging_path, manifest_path)
+        elif fs.exists(hadoop_fs.Path(staging_path)):
+            # a previous compaction failed before moving anything
+            fs.delete(hadoop_fs.Path(staging_path), True)
+
+        partition_files = collections.defaultdict(list)
+        files = fs.listFiles(store_path, True)
+        while files.hasNext():
+            status = files.next()
+            path = status.getPath()
+            if path.getName().endswith('.parquet') and '/_staging' not in path.toString():
+                partition_files[path.getParent().toString()].append((path.toString(), status.getLen()))
+
+        to_compact = {partition: files for partition, files in partition_files.items()
+                      if len(files) > max(1, -(-sum(size for _, size in files) // target_bytes))}
+        if not to_compact:
+            return 0
+
+        file_paths = [path for files in to_compact.values() for path, _ in files]
+        num_bytes = sum(size for files in to_compact.values() for _, size in files)
+        df = spark.read.option('basePath', self.path).parquet(*file_paths)
+        records_per_file = max(1, int(df.count() * target_bytes / num_bytes))
+
+        df.repartition(*self.partition_cols) \
+          .sortWithinPartitions(*self.partition_cols, 'publish_date') \
+          .write \
+          .partitionBy(*self.partition_cols) \
+          .option('maxRecordsPerFile', records_per_file) \
+          .mode('overwrite') \
+          .parquet(staging_path)
+
+        # written once all files are staged, so a manifest means the staged files are complete
+        manifest = [(partition, path) for partition, files in to_compact.items() for path, _ in files]
+        spark.createDataFrame(manifest, 'partition string, path string') \
+             .coalesce(1) \
+             .write \
+             .json(manifest_path)
+
+        self._finish_compaction(spark, fs, hadoop_fs, store_path, staging_path, manifest_path)
+        return len(to_compact)
+
+    def _rename(self, fs, src, dst):
+        return fs.rename(src, dst)
+
+    def _finish_compaction(self, spark, fs, hadoop_fs, store_path, staging_path, manifest_path):
+        '''
+        Move the staged files of a compaction into their partitions, then delete the files they replace.
+        Safe to repeat, as files already moved or deleted are skipped
+        '''
+        manifest = spark.read.schema('partition string, path string').json(manifest_path).collect()
+        partitions = sorted({row['partition'] for row in manifest})
+
+        for partition in partitions:
+            staged_partition = hadoop_fs.Path(f"{staging_path}{partition[len(store_path.toString()):]}")
+            if not fs.exists(staged_partition):
+                continue
+            for status in fs.listStatus(staged_partition):
+                if status.getPath().getName().endswith('.parquet'):
+                    target = hadoop_fs.Path(f"{partition}/{status.getPath().getName()}")
+                    if not self._rename(fs, status.getPath(), target):
+                        raise OSError(f"Failed to move compacted file {status.getPath().toString()} to {partition}, "
+                                      f"compaction will be finished by the next call to `compact`")
+
+        # the merged files are all in place, so the files they replace can go
+        for row in manifest:
+            path = hadoop_fs.Path(row['path'])
+            if fs.exists(path) and not fs.delete(path, False):
+                raise OSError(f"Failed to delete compacted file {row['path']}, compaction will be finished by the next call to `compact`")
+
+        fs.delete(hadoop_fs.Path(staging_path), True)
 
 
 class BaseCommonCrawl(BaseSource):
@@ -171,6 +446,16 @@ class CommonCrawl(BaseCommonCrawl):
         self.can_url_search = True
         self.crawls = None
         self.distinct = False
+        self.table_path = None
+        self.can_export_warc = True
+
+    def set_index(self, table_path):
+        '''
+        Search an index built from our own WARC files with `CCIndexBuildJob` instead of the Common Crawl index
+
+        :param table_path: Path of the index table
+        '''
+        self.table_path = table_path
 
     def set_crawls(self, crawl):
         if crawl == 'latest':
@@ -184,6 +469,10 @@ class CommonCrawl(BaseCommonCrawl):
                 self.crawls = crawl
 
     def fetch(self, spark_manager, max_articles=None, url_only=False):
+        # our own index holds only our crawls
+        if self.table_path and self.crawls is None:
+            self.crawls = 'all'
+
         # only need to look at crawls that are after the start_date of the search
         if self.start_date is not None and self.crawls is None:
             self.crawls = utils.get_cc_crawls_since(self.start_date)
@@ -192,12 +481,17 @@ class CommonCrawl(BaseCommonCrawl):
             raise ValueError('Set crawls either using `set_crawls` or `in_date_range`')
 
         # create the spark job
-        job = CCIndexFetchNewsJob(self.aws_access_key, self.aws_secret_key)
+        if self.table_path:
+            job = CCIndexFetchNewsJob(self.aws_access_key, self.aws_secret_key, table_path=self.table_path)
+        else:
+            job = CCIndexFetchNewsJob(self.aws_access_key, self.aws_secret_key)
         job.set_query_options(sites=self.sites, crawls=self.crawls, lang=self.lang, 
                               limit=max_articles, url_black_list=self.url_black_list,
                               start_date=self.start_date, end_date=self.end_date)
-        return job.run(spark_manager, features=self.features, urls=self.urls, url_only=url_only, keywords=self.keywords, 
-                       start_date=self.start_date, end_date=self.end_date)
+        return job.run(spark_manager, features=self.features, urls=self.urls, broadcast_urls=self.broadcast_urls, url_only=url_only, 
+                       keywords=self.keywords, keyword_options=self.keyword_options, start_date=self.start_date, end_date=self.end_date,
+                       seen_urls=self.seen_urls, warc_export_dir=self.warc_export_dir, warc_export_file_mb=self.warc_export_file_mb,
+                       warc_export_index_mode=self.warc_export_index_mode)
         
 
     def query_index(self, query, spark_master_url=None):
@@ -231,9 +525,55 @@ class NewsCrawl(BaseCommonCrawl):
 
         # create the spark job
         job = FetchNewsJob(self.aws_access_key, self.aws_secret_key)
-        return job.run(spark_manager, listings, url_only=url_only, keywords=self.keywords, limit=max_articles, sites=self.sites)
+        # check each record before parsing it where the seen URLs allow, otherwise exclude them once fetched
+        seen_url_checker = self.seen_urls.url_checker(spark_manager) if self.seen_urls else None
+        df = job.run(spark_manager, listings, url_only=url_only, keywords=self.keywords, keyword_options=self.keyword_options,
+                     limit=max_articles, sites=self.sites, url_black_list=self.url_black_list, seen_url_checker=seen_url_checker)
+
+        if self.seen_urls and seen_url_checker is None:
+            df = self.seen_urls.exclude(spark_manager, df)
+        return df
+
+class LocalWarc(BaseSource):
+    '''
+    Source of news articles in WARC files on a local or mounted filesystem, such as private crawls
+
+    Files are memory mapped, and files larger than `split_size_mb` are split at record boundaries into byte ranges
+    processed by separate tasks, so a few large files can still use every core.
+    '''
+
+    def __init__(self, paths, split_size_mb=64):
+        '''
+        :param paths: Path or list of paths to WARC files, or directories containing them
+        '''
+        super().__init__()
+        self.paths = paths
+        self.split_size_mb = split_size_mb
+        self.can_keyword_filter = True
+
+        # we apply newsplease heuristics in spark job
+        self.news_only = True
+
+    def fetch(self, spark_manager, max_articles=None, url_only=False):
+        job = LocalWarcFetchNewsJob(split_size_mb=self.split_size_mb)
+        # check each record before parsing it where the seen URLs allow, otherwise exclude them once fetched
+        seen_url_checker = self.seen_urls.url_checker(spark_manager) if self.seen_urls else None
+        df = job.run(spark_manager, self.paths, features=self.features, url_only=url_only, keywords=self.keywords, keyword_options=self.keyword_options,
+                     limit=max_articles, sites=self.sites, start_date=self.start_date, end_date=self.end_date,
+                     url_black_list=self.url_black_list, seen_url_checker=seen_url_checker)
+
+        if self.seen_urls and seen_url_checker is None:
+            df = self.seen_urls.exclude(spark_manager, df)
+        return df.limit(max_articles) if max_articles else df
 
 class MongoDB(BaseSource):
+    '''
+    Source of articles stored in a MongoDB collection
+
+    Date ranges, sites, the URL blacklist, the features and the article limit are sent to the server as an aggregation
+    pipeline, so only matching fields of matching articles leave the database. Each partition from the connector's
+    partitioner runs the pipeline over its own range of the collection.
+    '''
     connection_string: str
     database: str
     collection: str
@@ -252,21 +592,145 @@ class MongoDB(BaseSource):
         spark_builder.set_conf('spark.mongodb.input.uri', self.connection_string)
         spark_builder.set_conf('spark.mongodb.keep_alive_ms', 20000)
 
-    def fetch(self, spark_manager: spark_tools.SparkManager, max_articles: int = None, url_only: bool = False):
-        uri = utils.construct_db_uri(self.connection_string, self.database, self.collection)
+    def get_pipeline(self, max_articles=None, url_only=False):
+        '''
+        :return: Aggregation pipeline matching the articles to fetch and projecting their features
+        '''
+        match = []
+        if self.start_date or self.end_date:
+            # bounds as midnight timestamps, as when spark compares publish dates to them
+            date_range = {}
+            if self.start_date:
+                date_range['$gte'] = {'$date': f"{self.start_date.isoformat()}T00:00:00Z"}
+            if self.end_date:
+                date_range['$lte'] = {'$date': f"{self.end_date.isoformat()}T00:00:00Z"}
+            match.append({'publish_date': date_range})
+
+        if self.sites:
+            match.append({'$or': [{'url': {'$regex': re.escape(site)}} for site in self.sites]})
+
+        if self.url_black_list:
+            blacklist_regex = filters.url_blacklist_regex(self.url_black_list)
+            match.append({'url': {'$type': 'string', '$not': {'$regex': blacklist_regex}}})
+
+        pipeline = []
+        if match:
+            pipeline.append({'$match': match[0] if len(match) == 1 else {'$and': match}})
+
+        if max_articles:
+            # applied to each partition, and to all of them by spark afterwards
+            pipeline.append({'$limit': max_articles})
+
+        features = ['url'] if url_only else self.features
+        if features:
+            projection = {feature: 1 for feature in features}
+            # the seen URLs are excluded by spark after fetching
+            if self.seen_urls:
+                projection['url'] = 1
+            if '_id' not in features:
+                projection['_id'] = 0
+            pipeline.append({'$project': projection})
+
+        return pipeline
 
+    def fetch(self, spark_manager: spark_tools.SparkManager, max_articles: int = None, url_only: bool = False):
         spark = spark_manager.get_spark_session()
+        pipeline = self.get_pipeline(max_articles=max_articles, url_only=url_only)
         df = spark.read.format("mongo") \
                        .option("uri", self.connection_string) \
                        .option("database", self.database) \
                        .option("collection", self.collection) \
+                       .option("pipeline", json.dumps(pipeline)) \
+                       .option("partitioner", "MongoSamplePartitioner") \
                        .option("partitionerOptions.partitionSizeMB", str(self.partition_size)) \
                        .option("partitionerOptions.samplesPerPartition", "20") \
                        .load()
 
-        df = df.repartition(spark_manager.get_num_cpus() * 8)
+        if self.seen_urls:
+            df = self.seen_urls.exclude(spark_manager, df)
+            features = ['url'] if url_only else self.features
+            if features:
+                df = df.select(*[feature for feature in features if feature in df.columns])
+
+        return df.limit(max_articles) if max_articles else df
+
+
+class URLList(BaseSource):
+    '''
+    Source of articles downloaded live from a list of URLs, spread over executors
+
+    URLs are partitioned by host, so each site is fetched by a single task whose limits bound the load on it,
+    while different sites are fetched in parallel across executors.
+    '''
+
+    def __init__(self, urls, max_connections=32, max_per_host=2, min_host_interval=1.0, cache_dir=None, batch_size=1000, num_partitions=None):
+        '''
+        :param urls: List of URLs, a DataFrame with a `url` column, or a path to URLs stored as
+                     Parquet (.parquet), CSV with a `url` header (.csv), or text with one URL per line
+        :param max_connections: Number of downloads in flight at once in each task
+        :param max_per_host: Number of downloads in flight at once from each site
+        :param min_host_interval: Seconds between the starts of downloads from each site
+        :param cache_dir: Directory on executors to cache responses in, ideally shared between them.
+                          Cached pages are fetched again with conditional requests
+        :param batch_size: Number of URLs each task downloads before parsing them
+        :param num_partitions: Number of tasks to spread sites over, defaults to 8 per core
+        '''
+        super().__init__()
+        self.url_list = urls
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.min_host_interval = min_host_interval
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.num_partitions = num_partitions
+
+    def fetch(self, spark_manager, max_articles=None, url_only=False):
+        spark = spark_manager.get_spark_session()
+        url_df = utils.load_urls(spark_manager, self.url_list).distinct()
+
+        # drop what we can before downloading anything
+        if self.sites:
+            url_df = url_df.where(' OR '.join([f"url LIKE '%{worker_utils.escape_sql_string(site)}%'" for site in self.sites]))
+        if self.url_black_list:
+            url_df = url_df.where(~psql.functions.col('url').rlike(filters.url_blacklist_regex(self.url_black_list)))
+        if self.seen_urls:
+            url_df = self.seen_urls.exclude(spark_manager, url_df)
+
+        # only download as many pages as articles asked for, even if some fail to download or parse
+        if max_articles:
+            url_df = url_df.limit(max_articles)
+        if url_only:
+            return url_df
+
+        num_partitions = self.num_partitions or spark_manager.get_num_cpus() * 8
+        url_df = url_df.repartition(num_partitions, psql.functions.expr("parse_url(url, 'HOST')"))
+
+        features = self.features
+        fetcher = http_fetch.AsyncFetcher(max_connections=self.max_connections, max_per_host=self.max_per_host,
+                                          min_host_interval=self.min_host_interval, cache_dir=self.cache_dir)
+        batch_size = self.batch_size
+
+        def fetch_partition(rows):
+            urls = [row['url'] for row in rows]
+            for start in range(0, len(urls), batch_size):
+                batch_urls = urls[start:start + batch_size]
+                for url, html in zip(batch_urls, fetcher.fetch_all(batch_urls)):
+                    if html is None:
+                        continue
+                    try:
+                        article = worker_utils.html_to_article(url, html)
+                    except Exception:
+                        continue
+                    yield worker_utils.article_to_row(article, url, features)
 
-        return self._apply_default_filters(df, spark_manager, url_only, max_articles)
+        df = spark.createDataFrame(url_df.rdd.mapPartitions(fetch_partition), worker_utils.article_schema(features))
+
+        if self.start_date:
+            df = df.filter(df['publish_date'] >= self.start_date)
+        if self.end_date:
+            df = df.filter(df['publish_date'] <= self.end_date)
+
+        return df.limit(max_articles) if max_articles else df
 
 
 class SearchEngineSource(BaseSource):
@@ -279,19 +743,32 @@ class SearchEngineSource(BaseSource):
 class Google(SearchEngineSource):
     '''
     Source that uses Google's Custom Search JSON API
+
+    Result pages are requested concurrently within a query rate, and articles are downloaded concurrently with
+    bounded load on each site, optionally through a cache of responses kept between runs.
     '''
 
-    def __init__(self, dev_key, engine_id):
+    def __init__(self, dev_key, engine_id, max_concurrent_queries=4, queries_per_second=1.5, max_per_host=2, min_host_interval=0.5,
+                 cache_dir=None, api_url='https://www.googleapis.com/customsearch/v1'):
+        '''
+        :param max_concurrent_queries: Number of result pages requested at once
+        :param queries_per_second: Rate of result page requests, within the default quota of 100 queries a minute
+        :param max_per_host: Number of articles downloaded at once from each site
+        :param min_host_interval: Seconds between the starts of downloads from each site
+        :param cache_dir: Directory to cache downloaded articles in, which are then fetched again with conditional requests
+        '''
         super().__init__()
 
         self.dev_key = dev_key
         self.engine_id = engine_id
-
-    def fetch(self, spark_manager, max_articles: int = 100, url_only=False):
-
-        service = gbuild("customsearch", "v1",
-            developerKey=self.dev_key)
-
+        self.max_concurrent_queries = max_concurrent_queries
+        self.queries_per_second = queries_per_second
+        self.max_per_host = max_per_host
+        self.min_host_interval = min_host_interval
+        self.cache_dir = cache_dir
+        self.api_url = api_url
+
+    def _get_query(self):
         # construct keywords into query
         query = ' '.join(self.keywords)
 
@@ -307,56 +784,241 @@ class Google(SearchEngineSource):
             post_end_date = self.end_date + datetime.timedelta(days=1)
             query += f" before:{post_end_date.strftime('%Y-%m-%d')}"
 
-        # using siterestrict allows more than 10000 calls per day
-        # note both methods still require payment for more than 100 requests a day
-        # if sites:
-        #     method = service.cse()
-        # else:
-        #     method = service.cse().siterestrict()
-        method = service.cse()
+        return query
+
+    def _get_urls(self, max_articles):
+        query = self._get_query()
 
         # google custom search returns max of 100 results
         # each page contains max 10 results
+        num_pages = min(math.ceil(max_articles / 10), 10) if max_articles else 10
+        page_urls = [f"{self.api_url}?{urllib.parse.urlencode({'key': self.dev_key, 'cx': self.engine_id, 'q': query, 'start': (page_num * 10) + 1})}"
+                     for page_num in range(num_pages)]
 
-        if max_articles:
-            num_pages = max_articles // 10
-        else:
-            num_pages = 10
+        fetcher = http_fetch.AsyncFetcher(max_connections=self.max_concurrent_queries, max_per_host=self.max_concurrent_queries,
+                                          min_host_interval=1 / self.queries_per_second)
+        pages = fetcher.fetch_all(page_urls)
+        if pages[0] is None:
+            raise ValueError("Query to Google Search failed.")
+
+        results = [json.loads(page) for page in pages if page is not None]
+        if int(results[0]['searchInformation']['totalResults']) == 0:
+            raise ValueError("Query to Google Search produced no results.")
+
+        urls = list(dict.fromkeys(item['link'] for result in results for item in result.get('items', [])))
+        return urls[:max_articles] if max_articles else urls
 
+    def fetch(self, spark_manager, max_articles: int = 100, url_only=False):
+        spark_session = spark_manager.get_spark_session()
+        urls = self._get_urls(max_articles)
+
+        blacklist = filters.compile_url_blacklist(self.url_black_list)
+        urls = [url for url in urls if not filters.check_url_blacklisted(url, blacklist)]
+
+        # skip downloading articles collected by previous runs
+        if self.seen_urls and urls:
+            url_df = self.seen_urls.exclude(spark_manager, spark_session.createDataFrame([(url,) for url in urls], ['url']))
+            unseen_urls = set(row['url'] for row in url_df.collect())
+            urls = [url for url in urls if url in unseen_urls]
+
+        if url_only:
+            return spark_session.createDataFrame([psql.Row(url=url) for url in urls], 'url string')
+
+        fetcher = http_fetch.AsyncFetcher(max_per_host=self.max_per_host, min_host_interval=self.min_host_interval, cache_dir=self.cache_dir)
         articles = []
+        for url, html in zip(urls, fetcher.fetch_all(urls)):
+            try:
+                if html is None:
+                    raise ValueError('Download failed')
+                article = worker_utils.html_to_article(url, html)
+            except Exception:
+                logging.warning(f"Couldn't get article from URL: {url}")
+                continue
 
-        for page_num in range(num_pages):
-            results = method.list(
-                q=query,
-                cx=self.engine_id,
-                start=str((page_num * 10) + 1)
-            ).execute()
+            articles.append(worker_utils.article_to_row(article, url, self.features))
 
-            if int(results['searchInformation']['totalResults']) == 0:
-                raise ValueError("Query to Google Search produced no results.")
+        return spark_session.createDataFrame(articles, worker_utils.article_schema(self.features))
 
-            items = results['items']
 
-            for item in items:
-                url = item['link']
-                # TODO convert for spark
-                if url_only:
-                    articles.append(psql.Row(url=url))
-                else:
-                    try:
-                        article = worker_utils.link_to_article(url)
-                    except ValueError:
-                        logging.warn(f"Couldn't get article from URL: {url}")
-                        continue
+def _thread_local_properties(spark_context):
+    '''
+    :return: Whether local properties set in an `InheritableThread` stay in that thread, as when python threads are pinned to JVM threads
+    '''
+    probe = 'seldonite.thread.probe'
+    thread = InheritableThread(target=spark_context.setLocalProperty, args=(probe, 'set'))
+    thread.start()
+    thread.join()
 
-                    row_values = collections.OrderedDict()
-                    for feature in self.features:
-                        if feature == 'url':
-                            row_values[feature] = url
-                        else:
-                            row_values[feature] = getattr(article, feature)
+    if spark_context.getLocalProperty(probe) is None:
+        return True
+    spark_context.setLocalProperty(probe, None)
+    return False
 
-                    articles.append(psql.Row(**row_values))
 
-        spark_session = spark_manager.get_spark_session()
-        return spark_session.createDataFrame(articles)
+class MultiSource(BaseSource):
+    '''
+    Source combining several sources in one Spark session, such as NewsCrawl, CommonCrawl and a MongoDB archive
+
+    Filters are pushed down to each source, which are fetched concurrently in their own FAIR scheduler pools.
+    Pools need python threads pinned to JVM threads, which pyspark 3.1 only does with the environment variable
+    `PYSPARK_PIN_THREAD=true` set before the session starts, otherwise sources share a pool. Their articles are
+    aligned to the same schema and deduplicated by URL fingerprint, keeping the article of the first source listed.
+    The deduplicated articles stay cached until the collector is released.
+    '''
+
+    def __init__(self, sources, pool_prefix='seldonite'):
+        '''
+        :param sources: List of sources, in order of preference for articles found by several
+        :param pool_prefix: Prefix of the names of the scheduler pools of the sources
+        '''
+        super().__init__()
+        if not sources:
+            raise ValueError('MultiSource needs at least one source')
+        self.sources = sources
+        self.pool_prefix = pool_prefix
+        self._fetched_df = None
+
+        # filters any source can't apply are applied by the collector to all articles
+        self.can_keyword_filter = all(source.can_keyword_filter for source in sources)
+        self.can_url_search = all(source.can_url_search for source in sources)
+        self.can_lang_filter = any(source.can_lang_filter for source in sources)
+        self.can_export_warc = any(source.can_export_warc for source in sources)
+
+    def set_date_range(self, start_date, end_date):
+        super().set_date_range(start_date, end_date)
+        for source in self.sources:
+            source.set_date_range(start_date, end_date)
+
+    def set_language(self, language):
+        super().set_language(language)
+        for source in self.sources:
+            if source.can_lang_filter:
+                source.set_language(language)
+
+    def set_url_blacklist(self, url_black_list):
+        super().set_url_blacklist(url_black_list)
+        for source in self.sources:
+            source.set_url_blacklist(url_black_list)
+
+    def set_keywords(self, keywords, **keyword_options):
+        super().set_keywords(keywords, **keyword_options)
+        for source in self.sources:
+            source.set_keywords(keywords, **keyword_options)
+
+    def set_sites(self, sites):
+        super().set_sites(sites)
+        for source in self.sources:
+            source.set_sites(sites)
+
+    def set_urls(self, urls, broadcast=False):
+        super().set_urls(urls, broadcast=broadcast)
+        for source in self.sources:
+            source.set_urls(urls, broadcast=broadcast)
+
+    def set_features(self, features):
+        super().set_features(features)
+        for source in self.sources:
+            source.set_features(features)
+
+    def set_seen_urls(self, seen_urls):
+        super().set_seen_urls(seen_urls)
+        for source in self.sources:
+            source.set_seen_urls(seen_urls)
+
+    def set_warc_export(self, export_dir, file_mb=1024, index_mode='overwrite'):
+        super().set_warc_export(export_dir, file_mb=file_mb, index_mode=index_mode)
+        for source in self.sources:
+            if source.can_export_warc:
+                source.set_warc_export(export_dir, file_mb=file_mb, index_mode=index_mode)
+
+    def set_distinct(self):
+        for source in self.sources:
+            source.set_distinct()
+
+    def _set_spark_options(self, spark_builder: spark_tools.SparkBuilder):
+        # share executors between the jobs of the sources rather than running them one after the other
+        if 'spark.scheduler.mode' not in spark_builder.conf:
+            spark_builder.set_conf('spark.scheduler.mode', 'FAIR')
+        for source in self.sources:
+            source._set_spark_options(spark_builder)
+
+    def _release(self):
+        if self._fetched_df is not None:
+            self._fetched_df.unpersist()
+            self._fetched_df = None
+        for source in self.sources:
+            source._release()
+
+    def _align(self, df, columns, rank):
+        '''
+        :return: Dataframe of the columns in the common schema, with nulls for columns a source lacks
+        '''
+        schema = psql.types._parse_datatype_string(worker_utils.article_schema(columns))
+        aligned = []
+        for field in schema.fields:
+            if field.name in df.columns:
+                aligned.append(psql.functions.col(field.name).cast(field.dataType).alias(field.name))
+            else:
+                aligned.append(psql.functions.lit(None).cast(field.dataType).alias(field.name))
+        return df.select(*aligned, psql.functions.lit(rank).alias('_source_rank'))
+
+    def fetch(self, spark_manager, max_articles=None, url_only=False):
+        sc = spark_manager.get_spark_context()
+        columns = ['url'] if url_only else self.features
+        results = [None] * len(self.sources)
+        errors = [None] * len(self.sources)
+
+        # otherwise threads share local properties, so one source would move the others' jobs between pools
+        use_pools = _thread_local_properties(sc)
+        if not use_pools:
+            logging.warning('Python threads are not pinned to JVM threads, so sources are fetched in the same scheduler pool. '
+                            'Set PYSPARK_PIN_THREAD=true before starting the session to give each source its own pool')
+
+        def fetch_source(idx, source):
+            # jobs started from this thread run in the pool of the source
+            previous_pool = sc.getLocalProperty('spark.scheduler.pool')
+            if use_pools:
+                sc.setLocalProperty('spark.scheduler.pool', f"{self.pool_prefix}-{idx}")
+            try:
+                results[idx] = self._align(source.fetch(spark_manager, max_articles, url_only=url_only), columns, idx).persist()
+                num_rows = results[idx].count()
+                logging.info(f"Rows fetched from {type(source).__name__}: {num_rows}")
+            except Exception as err:
+                errors[idx] = err
+            finally:
+                if use_pools:
+                    sc.setLocalProperty('spark.scheduler.pool', previous_pool)
+
+        threads = [InheritableThread(target=fetch_source, args=(idx, source)) for idx, source in enumerate(self.sources)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        try:
+            for source, err in zip(self.sources, errors):
+                if err is not None:
+                    raise ValueError(f"Failed to fetch from {type(source).__name__}: {err}") from err
+
+            df = results[0]
+            for source_df in results[1:]:
+                df = df.unionByName(source_df)
+
+            # keep the article of the first source of each URL
+            df = add_fingerprint(df)
+            window = psql.Window.partitionBy(FINGERPRINT_COL).orderBy('_source_rank')
+            df = df.withColumn('_rank', psql.functions.row_number().over(window)) \
+                   .where(psql.functions.col('_rank') == 1) \
+                   .drop('_rank', '_source_rank', FINGERPRINT_COL)
+
+            self._release()
+            self._fetched_df = df.persist()
+            num_rows = self._fetched_df.count()
+            logging.info(f"Rows fetched from all sources: {num_rows}")
+        finally:
+            # the articles of the sources are only needed until the deduplicated articles are cached
+            for source_df in results:
+                if source_df is not None:
+                    source_df.unpersist()
+
+        return df.limit(max_articles) if max_articles else df
@@ -1,10 +1,20 @@
+import collections
 from contextlib import contextmanager
+import heapq
+import math
 import os
+import random
+from typing import Iterator
+import uuid
 
 from bigdl.orca import init_orca_context, stop_orca_context
-from pyspark import SparkContext, SparkConf
+import pandas as pd
+import pyarrow as pa
+from pyspark import SparkContext, SparkConf, StorageLevel
 import pyspark.sql as psql
 
+ROW_POSITION_MASK = (1 << 33) - 1
+
 
 class SparkBuilder():
     def __init__(self, master, name='seldonite_app', archives=[], executor_cores=16, executor_memory='128g', driver_cores=2, driver_memory='128g', num_executors=1, python_executable='python', keep_alive=False, spark_conf={}):
@@ -156,16 +166,227 @@ class SparkManager():
             self._spark_context.stop()
 
 def batch(df, max_rows=None):
-    assert max is not None
-
-    num_partitions = max(1, int(df.count() / max_rows))
-
-    df = df.withColumn('_row_id', psql.functions.monotonically_increasing_id())
-    # Using ntile() because monotonically_increasing_id is discontinuous across partitions
-    df = df.withColumn('_partition', psql.functions.ntile(num_partitions).over(psql.window.Window.orderBy(df._row_id))) 
-    df.cache()
-
-    for i in range(num_partitions):
-        df_batch = df.filter(df._partition == i+1).drop('_row_id', '_partition')
-
-        yield df_batch
+    '''
+    Lazily split a dataframe into batches of at most `max_rows` rows
+
+    Rows are numbered by their partition's offset plus their position within the partition, so batches are assigned
+    without a global sort or moving rows between partitions. Each batch is a contiguous range of partitions of a persisted
+    copy of the dataframe, and the cached blocks of other partitions are skipped by their statistics rather than scanned.
+    Each batch should be acted on before fetching the next, and the copy is released once iteration finishes.
+    '''
+    if max_rows is None:
+        raise ValueError('Please set the maximum number of rows in a batch')
+
+    df = df.withColumn('_partition', psql.functions.spark_partition_id()) \
+           .withColumn('_row_id', psql.functions.monotonically_increasing_id())
+    # persist so partition ids and row ids are stable across batches
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
+
+    try:
+        # only the number of rows in each partition is collected to the driver
+        partition_counts = df.groupby('_partition').count().collect()
+
+        partition_offsets = []
+        partition_ranges = []
+        num_rows = 0
+        for row in sorted(partition_counts, key=lambda row: row['_partition']):
+            partition_offsets.extend([psql.functions.lit(row['_partition']), psql.functions.lit(num_rows)])
+            partition_ranges.append((row['_partition'], num_rows, num_rows + row['count']))
+            num_rows += row['count']
+
+        if num_rows == 0:
+            return
+
+        # monotonically increasing ids hold the partition index in the upper 31 bits and the row position within the partition in the lower 33 bits
+        row_num = psql.functions.col('_row_id').bitwiseAND(ROW_POSITION_MASK)
+        partition_offset = psql.functions.create_map(*partition_offsets)[psql.functions.col('_partition')]
+        batch_df = df.withColumn('_batch', ((partition_offset + row_num) / max_rows).cast('long'))
+
+        for batch_idx in range(math.ceil(num_rows / max_rows)):
+            batch_start, batch_end = batch_idx * max_rows, (batch_idx + 1) * max_rows
+            batch_partitions = [partition for partition, start, end in partition_ranges if start < batch_end and end > batch_start]
+            # each cached partition holds a single partition id, so the range prunes whole partitions before the exact filter
+            yield batch_df.filter(batch_df._partition.between(batch_partitions[0], batch_partitions[-1])) \
+                          .filter(batch_df._batch == batch_idx) \
+                          .drop('_partition', '_row_id', '_batch')
+    finally:
+        df.unpersist()
+
+def _allocate_sample(stratum_sizes, num_rows, allocation='proportional'):
+    '''
+    Split a sample size between strata, never giving a stratum more rows than it has
+
+    :param allocation: 'proportional' to sample strata in proportion to their size, or 'equal' to sample the same
+        number from each stratum, with strata too small for their share giving their remainder to the others
+    :return: Dict of the number of rows to sample from each stratum
+    '''
+    if sum(stratum_sizes.values()) <= num_rows:
+        return dict(stratum_sizes)
+
+    # sort on the string form so strata of any type are ordered, and allocation is reproducible
+    strata = sorted(stratum_sizes, key=lambda stratum: (stratum_sizes[stratum], str(stratum)))
+    if allocation == 'proportional':
+        total_rows = sum(stratum_sizes.values())
+        quotas = {stratum: num_rows * stratum_sizes[stratum] / total_rows for stratum in strata}
+        allocated = {stratum: math.floor(quota) for stratum, quota in quotas.items()}
+        # largest remainders take the rows lost to rounding down
+        by_remainder = sorted(strata, key=lambda stratum: (allocated[stratum] - quotas[stratum], str(stratum)))
+        for stratum in by_remainder[:num_rows - sum(allocated.values())]:
+            allocated[stratum] += 1
+    elif allocation == 'equal':
+        allocated = {}
+        remaining = num_rows
+        for idx, stratum in enumerate(strata):
+            allocated[stratum] = min(stratum_sizes[stratum], remaining // (len(strata) - idx))
+            remaining -= allocated[stratum]
+        for stratum in reversed(strata):
+            extra = min(remaining, stratum_sizes[stratum] - allocated[stratum])
+            allocated[stratum] += extra
+            remaining -= extra
+    else:
+        raise ValueError(f"Unknown sample allocation '{allocation}', please use 'proportional' or 'equal'")
+
+    return allocated
+
+def reservoir_sample(df, num_rows, seed=0, strata_col=None, allocation='proportional'):
+    '''
+    Sample exactly `num_rows` rows, or every row if there are fewer, in a single pass over the dataframe
+
+    Each partition keeps a reservoir of the rows with the smallest random keys, per stratum if stratifying, and
+    reservoirs are merged by stratum on the executors. Only the counts of each stratum and then its allocated share
+    of the sample are collected to the driver, so the dataframe is never counted separately. The sample is
+    reproducible for a given seed and partitioning.
+
+    :param strata_col: Column to stratify the sample by
+    :param allocation: How to split the sample between strata, see `_allocate_sample`
+    :return: Dataframe of the sampled rows
+    '''
+    def partition_reservoirs(partition_idx, rows):
+        rng = random.Random(f"{seed}-{partition_idx}")
+        reservoirs = {}
+        counts = collections.Counter()
+        for row in rows:
+            stratum = row[strata_col] if strata_col else None
+            counts[stratum] += 1
+            # max heap on the key, so the largest kept key is replaced; position breaks ties before rows are compared
+            entry = (-rng.random(), -partition_idx, -counts[stratum], row)
+            reservoir = reservoirs.setdefault(stratum, [])
+            if len(reservoir) < num_rows:
+                heapq.heappush(reservoir, entry)
+            elif entry[:3] > reservoir[0][:3]:
+                heapq.heapreplace(reservoir, entry)
+
+        for stratum, reservoir in reservoirs.items():
+            yield stratum, (counts[stratum], [(-key, -idx, -pos, row) for key, idx, pos, row in reservoir])
+
+    def merge_reservoirs(a, b):
+        return a[0] + b[0], heapq.nsmallest(num_rows, a[1] + b[1], key=lambda entry: entry[:3])
+
+    # kept on the executors, as merged reservoirs can hold up to num_rows rows for every stratum
+    reservoirs = df.rdd.mapPartitionsWithIndex(partition_reservoirs).reduceByKey(merge_reservoirs).persist()
+
+    counts = dict(reservoirs.mapValues(lambda reservoir: reservoir[0]).collect())
+    allocated = _allocate_sample(counts, num_rows, allocation=allocation)
+
+    def allocated_entries(stratum_reservoir):
+        stratum, (_, entries) = stratum_reservoir
+        return heapq.nsmallest(allocated[stratum], entries, key=lambda entry: entry[:3])
+
+    sample = reservoirs.flatMap(allocated_entries).collect()
+    reservoirs.unpersist()
+
+    rows = [row for *_, row in sorted(sample, key=lambda entry: entry[:3])]
+    return psql.SparkSession.getActiveSession().createDataFrame(rows, schema=df.schema)
+
+# state from the setup callbacks of batch udfs, created once per python worker and reused by its tasks
+_batch_udf_states = {}
+
+def _rebatch(batches, batch_size):
+    # udfs over an iterator only need to return as many rows in total as they are given,
+    # so arrow batches can be split or merged to the requested size
+    if not batch_size:
+        yield from (batch.reset_index(drop=True) for batch in batches if len(batch) > 0)
+        return
+
+    buffered = []
+    num_buffered = 0
+    for batch in batches:
+        buffered.append(batch)
+        num_buffered += len(batch)
+        if num_buffered >= batch_size:
+            rows = pd.concat(buffered, ignore_index=True)
+            for start in range(0, len(rows) - batch_size + 1, batch_size):
+                yield rows.iloc[start:start + batch_size].reset_index(drop=True)
+            num_buffered = len(rows) % batch_size
+            buffered = [rows.iloc[len(rows) - num_buffered:]]
+
+    if num_buffered > 0:
+        yield pd.concat(buffered, ignore_index=True)
+
+def _to_series(values):
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        values = values.to_pandas()
+    return pd.Series(values).reset_index(drop=True)
+
+def _to_output_frame(output, output_cols, num_rows):
+    if isinstance(output, (pa.Table, pa.RecordBatch)):
+        output = output.to_pandas()
+
+    if isinstance(output, pd.DataFrame):
+        output = pd.DataFrame({col: output[col].reset_index(drop=True) for col in output_cols})
+    elif isinstance(output, dict):
+        output = pd.DataFrame({col: _to_series(output[col]) for col in output_cols})
+    elif isinstance(output, tuple):
+        if len(output) != len(output_cols):
+            raise ValueError(f"Batch UDF returned {len(output)} columns, expected {len(output_cols)}")
+        output = pd.DataFrame({col: _to_series(values) for col, values in zip(output_cols, output)})
+    elif len(output_cols) == 1:
+        output = pd.DataFrame({output_cols[0]: _to_series(output)})
+    else:
+        raise ValueError(f"Batch UDF must return a dataframe, dict or tuple for {len(output_cols)} output columns")
+
+    if len(output) != num_rows:
+        raise ValueError(f"Batch UDF returned {len(output)} rows for a batch of {num_rows}")
+    return output
+
+def batch_udf(func, input_cols, output_schema, batch_size=None, setup=None, arrow=False):
+    '''
+    Vectorized UDF applying a function to batches of several columns, giving one or more columns
+
+    Input columns are passed to Spark as one struct, so any number of them share an Arrow batch,
+    and rows are regrouped into batches of `batch_size` whatever the Arrow batch size.
+
+    :param func: Function of a batch of each input column, preceded by the state from `setup` if given, returning
+        a series or array for a single output column, or a dataframe, dict or tuple of them for several
+    :param output_schema: Spark DDL schema of the output columns, e.g. 'sentiment double, label string'
+    :param setup: Function called once per python worker to create state shared by its batches, such as a model
+    :param arrow: Pass the input columns as pyarrow arrays rather than pandas series
+    :return: Function of a dataframe, returning a struct column of the outputs
+    '''
+    if isinstance(input_cols, str):
+        input_cols = [input_cols]
+
+    output_fields = psql.types._parse_datatype_string(output_schema).fields
+    output_cols = [field.name for field in output_fields]
+    output_type = psql.types.StructType(output_fields)
+    state_key = uuid.uuid4().hex
+
+    @psql.functions.pandas_udf(output_type)
+    def apply_func(batches: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        args = []
+        if setup:
+            if state_key not in _batch_udf_states:
+                _batch_udf_states[state_key] = setup()
+            args.append(_batch_udf_states[state_key])
+
+        for batch in _rebatch(batches, batch_size):
+            columns = [batch[col] for col in input_cols]
+            if arrow:
+                columns = [pa.Array.from_pandas(column) for column in columns]
+            yield _to_output_frame(func(*args, *columns), output_cols, len(batch))
+
+    def apply(df):
+        inputs = psql.functions.struct(*[df[col].alias(col) for col in input_cols])
+        return apply_func(inputs)
+
+    return apply
@@ -12,4 +12,28 @@ class MockAccumulator:
         self.cnt = 0
 
     def add(self, x):
-        self.cnt += x
\ No newline at end of file
+        self.cnt += x
+ARTICLE_HTML = """<html><head><title>{title}</title>
+<meta property="og:type" content="article">
+<meta property="article:published_time" content="{date}">
+</head><body><article><h1>{title}</h1><p>{text}</p></article></body></html>"""
+
+def write_warc(path, urls, gzip=True, date='2021-09-15T10:00:00Z'):
+    '''
+    Write a WARC file with a request and an HTML news article response for each URL
+    '''
+    from io import BytesIO
+    from warcio.statusandheaders import StatusAndHeaders
+    from warcio.warcwriter import WARCWriter
+
+    with open(path, 'wb') as warc_file:
+        writer = WARCWriter(warc_file, gzip=gzip)
+        for idx, url in enumerate(urls):
+            text = ' '.join([f"The minister announced budget number {idx} for schools and hospitals today."] * 20)
+            html = ARTICLE_HTML.format(title=f"Budget story {idx}", date=date, text=text).encode('utf-8')
+            request_headers = StatusAndHeaders('GET / HTTP/1.1', [('Host', url.split('/')[2])], is_http_request=True)
+            request = writer.create_warc_record(url, 'request', payload=BytesIO(b''), http_headers=request_headers, warc_headers_dict={'WARC-Date': date})
+            http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html; charset=utf-8')], protocol='HTTP/1.1')
+            response = writer.create_warc_record(url, 'response', payload=BytesIO(html), http_headers=http_headers, warc_headers_dict={'WARC-Date': date})
+            writer.write_record(request)
+            writer.write_record(response)
@@ -0,0 +1,128 @@
+import os
+import sys
+
+import pyspark.sql as psql
+
+from seldonite.commoncrawl import warc_files
+from seldonite.commoncrawl.cc_index_build import CCIndexBuildJob, url_columns
+from seldonite.commoncrawl.cc_index_fetch_news import CCIndexFetchNewsJob
+from seldonite.sources import news
+
+import mock_source
+import mocks
+
+
+def test_url_columns():
+    columns = url_columns('https://news.bbc.co.uk:8080/world/story?id=1')
+    assert columns['url_host_tld'] == 'uk'
+    assert columns['url_host_2nd_last_part'] == 'co'
+    assert columns['url_host_4th_last_part'] == 'news'
+    assert columns['url_host_5th_last_part'] is None
+    assert columns['url_host_registry_suffix'] == 'co.uk'
+    assert columns['url_host_registered_domain'] == 'bbc.co.uk'
+    assert columns['url_port'] == 8080
+    assert columns['url_path'] == '/world/story'
+    assert columns['url_query'] == 'id=1'
+
+    columns = url_columns('https://someone.blogspot.com/post')
+    assert columns['url_host_registered_domain'] == 'blogspot.com'
+    assert columns['url_host_private_domain'] == 'someone.blogspot.com'
+
+def test_cc_index_build(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[2]') \
+        .appName("test_cc_index_build") \
+        .getOrCreate()
+
+    warc_dir = tmp_path / 'segment-1'
+    os.makedirs(warc_dir)
+    cbc_urls = [f"https://www.cbc.ca/news/story-{idx}" for idx in range(40)]
+    mocks.write_warc(str(warc_dir / 'big.warc.gz'), cbc_urls)
+    mocks.write_warc(str(warc_dir / 'small.warc'), ['https://apnews.com/article/1'], gzip=False)
+
+    table_path = str(tmp_path / 'index')
+    spark_manager = mock_source.LocalSparkManager(spark, num_cpus=2)
+    job = CCIndexBuildJob(crawl='LOCAL-2021', split_size_mb=0.01)
+    num_records = job.run(spark_manager, str(warc_dir), table_path)
+    assert num_records == 41
+
+    index_df = spark.read.schema(job.table_schema).parquet(table_path)
+    rows = index_df.where("url = 'https://www.cbc.ca/news/story-7'").collect()
+    assert len(rows) == 1
+    row = rows[0]
+    assert row['url_surtkey'] == 'ca,cbc)/news/story-7'
+    assert row['url_host_registered_domain'] == 'cbc.ca'
+    assert row['fetch_status'] == 200
+    assert row['content_mime_type'] == 'text/html'
+    assert row['content_charset'] == 'UTF-8'
+    assert row['content_languages'] == 'eng'
+    assert row['warc_segment'] == 'segment-1'
+    assert row['crawl'] == 'LOCAL-2021' and row['subset'] == 'warc'
+
+    # index queries and WARC record fetches work against the local index
+    job = CCIndexFetchNewsJob(None, None, table_path=table_path)
+    job.set_query_options(sites=['cbc.ca'], crawls=['LOCAL-2021'], lang='en')
+    articles = job.run(spark_manager, features=['title', 'url'], urls=None, url_only=False).collect()
+
+    assert sorted(article['url'] for article in articles) == sorted(cbc_urls)
+    assert all(article['title'].startswith('Budget story') for article in articles)
+
+def test_warc_export(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[2]') \
+        .appName("test_warc_export") \
+        .getOrCreate()
+
+    warc_dir = tmp_path / 'crawl'
+    os.makedirs(warc_dir)
+    cbc_urls = [f"https://www.cbc.ca/news/story-{idx}" for idx in range(20)]
+    mocks.write_warc(str(warc_dir / 'big.warc.gz'), cbc_urls)
+    mocks.write_warc(str(warc_dir / 'small.warc'), ['https://www.cbc.ca/news/uncompressed'], gzip=False)
+
+    table_path = str(tmp_path / 'index')
+    spark_manager = mock_source.LocalSparkManager(spark, num_cpus=2)
+    CCIndexBuildJob(crawl='LOCAL-2021').run(spark_manager, str(warc_dir), table_path)
+
+    export_dir = str(tmp_path / 'export')
+    job = CCIndexFetchNewsJob(None, None, table_path=table_path)
+    job.set_query_options(sites=['cbc.ca'], crawls=['LOCAL-2021'])
+    articles = job.run(spark_manager, features=['title', 'url'], urls=None, url_only=False,
+                       warc_export_dir=export_dir, warc_export_file_mb=0.01).collect()
+    expected_urls = sorted(cbc_urls + ['https://www.cbc.ca/news/uncompressed'])
+    assert sorted(article['url'] for article in articles) == expected_urls
+
+    # records are rolled into several files, with an offset index queryable like the columnar URL index
+    assert len(warc_files.list_warc_files(export_dir)) > 2
+    index_df = spark.read.parquet(os.path.join(export_dir, 'index'))
+    assert index_df.count() == len(expected_urls)
+    assert index_df.where("url_host_registered_domain = 'cbc.ca' AND crawl = 'LOCAL-2021' AND subset = 'warc'").count() == len(expected_urls)
+
+    job = CCIndexFetchNewsJob(None, None, table_path=os.path.join(export_dir, 'index'))
+    job.set_query_options(urls=['https://www.cbc.ca/news/story-3'], crawls=['LOCAL-2021'])
+    articles = job.run(spark_manager, features=['title', 'url'], urls=None, url_only=False).collect()
+    assert [article['url'] for article in articles] == ['https://www.cbc.ca/news/story-3']
+
+    # and read back sequentially as local WARC files
+    articles = news.LocalWarc(export_dir).fetch(spark_manager).collect()
+    assert sorted(article['url'] for article in articles) == expected_urls
+    assert not [file_name for file_name in os.listdir(export_dir) if file_name.endswith('.tmp')]
+
+    # exporting again replaces the index rather than adding to it
+    job = CCIndexFetchNewsJob(None, None, table_path=table_path)
+    job.set_query_options(sites=['cbc.ca'], crawls=['LOCAL-2021'])
+    job.run(spark_manager, features=['title', 'url'], urls=None, url_only=False, warc_export_dir=export_dir)
+    assert spark.read.parquet(os.path.join(export_dir, 'index')).count() == len(expected_urls)
+
+    # while appending only processes the records copied by that export
+    job = CCIndexFetchNewsJob(None, None, table_path=table_path)
+    job.set_query_options(urls=['https://www.cbc.ca/news/story-3'], crawls=['LOCAL-2021'])
+    articles = job.run(spark_manager, features=['title', 'url'], urls=None, url_only=False,
+                       warc_export_dir=export_dir, warc_export_index_mode='append').collect()
+    assert [article['url'] for article in articles] == ['https://www.cbc.ca/news/story-3']
+    assert spark.read.parquet(os.path.join(export_dir, 'index')).count() == len(expected_urls) + 1
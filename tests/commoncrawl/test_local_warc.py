@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pyspark.sql as psql
+import pytest
+from warcio.archiveiterator import ArchiveIterator
+
+from seldonite.commoncrawl import warc_files
+from seldonite.sources import news
+
+import mock_source
+import mocks
+
+
+@pytest.mark.parametrize("gzip", [True, False])
+def test_split_warc_file(tmp_path, gzip):
+    path = str(tmp_path / ('crawl.warc.gz' if gzip else 'crawl.warc'))
+    urls = [f"https://www.cbc.ca/news/{idx}" for idx in range(30)]
+    mocks.write_warc(path, urls, gzip=gzip)
+
+    ranges = warc_files.split_warc_file(path, split_size=8 * 1024)
+    assert len(ranges) > 2
+    assert ranges[0][1] == 0 and ranges[-1][2] == os.path.getsize(path)
+    assert all(prev_end == start for (_, _, prev_end), (_, start, _) in zip(ranges, ranges[1:]))
+
+    read_urls = []
+    for path, start, end in ranges:
+        def read_range(reader):
+            for record in ArchiveIterator(reader):
+                if record.rec_type == 'response':
+                    yield record.rec_headers.get_header('WARC-Target-URI')
+        read_urls.extend(warc_files.iterate_range(path, start, end, read_range))
+    assert read_urls == urls
+
+def test_local_warc_fetch(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[2]') \
+        .appName("test_local_warc_fetch") \
+        .getOrCreate()
+
+    warc_dir = tmp_path / 'crawl'
+    os.makedirs(warc_dir / 'sub')
+    mocks.write_warc(str(warc_dir / 'big.warc.gz'), [f"https://www.cbc.ca/news/{idx}" for idx in range(40)])
+    mocks.write_warc(str(warc_dir / 'sub' / 'small.warc'), ['https://apnews.com/article/1'], gzip=False)
+
+    source = news.LocalWarc(str(warc_dir), split_size_mb=0.01)
+    source.set_url_blacklist(['*/news/1'])
+    df = source.fetch(mock_source.LocalSparkManager(spark, num_cpus=2))
+
+    rows = df.collect()
+    assert df.columns == ['title', 'text', 'url', 'publish_date']
+    assert sorted(row['url'] for row in rows) == sorted([f"https://www.cbc.ca/news/{idx}" for idx in range(40) if idx != 1] + ['https://apnews.com/article/1'])
+    assert all(row['title'].startswith('Budget story') and row['publish_date'] for row in rows)
+
+    assert news.LocalWarc(str(warc_dir), split_size_mb=0.01).fetch(mock_source.LocalSparkManager(spark, num_cpus=2), url_only=True).count() == 41
@@ -0,0 +1 @@
+# the tests directory is put on the path for the shared helpers in mock_source, whichever test directory runs
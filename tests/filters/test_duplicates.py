@@ -0,0 +1,31 @@
+import numpy as np
+
+from seldonite.filters import duplicates
+
+ARTICLE = 'The prime minister announced a new budget on Tuesday, promising lower taxes for working families ' \
+          'and more funding for hospitals, schools and public transport across the country.'
+
+def test_minhash_similarity():
+    hasher = duplicates.MinHasher(num_perm=256)
+
+    syndicated = ARTICLE.replace('Tuesday', 'Wednesday')
+    unrelated = 'The home team won the cup final after a late goal in extra time, to the delight of their fans.'
+
+    signature = hasher.signature(ARTICLE)
+    assert signature.shape == (256,)
+    assert (signature == hasher.signature(ARTICLE.upper())).all()
+    assert (signature == hasher.signature(syndicated)).mean() > 0.5
+    assert (signature == hasher.signature(unrelated)).mean() < 0.1
+    assert hasher.signature('').shape == (0,)
+
+def test_lsh_params():
+    for threshold in [0.5, 0.8, 0.9]:
+        bands, rows = duplicates.lsh_params(threshold, num_perm=128)
+        assert bands * rows <= 128
+        # similarity at which texts are candidates with probability one half is near the threshold
+        assert abs((1 / bands) ** (1 / rows) - threshold) < 0.1
+
+    signature = duplicates.MinHasher().signature(ARTICLE)
+    band_hashes = duplicates.band_hashes(signature, 9, 14)
+    assert len(set(band_hashes)) == 9
+    assert band_hashes == duplicates.band_hashes(signature.copy(), 9, 14)
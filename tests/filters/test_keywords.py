@@ -0,0 +1,20 @@
+import pytest
+
+from seldonite.filters.keywords import KeywordMatcher
+
+@pytest.mark.parametrize("keywords, options, text, counts",
+    [(['tax', 'tax cut'], {}, "The tax cut, and another Tax cut.", {'tax': 2, 'tax cut': 2}),
+     (['tax'], {}, "Syntax errors are not taxes.", {}),
+     (['tax'], {'whole_words': False}, "Syntax errors are not taxes.", {'tax': 2}),
+     (['Tax'], {'case_sensitive': True}, "tax and Tax", {'Tax': 1}),
+     (['policy', 'tax cut'], {'stem': True}, "Policies on tax cuts", {'policy': 1, 'tax cut': 1}),
+     (['he', 'she', 'his', 'hers'], {'whole_words': False}, "ushers", {'she': 1, 'he': 1, 'hers': 1}),
+     (['afghanistan'], {}, None, {})])
+def test_keyword_counts(keywords, options, text, counts):
+    matcher = KeywordMatcher(keywords, **options)
+    assert matcher.count(text) == counts
+    assert matcher.matches(text) == bool(counts)
+
+def test_stem_requires_whole_words():
+    with pytest.raises(ValueError):
+        KeywordMatcher(['tax'], whole_words=False, stem=True)
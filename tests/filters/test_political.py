@@ -1,10 +1,15 @@
 import os
+import sys
 import zipfile
 
+import numpy as np
 import pandas as pd
 import pyspark.sql as psql
+import pytest
+import tensorflow as tf
+from tensorflow.keras.models import load_model
 
-from seldonite import filters
+from seldonite.filters import political
 from seldonite.helpers import utils
 
 def test_preprocess():
@@ -13,18 +18,135 @@ def test_preprocess():
     data_path = os.path.join(fixture_path, 'to_preprocess_political.csv')
     df = pd.read_csv(data_path)
 
-    rows = (psql.Row(url=row['url'], all_text=row['all_text']) for idx, row in df.iterrows())
-
     # make sure the file are where we need them
-    filters.political.ensure_zip_exists()
+    political.ensure_zip_exists()
     zip_path = os. path.join(this_dir_path, '..', '..', 'seldonite', 'filters', 'pon_classifier.zip')
     utils.unzip(zip_path, fixture_path)
 
-    tokens = filters.political.preprocess_text_partition(rows, tokenizer_path=fixture_path)
-    tokens = list(tokens)
+    tokens = political.tokenize(df['all_text'], tokenizer_path=fixture_path)
+    encoded_tokens = [political.encode_tokens(article_tokens) for article_tokens in tokens]
+    padded_tokens = political.pad_tokens([political.decode_tokens(article_tokens) for article_tokens in encoded_tokens])
 
     # clean up files
     os.remove(os.path.join(fixture_path, 'model.h5'))
     os.remove(os.path.join(fixture_path, 'tokenizer.json'))
 
-    assert len(tokens) == len(df)
\ No newline at end of file
+    assert len(tokens) == len(df)
+    assert all(len(article_tokens) <= political.PADDING_SIZE for article_tokens in tokens)
+    assert padded_tokens.shape == (len(df), political.PADDING_SIZE)
+    for article_tokens, padded_article_tokens in zip(tokens, padded_tokens):
+        assert (padded_article_tokens[political.PADDING_SIZE - len(article_tokens):] == article_tokens).all()
+
+def test_predict_bucketed():
+
+    tf.random.set_seed(0)
+    # padding tokens have an embedding and pass through biases, and strided pooling depends on the padded length,
+    # so predictions only match padding to the padding size at some lengths
+    model = tf.keras.Sequential([
+        tf.keras.layers.Embedding(100, 4, input_length=political.PADDING_SIZE, embeddings_initializer='uniform'),
+        tf.keras.layers.Conv1D(4, 5, activation='relu', bias_initializer='ones'),
+        tf.keras.layers.MaxPooling1D(5),
+        tf.keras.layers.Conv1D(4, 3, activation='relu', bias_initializer='ones'),
+        tf.keras.layers.GlobalMaxPooling1D(),
+        tf.keras.layers.Dense(2, activation='softmax')
+    ])
+
+    variable_model = political.variable_length_model(model)
+    assert variable_model.input_shape == (None, None)
+
+    buckets = political.exact_bucket_lengths(variable_model)
+    assert buckets[-1] == (political.PADDING_SIZE, political.PADDING_SIZE)
+    assert all(max_length <= length for length, max_length in buckets)
+
+    rng = np.random.default_rng(0)
+    tokens = [rng.integers(1, 100, size=length, dtype=np.int32) for length in [3, 2000, 130, 1, 700, 40, 92, 220, 1372, 1373]]
+    expected = model.predict(political.pad_tokens(tokens), verbose=0)
+
+    predictions = political.predict_bucketed(variable_model, tokens, batch_size=2)
+
+    assert np.allclose(predictions, expected, atol=1e-4)
+
+def test_predict_bucketed_classifier(tmp_path):
+
+    this_dir_path = os.path.dirname(os.path.abspath(__file__))
+    zip_path = os.path.join(this_dir_path, '..', '..', 'seldonite', 'filters', 'pon_classifier.zip')
+    if not os.path.exists(zip_path):
+        pytest.skip('Political classifier archive is not downloaded')
+    utils.unzip(zip_path, str(tmp_path))
+
+    df = pd.read_csv(os.path.join(this_dir_path, '..', 'fixtures', 'to_preprocess_political.csv'))
+    tokens = political.tokenize(df['all_text'], tokenizer_path=str(tmp_path))
+
+    model_path = str(tmp_path / 'model.h5')
+    expected = load_model(model_path).predict(political.pad_tokens(tokens), verbose=0)
+    predictions = political.predict_bucketed(political.load_classifier(model_path), tokens)
+
+    assert np.allclose(predictions, expected, atol=1e-4)
+
+def test_hashed_linear_classifier(tmp_path):
+
+    political_texts = [f"The senate voted on the {topic} bill after the government debate" for topic in ['tax', 'budget', 'defence', 'health']]
+    sports_texts = [f"The {team} team won the match after a late goal in the league" for team in ['home', 'away', 'local', 'national']]
+    texts = (political_texts + sports_texts) * 10
+    cnn_predictions = np.array(([0.9] * 4 + [0.1] * 4) * 10)
+
+    first_stage = political.HashedLinearClassifier(n_features=2**10).fit(texts, cnn_predictions, epochs=20, seed=0)
+    predictions = first_stage.predict(texts)
+    assert (predictions[cnn_predictions > 0.5] > 0.5).all()
+    assert (predictions[cnn_predictions < 0.5] < 0.5).all()
+
+    report = first_stage.calibrate(predictions, cnn_predictions, threshold=0.5, tolerance=0)
+    assert report['precision'] == 1
+    assert report['recall'] == 1
+    assert report['cnn_fraction'] < 1
+
+    # uncertain articles are left to the cnn, so a maximally uncertain model agrees with it exactly
+    uncertain_stage = political.HashedLinearClassifier(n_features=2**10)
+    report = uncertain_stage.calibrate(uncertain_stage.predict(texts), cnn_predictions, threshold=0.5, tolerance=0)
+    assert report == {'precision': 1.0, 'recall': 1.0, 'cnn_fraction': 1.0, 'articles': len(texts)}
+
+    model_path = str(tmp_path / 'first_stage.npz')
+    first_stage.save(model_path)
+    loaded_stage = political.HashedLinearClassifier.load(model_path)
+    assert (loaded_stage.predict(texts) == predictions).all()
+    assert (loaded_stage.lower, loaded_stage.upper, loaded_stage.threshold) == (first_stage.lower, first_stage.upper, first_stage.threshold)
+
+def test_spark_predict(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    tf.random.set_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.layers.Embedding(100, 4, input_length=political.PADDING_SIZE),
+        tf.keras.layers.Conv1D(4, 5, activation='relu'),
+        tf.keras.layers.GlobalMaxPooling1D(),
+        tf.keras.layers.Dense(2, activation='softmax')
+    ])
+    model_path = str(tmp_path / 'model.h5')
+    model.save(model_path)
+
+    rng = np.random.default_rng(0)
+    tokens = [political.encode_tokens(rng.integers(1, 100, size=length, dtype=np.int32)) for length in rng.integers(1, 2000, size=45)]
+
+    spark = psql.SparkSession.builder \
+        .master('local[2]') \
+        .appName("test_spark_predict") \
+        .getOrCreate()
+    sc = spark.sparkContext
+    # partitions longer and shorter than the batch size, and an empty partition
+    rows = [(idx, article_tokens) for idx, article_tokens in enumerate(tokens)]
+    rdd = sc.parallelize(rows[:40], 1).union(sc.parallelize(rows[40:], 1)).union(sc.parallelize([], 1))
+    df = spark.createDataFrame(rdd, 'id int, tokens binary')
+    assert df.rdd.glom().map(len).collect() == [40, 5, 0]
+
+    predictions = political.spark_predict(df, 'tokens', 'political', batch_size=16, model_path=model_path).orderBy('id').collect()
+
+    # each article predicted on its own, padded to the padding size
+    expected = model.predict(political.pad_tokens([political.decode_tokens(article_tokens) for article_tokens in tokens]), verbose=0)[:, 1]
+    assert [row['id'] for row in predictions] == list(range(len(tokens)))
+    assert np.allclose([row['political'] for row in predictions], expected, atol=1e-5)
+
+    # the quantized model is exported once on the driver and shipped to executors
+    predictions = political.spark_predict(df, 'tokens', 'political', batch_size=16, quantized=True, model_path=model_path).orderBy('id').collect()
+    assert sorted(os.listdir(tmp_path)) == sorted(['model.h5', political.QUANTIZED_MODEL_NAME])
+    assert np.allclose([row['political'] for row in predictions], expected, atol=1e-2)
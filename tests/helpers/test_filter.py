@@ -1,4 +1,7 @@
 
+import types
+
+import pandas as pd
 import pytest
 
 from seldonite import filters
@@ -8,4 +11,57 @@ from seldonite import filters
      ("https://www.kelownacapnews.com/life/the-rising-landscapes-of-painter-karel-doruyter/", ["apnews.com"], False)])
 def test_check_url(url, sites, is_from_sites):
     result = filters.check_url_from_sites(url, sites)
-    assert result == is_from_sites
\ No newline at end of file
+    assert result == is_from_sites
+
+@pytest.mark.parametrize("url, url_wildcards, is_blacklisted",
+    [("https://www.cbc.ca/sports/hockey/story", ["*/sports/*"], True),
+     ("https://www.cbc.ca/news/politics/story", ["*/sports/*"], False),
+     ("https://www.cbc.ca/news/politics/story", ["*/sports/*", "*/news/*"], True),
+     ("https://www.cbc.ca/sports", ["*/sports/*"], False),
+     ("https://www.cbc.ca/live_blog/1", ["*/live_blog/*"], True),
+     ("https://www.cbc.ca/liveXblog/1", ["*/live_blog/*"], True),
+     ("https://www.cbc.ca/live\\_blog/1", ["*/live\\_blog/*"], False),
+     ("https://www.cbc.ca/live_blog/1", ["*/live\\_blog/*"], True),
+     ("https://www.cbc.ca/video?id=1.2", ["*?id=1.2"], True),
+     ("https://www.cbc.ca/video?id=102", ["*?id=1.2"], False),
+     ("https://www.cbc.ca/sports/\n", ["*/sports/"], False),
+     ("https://www.cbc.ca/Sports/story", ["*/sports/*"], False)])
+def test_url_blacklist_like_semantics(url, url_wildcards, is_blacklisted):
+    blacklist = filters.compile_url_blacklist(url_wildcards)
+    assert filters.check_url_blacklisted(url, blacklist) == is_blacklisted
+
+def test_empty_url_blacklist():
+    blacklist = filters.compile_url_blacklist([])
+    assert not filters.check_url_blacklisted("https://www.cbc.ca/sports/hockey/story", blacklist)
+
+@pytest.mark.parametrize("keywords, title, text, contains",
+    [(["gun"], "Gun laws", "New rules on guns", True),
+     (["gun"], "Gun laws", "New rules on firearms", False),
+     (["NATO"], "Nato summit", "Leaders met", False),
+     (["NATO"], "Summit", "NATO leaders met", True)])
+def test_contains_keywords(keywords, title, text, contains):
+    article = types.SimpleNamespace(title=title, text=text)
+    assert filters.contains_keywords(article, keywords) == contains
+
+@pytest.mark.parametrize("text, language",
+    [("The government announced a new policy on immigration for foreign workers today.", "en"),
+     ("Le gouvernement a annoncé une nouvelle politique d'immigration aujourd'hui.", "fr"),
+     ("", None),
+     (None, None),
+     ("1234 5678", None)])
+def test_detect_language(text, language):
+    detected, confidence = filters.detect_language(text, max_chars=200)
+    assert detected == language
+    if language:
+        assert confidence > 0.5
+    else:
+        assert confidence is None
+
+def test_extract_countries_batch():
+    texts = pd.Series(["Canada and Germany met in Canada.", "No places here.", None])
+    countries_df = filters.extract_countries_batch(texts, counts=True, positions=True)
+
+    assert list(countries_df.columns) == ['countries', 'country_counts', 'country_spans']
+    assert countries_df['countries'].tolist() == [['Canada', 'Germany'], [], []]
+    assert countries_df['country_counts'][0] == {'Canada': 2, 'Germany': 1}
+    assert countries_df['country_spans'][0]['Canada'] == [[0, 6], [26, 32]]
@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+
+from seldonite.helpers import mongo_sink
+
+pymongo = pytest.importorskip('pymongo')
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError
+import pyspark.sql as psql
+
+
+class FakeCollection:
+    def __init__(self, failures):
+        self.documents = {}
+        self.failures = failures
+
+    def bulk_write(self, requests, ordered=True):
+        assert not ordered
+        failure = self.failures.pop(0) if self.failures else None
+        if failure == 'connection':
+            raise AutoReconnect('primary stepped down')
+        if failure == 'write_concern':
+            # applied, but not replicated in time
+            for request in requests:
+                self.documents[request._doc['url']] = request._doc
+            raise BulkWriteError({'nUpserted': len(requests), 'nMatched': 0, 'writeErrors': [],
+                                  'writeConcernErrors': [{'code': 64, 'errmsg': 'waiting for replication timed out'}]})
+
+        details = {'nUpserted': 0, 'nMatched': 0, 'writeErrors': []}
+        for idx, request in enumerate(requests):
+            document = request._doc
+            if failure and document['url'] in failure:
+                details['writeErrors'].append({'index': idx, 'code': failure[document['url']], 'errmsg': 'error'})
+                continue
+            if document['url'] in self.documents:
+                details['nMatched'] += 1
+            else:
+                details['nUpserted'] += 1
+            self.documents[document['url']] = document
+
+        if details['writeErrors']:
+            raise BulkWriteError(details)
+        return pymongo.results.BulkWriteResult({'nUpserted': details['nUpserted'], 'nMatched': details['nMatched'], 'upserted': []}, True)
+
+def test_bulk_upsert():
+    documents = [{'url': f"https://cbc.ca/{idx}", 'publish_date': datetime.datetime(2021, 9, idx + 1)} for idx in range(4)]
+    # a connection failure is retried, a duplicate key or a document too large is not
+    collection = FakeCollection(['connection', {'https://cbc.ca/1': 11000, 'https://cbc.ca/2': 10334}])
+
+    counts = mongo_sink.bulk_upsert(collection, documents + [{'url': None}], max_retries=3, backoff=0)
+    assert counts == {'inserted': 2, 'updated': 0, 'failed': 3, 'failed_keys': ['https://cbc.ca/1', 'https://cbc.ca/2']}
+
+    counts = mongo_sink.bulk_upsert(collection, documents, max_retries=3, backoff=0)
+    assert counts == {'inserted': 2, 'updated': 2, 'failed': 0, 'failed_keys': []}
+    assert len(collection.documents) == 4
+
+def test_bulk_upsert_write_concern():
+    documents = [{'url': f"https://cbc.ca/{idx}"} for idx in range(3)]
+
+    # unacknowledged writes are not counted as written
+    counts = mongo_sink.bulk_upsert(FakeCollection(['write_concern']), documents, max_retries=0, backoff=0)
+    assert counts == {'inserted': 0, 'updated': 0, 'failed': 3, 'failed_keys': [document['url'] for document in documents]}
+
+    # and are counted once rewritten, as updates of the documents already applied
+    counts = mongo_sink.bulk_upsert(FakeCollection(['write_concern']), documents, max_retries=1, backoff=0)
+    assert counts == {'inserted': 0, 'updated': 3, 'failed': 0, 'failed_keys': []}
+
+def test_to_document():
+    publish_time = datetime.datetime(2021, 9, 1, 12, 30)
+    document = mongo_sink._to_document(psql.Row(url='https://cbc.ca/1', publish_date=datetime.date(2021, 9, 1), fetch_time=publish_time))
+
+    # the same instants, explicitly in UTC
+    assert document['publish_date'] == datetime.datetime(2021, 9, 1, tzinfo=datetime.timezone.utc)
+    assert document['fetch_time'].tzinfo == datetime.timezone.utc
+    assert document['fetch_time'].timestamp() == publish_time.timestamp()
+
+class IndexCollection:
+    name = 'articles'
+
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+        self.indexes = []
+
+    def create_index(self, key, unique=False):
+        if unique and self.duplicates:
+            raise DuplicateKeyError('E11000 duplicate key error', code=11000)
+        self.indexes.append((key, unique))
+
+def test_create_key_index():
+    collection = IndexCollection(duplicates=False)
+    mongo_sink._create_key_index(collection, 'url')
+    assert collection.indexes == [('url', True)]
+
+    # duplicates left by earlier runs don't stop articles being written
+    collection = IndexCollection(duplicates=True)
+    mongo_sink._create_key_index(collection, 'url')
+    assert collection.indexes == [('url', False)]
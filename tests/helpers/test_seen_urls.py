@@ -0,0 +1,26 @@
+import numpy as np
+
+from seldonite.helpers import seen_urls
+
+def test_url_fingerprint():
+    assert seen_urls.url_fingerprint('https://www.cbc.ca/news/politics/story') == seen_urls.url_fingerprint('http://cbc.ca/news/politics/story')
+    assert seen_urls.url_fingerprint('https://cbc.ca/news/politics/story') != seen_urls.url_fingerprint('https://cbc.ca/news/world/story')
+
+def test_bloom_seen_urls(tmp_path):
+    path = str(tmp_path / 'seen.npz')
+    bloom = seen_urls.BloomSeenUrls(path, capacity=1000, error_rate=0.01)
+
+    rng = np.random.default_rng(0)
+    fingerprints = rng.integers(np.iinfo(np.int64).min, np.iinfo(np.int64).max, size=6000, dtype=np.int64)
+    seen, unseen = fingerprints[:3000], fingerprints[3000:]
+
+    assert not bloom.contains(seen).any()
+    bloom.add_fingerprints(seen)
+    bloom.add_fingerprints(seen[:10])
+    bloom.save()
+
+    loaded_bloom = seen_urls.BloomSeenUrls(path, capacity=1000, error_rate=0.01)
+    assert loaded_bloom.contains(seen).all()
+    assert loaded_bloom.contains(unseen).mean() < 0.01
+    # filled filters are followed by larger ones, rather than overfilled
+    assert [bloom_filter['count'] for bloom_filter in loaded_bloom._get_filters()] == [1000, 2000]
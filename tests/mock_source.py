@@ -1,5 +1,24 @@
 from seldonite.sources import news
 
+
+class LocalSparkManager:
+    '''
+    Spark manager of a session started by a test
+    '''
+
+    def __init__(self, spark, num_cpus=1):
+        self._spark = spark
+        self._num_cpus = num_cpus
+
+    def get_spark_session(self):
+        return self._spark
+
+    def get_spark_context(self):
+        return self._spark.sparkContext
+
+    def get_num_cpus(self):
+        return self._num_cpus
+
 class MockSource(news.BaseSource):
     def __init__(self, can_keyword_filter=False, articles=None):
         super().__init__()
@@ -19,4 +38,14 @@ class MockSource(news.BaseSource):
         if self.can_keyword_filter:
             return [{'url': 'https://cbc.ca/thing/happened/', 'text': ' '.join(self.keywords)}] * 10
         else:
-            return []
\ No newline at end of file
+            return []
+
+class SparkSource(news.BaseSource):
+    def __init__(self, articles):
+        super().__init__()
+
+        self.articles = articles
+
+    def fetch(self, spark_manager, max_articles=None, url_only=False):
+        df = spark_manager.get_spark_session().createDataFrame(self.articles)
+        return self._apply_default_filters(df, spark_manager, url_only, max_articles)
@@ -0,0 +1,256 @@
+import datetime
+import http.server
+import json
+import os
+import socket
+import sys
+import threading
+import urllib.parse
+
+import pandas as pd
+import pyspark.sql as psql
+import pytest
+
+from seldonite.sources import news
+from seldonite.spark import spark_tools
+
+import mock_source
+
+MONGO_URI = os.environ.get('SELDONITE_TEST_MONGO_URI', 'mongodb://localhost:27017')
+
+
+def test_mongodb_pipeline():
+    source = news.MongoDB('mongodb://localhost:27017', 'news', 'articles')
+    source.set_date_range(datetime.date(2021, 9, 1), datetime.date(2021, 9, 30))
+    source.set_sites(['cbc.ca', 'apnews.com'])
+    source.set_url_blacklist(['*/sports/*'])
+    source.set_features(['title', 'url'])
+
+    assert source.get_pipeline(max_articles=10) == [
+        {'$match': {'$and': [
+            {'publish_date': {'$gte': {'$date': '2021-09-01T00:00:00Z'}, '$lte': {'$date': '2021-09-30T00:00:00Z'}}},
+            {'$or': [{'url': {'$regex': r'cbc\.ca'}}, {'url': {'$regex': r'apnews\.com'}}]},
+            {'url': {'$type': 'string', '$not': {'$regex': '(?s)^(?:.*/sports/.*)(?!.)'}}}
+        ]}},
+        {'$limit': 10},
+        {'$project': {'title': 1, 'url': 1, '_id': 0}}
+    ]
+
+    assert news.MongoDB('mongodb://localhost:27017', 'news', 'articles').get_pipeline(url_only=True) == [{'$project': {'url': 1, '_id': 0}}]
+
+def _mongod_running():
+    host, port = MONGO_URI.split('//')[-1].split('/')[0].split(':')
+    try:
+        with socket.create_connection((host, int(port)), timeout=1):
+            return True
+    except OSError:
+        return False
+
+@pytest.mark.skipif(not _mongod_running(), reason='needs a local mongod')
+def test_mongodb_fetch():
+    pymongo = pytest.importorskip('pymongo')
+
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    collection = pymongo.MongoClient(MONGO_URI)['seldonite_test']['articles']
+    collection.drop()
+    collection.insert_many([
+        {'title': 'Budget', 'text': 'Text', 'url': 'https://www.cbc.ca/news/budget', 'publish_date': datetime.datetime(2021, 9, 1)},
+        {'title': 'Final', 'text': 'Text', 'url': 'https://www.cbc.ca/sports/final', 'publish_date': datetime.datetime(2021, 9, 2)},
+        {'title': 'Storm', 'text': 'Text', 'url': 'https://apnews.com/article/storm', 'publish_date': datetime.datetime(2021, 9, 3)},
+        {'title': 'Old', 'text': 'Text', 'url': 'https://www.cbc.ca/news/old', 'publish_date': datetime.datetime(2020, 1, 1)},
+    ])
+
+    spark = psql.SparkSession.builder \
+        .master('local[1]') \
+        .appName("test_mongodb_fetch") \
+        .config('spark.jars.packages', 'org.mongodb.spark:mongo-spark-connector_2.12:3.0.1') \
+        .getOrCreate()
+
+    spark_manager = mock_source.LocalSparkManager(spark)
+
+    source = news.MongoDB(MONGO_URI, 'seldonite_test', 'articles')
+    source.set_date_range(datetime.date(2021, 1, 1), datetime.date(2021, 12, 31))
+    source.set_sites(['cbc.ca'])
+    source.set_url_blacklist(['*/sports/*'])
+    source.set_features(['title', 'url'])
+
+    df = source.fetch(spark_manager)
+    assert sorted(df.columns) == ['title', 'url']
+    assert [row['url'] for row in df.collect()] == ['https://www.cbc.ca/news/budget']
+
+ARTICLE_HTML = """<html><head><title>{title}</title></head>
+<body><article><h1>{title}</h1><p>{text}</p></article></body></html>"""
+
+class NewsHandler(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        NewsHandler.requests.append(url.path)
+        if url.path == '/customsearch/v1':
+            start = int(urllib.parse.parse_qs(url.query)['start'][0])
+            host = f"http://localhost:{self.server.server_port}"
+            items = [{'link': f"{host}/news/{idx}"} for idx in range(start, min(start + 10, 16))]
+            body = json.dumps({'searchInformation': {'totalResults': '15'}, **({'items': items} if items else {})})
+            headers = {'Content-Type': 'application/json'}
+        else:
+            idx = url.path.split('/')[-1]
+            if self.headers.get('If-None-Match') == f'"{idx}"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            text = ' '.join(['The minister announced a new budget for schools and hospitals today.'] * 20)
+            body = ARTICLE_HTML.format(title=f"Budget story {idx}", text=text)
+            headers = {'Content-Type': 'text/html', 'ETag': f'"{idx}"'}
+
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def news_server():
+    server = http.server.ThreadingHTTPServer(('localhost', 0), NewsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    NewsHandler.requests = []
+    yield f"http://localhost:{server.server_port}"
+    server.shutdown()
+
+def test_google_fetch(news_server, tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[1]') \
+        .appName("test_google_fetch") \
+        .getOrCreate()
+
+    spark_manager = mock_source.LocalSparkManager(spark)
+
+    source = news.Google('key', 'engine', api_url=f"{news_server}/customsearch/v1", queries_per_second=100, min_host_interval=0, cache_dir=str(tmp_path))
+    source.set_keywords(['budget'])
+    source.set_url_blacklist(['*/news/3'])
+
+    df = source.fetch(spark_manager, max_articles=20)
+    rows = df.collect()
+    assert sorted(row['url'] for row in rows) == sorted(f"{news_server}/news/{idx}" for idx in range(1, 16) if idx != 3)
+    assert all(row['title'].startswith('Budget story') for row in rows)
+    assert NewsHandler.requests.count('/customsearch/v1') == 2
+
+    # unchanged articles come from the cache
+    assert source.fetch(spark_manager, max_articles=20).count() == 14
+
+    url_df = source.fetch(spark_manager, max_articles=10, url_only=True)
+    assert url_df.columns == ['url']
+    # blacklisted URLs are dropped from the results asked for
+    assert url_df.count() == 9
+
+def test_url_list_fetch(news_server, tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[2]') \
+        .appName("test_url_list_fetch") \
+        .getOrCreate()
+
+    spark_manager = mock_source.LocalSparkManager(spark, num_cpus=2)
+
+    urls = [f"{news_server}/news/{idx}" for idx in range(20)] + [f"{news_server}/news/0", 'http://localhost:1/unreachable']
+    source = news.URLList(urls, max_per_host=4, min_host_interval=0, cache_dir=str(tmp_path), batch_size=8)
+    source.set_url_blacklist(['*/news/1'])
+    source.set_features(['title', 'url', 'publish_date'])
+
+    df = source.fetch(spark_manager)
+    assert df.columns == ['title', 'url', 'publish_date']
+    rows = df.collect()
+    assert sorted(row['url'] for row in rows) == sorted(f"{news_server}/news/{idx}" for idx in range(20) if idx != 1)
+    assert all(row['title'] == f"Budget story {row['url'].split('/')[-1]}" for row in rows)
+
+    assert source.fetch(spark_manager, url_only=True).count() == 20
+
+    # only as many pages as articles asked for are downloaded
+    NewsHandler.requests = []
+    source = news.URLList(urls[:20], max_per_host=4, min_host_interval=0, batch_size=8)
+    assert source.fetch(spark_manager, max_articles=5).count() == 5
+    assert len(NewsHandler.requests) == 5
+
+def test_multi_source(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[2]') \
+        .appName("test_multi_source") \
+        .getOrCreate()
+
+    spark_manager = mock_source.LocalSparkManager(spark, num_cpus=2)
+
+    def cached_rdds():
+        return set(spark.sparkContext._jsc.getPersistentRDDs().keySet())
+
+    cached_before = cached_rdds()
+
+    first_path = str(tmp_path / 'first.csv')
+    pd.DataFrame({
+        'title': ['Budget passed', 'Final won', 'Storm hits'],
+        'text': ['The budget', 'A close game', 'Rain'],
+        'url': ['https://www.paper.com/budget', 'https://paper.com/sport/final', 'https://weather.com/storm'],
+        'publish_date': ['2021-09-01 10:00:00', '2021-09-15 12:00:00', '2021-10-01 08:00:00']
+    }).to_csv(first_path)
+    # no text column, and the budget story again under another form of its URL
+    second_path = str(tmp_path / 'second.csv')
+    pd.DataFrame({
+        'title': ['Budget passed again', 'Election called'],
+        'url': ['https://paper.com/budget', 'https://news.com/election'],
+        'publish_date': ['2021-09-02 10:00:00', '2021-09-20 09:00:00']
+    }).to_csv(second_path)
+
+    source = news.MultiSource([news.CSV(first_path), news.CSV(second_path)])
+    source.set_url_blacklist(['*/sport/*'])
+    source.set_date_range(datetime.date(2021, 9, 1), datetime.date(2021, 9, 30))
+    assert all(child.url_black_list == ['*/sport/*'] for child in source.sources)
+
+    df = source.fetch(spark_manager)
+    assert df.columns == ['title', 'text', 'url', 'publish_date']
+    rows = {row['url']: row for row in df.collect()}
+    assert sorted(rows) == ['https://news.com/election', 'https://www.paper.com/budget']
+    assert rows['https://www.paper.com/budget']['title'] == 'Budget passed'
+    assert rows['https://news.com/election']['text'] is None
+
+    # sources only filter URLs by dates they have
+    assert sorted(row['url'] for row in source.fetch(spark_manager, url_only=True).collect()) == \
+        ['https://news.com/election', 'https://weather.com/storm', 'https://www.paper.com/budget']
+
+    # only the deduplicated articles stay cached, until released
+    assert len(cached_rdds() - cached_before) == 1
+    source._release()
+    assert cached_rdds() == cached_before
+
+    # the pool of the calling thread is kept
+    spark.sparkContext.setLocalProperty('spark.scheduler.pool', 'outer')
+    source.fetch(spark_manager)
+    assert spark.sparkContext.getLocalProperty('spark.scheduler.pool') == 'outer'
+    spark.sparkContext.setLocalProperty('spark.scheduler.pool', None)
+    source._release()
+
+    # sources fetched before one fails are released
+    class FailingSource(news.BaseSource):
+        def fetch(self, spark_manager, max_articles=None, url_only=False):
+            raise ConnectionError('archive unavailable')
+
+    source = news.MultiSource([news.CSV(first_path), FailingSource()])
+    with pytest.raises(ValueError, match='FailingSource'):
+        source.fetch(spark_manager)
+    assert cached_rdds() == cached_before
+
+    spark_builder = spark_tools.SparkBuilder(None)
+    source._set_spark_options(spark_builder)
+    assert spark_builder.conf['spark.scheduler.mode'] == 'FAIR'
@@ -1,14 +1,26 @@
+import collections
+import datetime
+import glob
+import math
 import os
 import sys
 import zipfile
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute
 import pyspark.sql as psql
+import pytest
 
 from seldonite import filters
-from seldonite.helpers import utils
+from seldonite.collect import Collector
+from seldonite.helpers import seen_urls, utils, worker_utils
 from seldonite.commoncrawl.cc_index_fetch_news import CCIndexFetchNewsJob
 from seldonite.commoncrawl.fetch_news import FetchNewsJob
+from seldonite.sources import news
+from seldonite.spark import spark_tools
+
+import mock_source
 
 def test_preprocess_political_filter():
     this_dir_path = os.path.dirname(os.path.abspath(__file__))
@@ -43,4 +55,361 @@ def test_preprocess_political_filter():
     finally:
         # clean up files
         os.remove(os.path.join(fixture_path, 'model.h5'))
-        os.remove(os.path.join(fixture_path, 'tokenizer.json'))
\ No newline at end of file
+        os.remove(os.path.join(fixture_path, 'tokenizer.json'))
+
+def test_url_blacklist_regex_matches_like():
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_url_blacklist") \
+        .getOrCreate()
+
+    urls = [
+        'https://www.cbc.ca/sports/hockey/story',
+        'https://www.cbc.ca/news/politics/story',
+        'https://www.cbc.ca/live_blog/1',
+        'https://www.cbc.ca/liveXblog/1',
+        'https://www.cbc.ca/video?id=1.2',
+        'https://www.cbc.ca/video?id=102',
+        "https://www.cbc.ca/o'brien/story",
+        'https://www.cbc.ca/sports'
+    ]
+    url_wildcards = ['*/sports/*', '*/live\\_blog/*', '*?id=1.2', "*/o'brien/*"]
+    df = spark.createDataFrame([(url,) for url in urls], ['url'])
+
+    like_df = df
+    for url_wildcard in url_wildcards:
+        like_df = like_df.where(~psql.functions.col('url').like(url_wildcard.replace('*', '%')))
+
+    regex_df = df.where(~psql.functions.col('url').rlike(filters.url_blacklist_regex(url_wildcards)))
+
+    df.createOrReplaceTempView('urls')
+    regex = worker_utils.escape_sql_string(filters.url_blacklist_regex(url_wildcards))
+    sql_df = spark.sql(f"SELECT url FROM urls WHERE NOT (url RLIKE '{regex}')")
+
+    like_urls = sorted(row['url'] for row in like_df.collect())
+    assert like_urls == sorted(row['url'] for row in regex_df.collect())
+    assert like_urls == sorted(row['url'] for row in sql_df.collect())
+    assert like_urls == sorted(url for url in urls if not filters.check_url_blacklisted(url, filters.compile_url_blacklist(url_wildcards)))
+
+
+def test_lookup_urls_by_surtkey():
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_lookup_urls") \
+        .getOrCreate()
+
+    index_urls = ['https://www.cbc.ca/news/politics/story', 'https://www.cbc.ca/sports/hockey/story', 'https://apnews.com/article/a']
+    index_df = utils.add_surtkey(spark.createDataFrame([(url,) for url in index_urls], ['url']))
+    url_df = utils.add_surtkey(spark.createDataFrame([('http://cbc.ca/news/politics/story',), ('https://apnews.com/article/a',)], ['url']))
+
+    for broadcast in [True, False]:
+        found_df = utils.lookup_urls(index_df, url_df, on='url_surtkey', broadcast=broadcast)
+        assert sorted(row['url'] for row in found_df.collect()) == ['https://apnews.com/article/a', 'https://www.cbc.ca/news/politics/story']
+
+
+def test_batch():
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_batch") \
+        .getOrCreate()
+
+    num_rows = 1000
+    max_rows = 150
+    df = spark.range(num_rows).repartition(7)
+
+    batch_ids = []
+    num_batches = 0
+    for df_batch in spark_tools.batch(df, max_rows=max_rows):
+        assert df_batch.columns == ['id']
+        ids = [row['id'] for row in df_batch.collect()]
+        assert 0 < len(ids) <= max_rows
+        batch_ids.extend(ids)
+        num_batches += 1
+
+    assert num_batches == math.ceil(num_rows / max_rows)
+    assert sorted(batch_ids) == list(range(num_rows))
+
+def test_reservoir_sample():
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_reservoir_sample") \
+        .getOrCreate()
+
+    df = spark.createDataFrame([(idx, 'a' if idx < 900 else 'b') for idx in range(1000)], ['id', 'domain']).repartition(7)
+
+    sample_df = spark_tools.reservoir_sample(df, 50, seed=1)
+    sample_ids = [row['id'] for row in sample_df.collect()]
+    assert sample_df.columns == ['id', 'domain']
+    assert len(set(sample_ids)) == 50
+    assert sample_ids == [row['id'] for row in spark_tools.reservoir_sample(df, 50, seed=1).collect()]
+    assert sample_ids != [row['id'] for row in spark_tools.reservoir_sample(df, 50, seed=2).collect()]
+
+    assert spark_tools.reservoir_sample(df, 2000).count() == 1000
+
+    domains = collections.Counter(row['domain'] for row in spark_tools.reservoir_sample(df, 50, strata_col='domain').collect())
+    assert domains == {'a': 45, 'b': 5}
+    domains = collections.Counter(row['domain'] for row in spark_tools.reservoir_sample(df, 50, strata_col='domain', allocation='equal').collect())
+    assert domains == {'a': 25, 'b': 25}
+
+    # many small strata still give a sample of the requested size
+    df = spark.createDataFrame([(idx, str(idx // 5)) for idx in range(1000)], ['id', 'domain']).repartition(7)
+    sample_ids = [row['id'] for row in spark_tools.reservoir_sample(df, 50, strata_col='domain').collect()]
+    assert len(set(sample_ids)) == 50
+
+def test_allocate_sample():
+    assert spark_tools._allocate_sample({'a': 5, 'b': 3, 'c': 2}, 4) == {'a': 2, 'b': 1, 'c': 1}
+    assert spark_tools._allocate_sample({'a': 100, 'b': 3, 'c': 2}, 30, allocation='equal') == {'a': 25, 'b': 3, 'c': 2}
+    assert spark_tools._allocate_sample({'a': 5, 'b': 3}, 20) == {'a': 5, 'b': 3}
+
+def test_drop_near_duplicates():
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_drop_near_duplicates") \
+        .getOrCreate()
+
+    story = 'The prime minister announced a new budget on {}, promising lower taxes for working families ' \
+            'and more funding for hospitals, schools and public transport across the {}.'
+    articles = [
+        ('https://wire.com/budget', '2021-01-02', story.format('Tuesday', 'country')),
+        ('https://paper.com/budget', '2021-01-01', story.format('Tuesday', 'nation')),
+        ('https://undated.com/budget', None, story.format('Tuesday', 'nation')),
+        ('https://other.com/budget', '2021-01-03', story.format('Tuesday', 'country')),
+        ('https://sport.com/final', '2021-01-01', 'The home team won the cup final after a late goal in extra time, to the delight of their fans.'),
+        ('https://empty.com/page', '2021-01-01', None)
+    ]
+    df = spark.createDataFrame(articles, 'url string, publish_date string, all_text string').repartition(3)
+
+    # the undated copy is dropped in favour of the earliest dated article
+    deduped_df = filters.duplicates.drop_near_duplicates(df, threshold=0.7)
+
+    assert deduped_df.columns == df.columns
+    assert sorted(row['url'] for row in deduped_df.collect()) == ['https://empty.com/page', 'https://paper.com/budget', 'https://sport.com/final']
+
+def test_seen_urls(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_seen_urls") \
+        .getOrCreate()
+    spark_manager = mock_source.LocalSparkManager(spark)
+
+    first_urls = ['https://www.cbc.ca/news/a', 'https://apnews.com/article/b']
+    second_urls = ['http://cbc.ca/news/a', 'https://apnews.com/article/c']
+    first_df = spark.createDataFrame([(url, 'title') for url in first_urls], ['url', 'title'])
+    second_df = spark.createDataFrame([(url, 'title') for url in second_urls], ['url', 'title'])
+
+    for seen in [seen_urls.ParquetSeenUrls(str(tmp_path / 'seen')), seen_urls.BloomSeenUrls(str(tmp_path / 'seen.npz'))]:
+        assert sorted(row['url'] for row in seen.exclude(spark_manager, first_df).collect()) == sorted(first_urls)
+
+        seen.add(spark_manager, first_df)
+        seen.add(spark_manager, first_df)
+
+        assert seen.exclude(spark_manager, first_df).columns == first_df.columns
+        assert [row['url'] for row in seen.exclude(spark_manager, second_df).collect()] == ['https://apnews.com/article/c']
+
+        index_df = utils.add_surtkey(second_df)
+        assert [row['url'] for row in seen.exclude(spark_manager, index_df, surtkey_col='url_surtkey').collect()] == ['https://apnews.com/article/c']
+
+    assert spark.read.parquet(str(tmp_path / 'seen')).count() == 2
+
+    # runs of added URLs are merged once there are too many files
+    seen = seen_urls.ParquetSeenUrls(str(tmp_path / 'merged'), max_files=2)
+    urls = [f"https://www.cbc.ca/news/{idx}" for idx in range(6)]
+    for idx in range(0, 6, 2):
+        seen.add(spark_manager, spark.createDataFrame([(url,) for url in urls[idx:idx + 2]], ['url']))
+    assert len(glob.glob(str(tmp_path / 'merged' / '*.parquet'))) <= 2
+    assert not os.path.exists(tmp_path / 'merged' / '_staging')
+    assert spark.read.parquet(str(tmp_path / 'merged')).count() == 6
+    assert seen.exclude(spark_manager, spark.createDataFrame([(url,) for url in urls + ['https://apnews.com/article/c']], ['url'])).count() == 1
+
+def test_batch_udf():
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_batch_udf") \
+        .getOrCreate()
+
+    df = spark.createDataFrame([(idx, f"title {idx}", 'text ' * idx) for idx in range(100)], ['id', 'title', 'text']).repartition(2)
+
+    def setup():
+        return {'calls': 0}
+
+    def text_stats(state, titles, texts):
+        state['calls'] += 1
+        assert len(titles) <= 30
+        return texts.str.len(), titles.str.upper(), pd.Series([state['calls']] * len(titles))
+
+    collector = Collector(None)
+    assert collector.apply_batch_udf(text_stats, ['title', 'text'], 'text_length int, title string, call long', batch_size=30, setup=setup) is collector
+    collector.apply_batch_udf(lambda ids: pa.compute.multiply(ids, 2), 'id', 'id long', arrow=True)
+
+    output_df = collector._batch_udf_stage(df, None)
+    assert output_df.columns == ['text', 'text_length', 'title', 'call', 'id']
+
+    rows = sorted(output_df.collect(), key=lambda row: row['text_length'])
+    assert [row['text_length'] for row in rows] == [5 * idx for idx in range(100)]
+    assert [row['title'] for row in rows] == [f"TITLE {idx}" for idx in range(100)]
+    assert [row['id'] for row in rows] == [2 * idx for idx in range(100)]
+    # setup state is kept between batches on a worker
+    assert max(row['call'] for row in rows) > 1
+
+def test_csv_source(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_csv_source") \
+        .getOrCreate()
+    spark_manager = mock_source.LocalSparkManager(spark)
+
+    csv_path = str(tmp_path / 'articles.csv')
+    cache_dir = str(tmp_path / 'cache')
+    articles = pd.DataFrame({
+        'title': ['Budget passed', 'Final won', 'Storm hits'],
+        'text': ['The budget,\n"finally"', 'A close game', 'Rain'],
+        'url': ['https://paper.com/budget', 'https://sport.com/final', 'https://weather.com/storm'],
+        'publish_date': ['2021-09-01 10:00:00', '2021-09-15 12:00:00', '2021-10-01 08:00:00']
+    })
+    articles.to_csv(csv_path)
+
+    source = news.CSV(csv_path, schema='url string, publish_date timestamp', cache_dir=cache_dir)
+    source.set_date_range(datetime.date(2021, 9, 10), datetime.date(2021, 12, 1))
+    df = source.fetch(spark_manager)
+
+    assert dict(df.dtypes) == {'title': 'string', 'text': 'string', 'url': 'string', 'publish_date': 'timestamp'}
+    assert sorted(row['url'] for row in df.collect()) == ['https://sport.com/final', 'https://weather.com/storm']
+    assert df.where(df['url'] == 'https://paper.com/budget').count() == 0
+
+    cache_versions = os.listdir(os.path.join(cache_dir, os.listdir(cache_dir)[0]))
+    source.fetch(spark_manager).collect()
+    assert os.listdir(os.path.join(cache_dir, os.listdir(cache_dir)[0])) == cache_versions
+
+    # changing the CSV replaces the cached copy
+    pd.concat([articles, articles.iloc[:1]], ignore_index=True).to_csv(csv_path)
+    source.set_date_range(None, None)
+    assert source.fetch(spark_manager).count() == 4
+    new_versions = os.listdir(os.path.join(cache_dir, os.listdir(cache_dir)[0]))
+    assert len(new_versions) == 1 and new_versions != cache_versions
+
+    uncached_df = news.CSV(csv_path).fetch(spark_manager)
+    assert sorted(uncached_df.columns) == ['publish_date', 'text', 'title', 'url']
+    assert uncached_df.count() == 4
+
+    with pytest.raises(ValueError):
+        news.CSV(csv_path, schema='author string').fetch(spark_manager)
+
+def test_parquet_store(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    master = 'local[1]'
+    spark = psql.SparkSession.builder \
+        .master(master) \
+        .appName("test_parquet_store") \
+        .getOrCreate()
+    spark_manager = mock_source.LocalSparkManager(spark)
+
+    store_path = str(tmp_path / 'store')
+    store = news.ParquetStore(store_path)
+    articles = [
+        ('Budget passed', 'Text', 'https://news.bbc.co.uk/budget', datetime.datetime(2021, 9, 1)),
+        ('Final won', 'Text', 'https://www.cbc.ca/sports/final', datetime.datetime(2021, 9, 15)),
+        ('Storm hits', 'Text', 'https://www.cbc.ca/news/storm', datetime.datetime(2021, 10, 1)),
+    ]
+    # incremental appends leave a file per partition each
+    for article in articles + articles:
+        store.write(spark.createDataFrame([article], ['title', 'text', 'url', 'publish_date']))
+
+    assert sorted(os.listdir(store_path + '/year=2021/month=9')) == ['domain=bbc.co.uk', 'domain=cbc.ca']
+
+    store.set_date_range(datetime.date(2021, 9, 10), datetime.date(2021, 12, 1))
+    store.set_sites(['cbc.ca'])
+    df = store.fetch(spark_manager)
+    assert df.columns == ['title', 'text', 'url', 'publish_date']
+    assert sorted(row['url'] for row in df.collect()) == ['https://www.cbc.ca/news/storm'] * 2 + ['https://www.cbc.ca/sports/final'] * 2
+
+    assert store.compact(spark_manager) == 3
+    assert store.compact(spark_manager) == 0
+    partition_files = [file for file in os.listdir(store_path + '/year=2021/month=9/domain=cbc.ca') if file.endswith('.parquet')]
+    assert len(partition_files) == 1
+
+    store.set_date_range(None, None)
+    store.set_sites([])
+    store.set_features(['url'])
+    df = store.fetch(spark_manager)
+    assert df.columns == ['url']
+    assert df.count() == 6
+
+def test_parquet_store_compact_failure(tmp_path):
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[1]') \
+        .appName("test_parquet_store_compact_failure") \
+        .getOrCreate()
+    spark_manager = mock_source.LocalSparkManager(spark)
+
+    store_path = str(tmp_path / 'store')
+    store = news.ParquetStore(store_path)
+    articles = [
+        ('Budget passed', 'Text', 'https://news.bbc.co.uk/budget', datetime.datetime(2021, 9, 1)),
+        ('Final won', 'Text', 'https://www.cbc.ca/sports/final', datetime.datetime(2021, 9, 15)),
+        ('Storm hits', 'Text', 'https://www.cbc.ca/news/storm', datetime.datetime(2021, 10, 1)),
+    ]
+    for article in articles + articles:
+        store.write(spark.createDataFrame([article], ['title', 'text', 'url', 'publish_date']))
+    expected_urls = sorted(article[2] for article in articles + articles)
+
+    # moving the second merged file fails, after the first partition's merged file is in place
+    num_renames = []
+    def failing_rename(fs, src, dst):
+        num_renames.append(src)
+        if len(num_renames) == 2:
+            return False
+        return fs.rename(src, dst)
+    store._rename = failing_rename
+
+    with pytest.raises(OSError):
+        store.compact(spark_manager)
+    assert os.path.exists(os.path.join(store_path, '_staging'))
+
+    # articles may be seen twice, but none are lost
+    store.set_features(['url'])
+    assert sorted(set(row['url'] for row in store.fetch(spark_manager).collect())) == sorted(set(expected_urls))
+    assert store.fetch(spark_manager).count() >= len(expected_urls)
+
+    # the next compaction finishes the failed one
+    news.ParquetStore(store_path).compact(spark_manager)
+    assert not os.path.exists(os.path.join(store_path, '_staging'))
+    assert sorted(row['url'] for row in store.fetch(spark_manager).collect()) == expected_urls
+    for partition in ['year=2021/month=9/domain=cbc.ca', 'year=2021/month=9/domain=bbc.co.uk', 'year=2021/month=10/domain=cbc.ca']:
+        assert len([file for file in os.listdir(os.path.join(store_path, partition)) if file.endswith('.parquet')]) == 1
@@ -1,6 +1,10 @@
+import os
+import sys
+
+import pyspark.sql as psql
 import pytest
 
-from seldonite import collect
+from seldonite import collect, run
 
 import mock_source
 
@@ -38,4 +42,65 @@ def test_model_topics(articles):
 
     assert lda
     assert dictionary
-    
\ No newline at end of file
+    
+
+def test_plan_filters():
+    collector = collect.Collector(mock_source.SparkSource([]))
+    assert collector.get_plan() == ['fetch']
+
+    # set in a different order to the one they run in
+    collector.mentions_countries(['Canada']) \
+             .drop_near_duplicates() \
+             .in_language('en') \
+             .by_keywords(['budget']) \
+             .distinct() \
+             .from_urls(['https://www.cbc.ca/news/budget']) \
+             .apply_batch_udf(lambda text: text, 'text', 'text string') \
+             .apply_udf(psql.functions.udf(lambda text: text), 'text')
+
+    # functions replacing the text run before the filters reading it
+    assert collector.get_plan() == ['fetch', 'urls', 'distinct', 'udf', 'batch_udf', 'keywords', 'language', 'near_duplicates', 'countries']
+    assert [name for name, _ in collector._plan_filters()] == collector.get_plan()[1:]
+
+    # and other functions after all filters, so they only see the rows kept
+    collector = collect.Collector(mock_source.SparkSource([]))
+    collector.apply_batch_udf(lambda text: text, 'text', 'sentiment double, scores struct<positive: double, negative: double>') \
+             .by_keywords(['budget']) \
+             .distinct()
+    assert collector.get_plan() == ['fetch', 'distinct', 'keywords', 'batch_udf']
+
+def test_ddl_column_names():
+    assert collect._ddl_column_names('sentiment double, label string') == ['sentiment', 'label']
+    assert collect._ddl_column_names('scores struct<positive:double,negative:double>, `tags` array<string>') == ['scores', 'tags']
+    assert collect._ddl_column_names('label:string') == ['label']
+
+def test_count_rows():
+    os.environ['PYSPARK_PYTHON'] = sys.executable
+    os.environ['PYSPARK_DRIVER_PYTHON'] = sys.executable
+
+    spark = psql.SparkSession.builder \
+        .master('local[1]') \
+        .appName("test_count_rows") \
+        .getOrCreate()
+    spark_manager = mock_source.LocalSparkManager(spark)
+
+    articles = [{'url': f"https://www.cbc.ca/news/story-{idx % 4}", 'title': 'Story', 'text': 'the budget' if idx % 2 else 'the game'}
+                for idx in range(8)]
+    collector = collect.Collector(mock_source.SparkSource(articles))
+    collector.distinct().by_keywords(['budget']).count_rows()
+
+    df = collector._process(spark_manager)
+    assert sorted(row['url'] for row in df.collect()) == ['https://www.cbc.ca/news/story-1', 'https://www.cbc.ca/news/story-3']
+    assert list(collector.filter_row_counts.items()) == [('fetch', 8), ('distinct', 4), ('keywords', 2)]
+
+    # frames cached for counting are released once the output is cached
+    runner = run.Runner(collector)
+    runner.set_spark_manager(spark_manager)
+    df = runner.get_obj()
+    assert df.is_cached
+    assert all(persisted_df is df for persisted_df in collector._persisted_dfs)
+    assert df.count() == 2
+
+    runner.release()
+    assert not df.is_cached
+    assert not collector._persisted_dfs